@@ -0,0 +1,615 @@
+"""
+Saga outcome history, and queries over it.
+
+When QBOX_ANALYTICS_DIR is set, every saga that finishes is recorded there: one row in
+the `sagas` table (its outcome, duration, and how many transactions, skipped steps,
+retries and compensations it took) and one row in the `steps` table for each
+transaction and compensation it sent (status, attempts and latency). Rows are buffered
+in memory and written behind by one thread, every QBOX_ANALYTICS_FLUSH_SECONDS or
+SEGMENT_ROWS rows, so recording costs a saga a few appends.
+
+Files are columnar. After a magic string, a file is a sequence of segments of
+
+    header length (4 bytes) | JSON header | column | column | ...
+
+where each column is a packed array of fixed-width little-endian values, with the
+header giving the table, row count, column types and byte lengths, the range of
+`finished` times in the segment and, for string columns, the segment's dictionary
+(the column then holds indexes into it). Files are rolled once they grow past
+QBOX_ANALYTICS_FILE_BYTES, and only the newest QBOX_ANALYTICS_MAX_FILES are kept.
+
+Queries load whole columns at a time with `array.frombytes`, skip segments that are
+entirely outside the time range asked for, and aggregate with grouping and sorting
+done by the interpreter's built-ins, which gets through millions of rows in seconds:
+
+    python3 analytics.py sagas --since 3600
+    python3 analytics.py steps --saga orders
+    python3 analytics.py failures --format json
+"""
+import os
+import sys
+import json
+import glob
+import time
+import array
+import atexit
+import struct
+import logging
+import metrics
+import operator
+import argparse
+import settings
+import itertools
+import threading
+import collections
+
+MAGIC = b"QBOXCOL1"
+HEADER_LENGTH = struct.Struct("<I")
+
+# Rows buffered before the flusher is woken up early.
+SEGMENT_ROWS = 8192
+
+TRANSACTION = 0
+COMPENSATION = 1
+KINDS = {"TRANSACTION": TRANSACTION, "COMPENSATION": COMPENSATION}
+
+# (name, array typecode) of the columns of each table. Typecodes are fixed-width
+# everywhere Qbox runs ("I" is 4 bytes, "H" 2, "h" 2, "B" 1, "f" 4 and "d" 8).
+TABLES = {
+    "sagas": (
+        ("finished", "d"),
+        ("saga", "I"),
+        ("success", "B"),
+        ("durationMs", "f"),
+        ("transactions", "H"),
+        ("skipped", "H"),
+        ("retries", "I"),
+        ("compensations", "H"),
+        ("failedCompensations", "H"),
+        ("exitedEarly", "B"),
+    ),
+    "steps": (
+        ("finished", "d"),
+        ("saga", "I"),
+        ("kind", "B"),
+        ("step", "H"),
+        ("name", "I"),
+        ("status", "H"),
+        ("attempts", "I"),
+        ("latencyMs", "f"),
+        ("succeeded", "B"),
+    ),
+}
+
+# Columns holding strings, stored as indexes into a dictionary.
+STRING_COLUMNS = ("saga", "name")
+
+
+class Table(object):
+    """
+    Rows being buffered for one table, a column at a time.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.columns = {column: array.array(code) for column, code in TABLES[name]}
+        self.strings = {
+            column: {} for column in STRING_COLUMNS if column in self.columns
+        }
+
+    def __len__(self):
+        return len(self.columns["finished"])
+
+    def append(self, row):
+        for column, values in self.columns.items():
+            value = row[column]
+            if column in self.strings:
+                value = self.strings[column].setdefault(
+                    value, len(self.strings[column])
+                )
+            values.append(value)
+
+    def segment(self):
+        blobs = []
+        for values in self.columns.values():
+            if sys.byteorder != "little":
+                values = array.array(values.typecode, values)
+                values.byteswap()
+            blobs.append(values.tobytes())
+
+        finished = self.columns["finished"]
+        header = json.dumps(
+            {
+                "table": self.name,
+                "rows": len(self),
+                "first": min(finished),
+                "last": max(finished),
+                "columns": [
+                    [column, values.typecode, len(blob)]
+                    for (column, values), blob in zip(self.columns.items(), blobs)
+                ],
+                "strings": {
+                    column: list(strings) for column, strings in self.strings.items()
+                },
+            }
+        ).encode("utf-8")
+        return b"".join([HEADER_LENGTH.pack(len(header)), header] + blobs)
+
+
+def saga_name(configuration):
+    match = configuration.get("matchRequest", {})
+    return f"{match.get('method', '')} {match.get('url', '')}".strip()
+
+
+def rows(coordinator, success, failed_compensations):
+    """
+    The rows to record for a saga that just finished, by table.
+    """
+
+    finished = time.time()
+    saga = saga_name(coordinator.configuration)
+    transactions = coordinator.configuration["onMatchedRequest"]
+
+    steps = []
+    for kind, node, succeeded in coordinator.history:
+        step = node.step or 0
+        steps.append(
+            {
+                "finished": finished,
+                "saga": saga,
+                "kind": KINDS[kind],
+                "step": step,
+                "name": transactions[step].get("name", str(step)),
+                "status": node.response_status or 0,
+                "attempts": node.attempts,
+                "latencyMs": (node.elapsed or 0) * 1000,
+                "succeeded": succeeded,
+            }
+        )
+
+    sent = [row for row in steps if row["kind"] == TRANSACTION]
+    compensations = [row for row in steps if row["kind"] == COMPENSATION]
+    return {
+        "sagas": [
+            {
+                "finished": finished,
+                "saga": saga,
+                "success": success,
+                "durationMs": (time.monotonic() - coordinator.started) * 1000,
+                "transactions": len(sent),
+                "skipped": coordinator.skipped,
+                "retries": sum(max(0, row["attempts"] - 1) for row in steps),
+                "compensations": len(compensations),
+                "failedCompensations": len(failed_compensations),
+                "exitedEarly": coordinator.exited_early,
+            }
+        ],
+        "steps": steps,
+    }
+
+
+class AnalyticsWriter(object):
+    def __init__(
+        self,
+        directory,
+        file_bytes=None,
+        max_files=None,
+        flush_seconds=None,
+        segment_rows=SEGMENT_ROWS,
+    ):
+        self.directory = directory
+        self.file_bytes = file_bytes or settings.ANALYTICS_FILE_BYTES
+        self.max_files = max_files or settings.ANALYTICS_MAX_FILES
+        self.flush_seconds = flush_seconds or settings.ANALYTICS_FLUSH_SECONDS
+        self.segment_rows = segment_rows
+        self.condition = threading.Condition()
+        self.tables = self.empty_tables()
+        self.write_lock = threading.Lock()
+        self.file = None
+        self.sequence = 0
+        self.flusher = None
+        self.recorded = 0
+        self.errors = 0
+
+    @staticmethod
+    def empty_tables():
+        return {name: Table(name) for name in TABLES}
+
+    def record(self, coordinator, success, failed_compensations):
+        tables = rows(coordinator, success, failed_compensations)
+
+        with self.condition:
+            for name, table_rows in tables.items():
+                for row in table_rows:
+                    self.tables[name].append(row)
+            self.recorded += 1
+
+            if self.flusher is None:
+                self.flusher = threading.Thread(
+                    target=self.run, name="qbox-analytics", daemon=True
+                )
+                self.flusher.start()
+            if len(self.tables["steps"]) >= self.segment_rows:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait(self.flush_seconds)
+            self.flush()
+
+    def flush(self):
+        with self.condition:
+            tables = self.tables
+            self.tables = self.empty_tables()
+
+        segments = [table.segment() for table in tables.values() if len(table)]
+        if not segments:
+            return
+
+        with self.write_lock:
+            try:
+                file = self.current_file()
+                for segment in segments:
+                    file.write(segment)
+                file.flush()
+            except OSError as e:
+                self.errors += 1
+                logging.error(f"Could not write saga analytics: {e}")
+
+    def current_file(self):
+        if self.file is not None and self.file.tell() < self.file_bytes:
+            return self.file
+
+        if self.file is not None:
+            self.file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        self.sequence += 1
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(
+            self.directory, f"sagas-{stamp}-{os.getpid()}-{self.sequence}.qcol"
+        )
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+
+        for old in files(self.directory)[: -self.max_files]:
+            os.remove(old)
+        return self.file
+
+    def close(self):
+        self.flush()
+        with self.write_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def snapshot(self):
+        with self.condition:
+            return {
+                "recorded": self.recorded,
+                "buffered": len(self.tables["sagas"]),
+                "errors": self.errors,
+            }
+
+
+def files(directory):
+    return sorted(glob.glob(os.path.join(directory, "*.qcol")), key=os.path.getmtime)
+
+
+def read_segments(path):
+    """
+    The (header, column blobs) of each complete segment in a file.
+    """
+
+    with open(path, "rb") as data:
+        if data.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a Qbox analytics file")
+
+        while True:
+            prefix = data.read(HEADER_LENGTH.size)
+            if len(prefix) < HEADER_LENGTH.size:
+                return
+            (length,) = HEADER_LENGTH.unpack(prefix)
+            header = data.read(length)
+            if len(header) < length:
+                return
+            header = json.loads(header)
+
+            blobs = {}
+            for column, _, size in header["columns"]:
+                blobs[column] = data.read(size)
+                if len(blobs[column]) < size:
+                    # A partially written trailing segment, e.g. from a crash.
+                    return
+            yield header, blobs
+
+
+class Columns(object):
+    """
+    One table loaded from analytics files, as a column array per column. String
+    columns hold indexes into `strings`, which is shared by all of them.
+    """
+
+    def __init__(self, name):
+        self.columns = {column: array.array(code) for column, code in TABLES[name]}
+        self.strings = []
+        self.indexes = {}
+
+    def __len__(self):
+        return len(self.columns["finished"])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def intern(self, value):
+        index = self.indexes.get(value)
+        if index is None:
+            index = self.indexes[value] = len(self.strings)
+            self.strings.append(value)
+        return index
+
+    def extend(self, header, blobs, since=None):
+        loaded = {}
+        for column, code, _ in header["columns"]:
+            if column not in self.columns:
+                continue
+            values = array.array(code)
+            values.frombytes(blobs[column])
+            if sys.byteorder != "little":
+                values.byteswap()
+            if column in header["strings"]:
+                translation = [self.intern(s) for s in header["strings"][column]]
+                values = array.array("I", map(translation.__getitem__, values))
+            loaded[column] = values
+
+        if since is not None and header["first"] < since:
+            keep = [finished >= since for finished in loaded["finished"]]
+            loaded = {
+                column: array.array(values.typecode, itertools.compress(values, keep))
+                for column, values in loaded.items()
+            }
+
+        for column, values in self.columns.items():
+            values.extend(loaded[column])
+
+
+def load(directory, since=None):
+    """
+    Every table in the analytics files in `directory`, with only the rows of sagas
+    that finished at or after `since` (a unix timestamp) if given.
+    """
+
+    tables = {name: Columns(name) for name in TABLES}
+    for path in files(directory):
+        for header, blobs in read_segments(path):
+            if since is not None and header["last"] < since:
+                continue
+            tables[header["table"]].extend(header, blobs, since)
+    return tables
+
+
+def percentile(ordered, q):
+    """
+    The nearest-rank `q`-quantile of an already sorted sequence.
+    """
+
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def group(keys, *columns):
+    """
+    The values of `columns` for each distinct key, where keys are tuples taken across
+    the `keys` columns.
+    """
+
+    positions = collections.defaultdict(list)
+    for position, key in enumerate(zip(*keys)):
+        positions[key].append(position)
+
+    groups = {}
+    for key, rows in positions.items():
+        if len(rows) == 1:
+            groups[key] = tuple([column[rows[0]]] for column in columns)
+        else:
+            pick = operator.itemgetter(*rows)
+            groups[key] = tuple(list(pick(column)) for column in columns)
+    return groups
+
+
+def rate(selected, total):
+    return round(selected / total, 4) if total else None
+
+
+def latencies(values):
+    ordered = sorted(values)
+    return {
+        name: round(value, 3) if value is not None else None
+        for name, value in (
+            ("p50", percentile(ordered, 0.5)),
+            ("p90", percentile(ordered, 0.9)),
+            ("p99", percentile(ordered, 0.99)),
+        )
+    }
+
+
+def selected(table, saga):
+    """
+    Positions of the saga ids in `table` whose name contains `saga`, or None for all.
+    """
+
+    if saga is None:
+        return None
+    return {i for i, name in enumerate(table.strings) if saga in name}
+
+
+def saga_summary(tables, saga=None):
+    """
+    Success and compensation rates and duration percentiles, per saga.
+    """
+
+    sagas = tables["sagas"]
+    wanted = selected(sagas, saga)
+    groups = group(
+        [sagas["saga"]],
+        sagas["success"],
+        sagas["compensations"],
+        sagas["failedCompensations"],
+        sagas["retries"],
+        sagas["durationMs"],
+    )
+
+    summary = []
+    for (index,), (success, compensations, failed, retries, durations) in sorted(
+        groups.items(), key=lambda item: sagas.strings[item[0][0]]
+    ):
+        if wanted is not None and index not in wanted:
+            continue
+        count = len(success)
+        summary.append(
+            {
+                "saga": sagas.strings[index],
+                "count": count,
+                "successRate": rate(sum(success), count),
+                "compensationRate": rate(count - compensations.count(0), count),
+                "failedCompensations": sum(failed),
+                "retriesPerSaga": rate(sum(retries), count),
+                "durationMs": latencies(durations),
+            }
+        )
+    return summary
+
+
+def step_summary(tables, saga=None):
+    """
+    Failure rates, attempts and latency percentiles, per saga step.
+    """
+
+    steps = tables["steps"]
+    wanted = selected(steps, saga)
+    groups = group(
+        [steps["saga"], steps["kind"], steps["step"], steps["name"]],
+        steps["succeeded"],
+        steps["attempts"],
+        steps["latencyMs"],
+    )
+
+    summary = []
+    for (index, kind, step, name), (succeeded, attempts, latency) in sorted(
+        groups.items(), key=lambda item: (steps.strings[item[0][0]],) + item[0][1:3]
+    ):
+        if wanted is not None and index not in wanted:
+            continue
+        count = len(succeeded)
+        summary.append(
+            {
+                "saga": steps.strings[index],
+                "kind": "COMPENSATION" if kind == COMPENSATION else "TRANSACTION",
+                "step": step,
+                "name": steps.strings[name],
+                "count": count,
+                "failureRate": rate(count - sum(succeeded), count),
+                "attemptsPerStep": rate(sum(attempts), count),
+                "latencyMs": latencies(latency),
+            }
+        )
+    return summary
+
+
+def failure_breakdown(tables, saga=None):
+    """
+    Failed steps by saga, step and response status (0 for no response), most common
+    first.
+    """
+
+    steps = tables["steps"]
+    wanted = selected(steps, saga)
+    failed = [not succeeded for succeeded in steps["succeeded"]]
+    keys = zip(steps["saga"], steps["kind"], steps["name"], steps["status"])
+    counts = collections.Counter(itertools.compress(keys, failed))
+    total = sum(counts.values())
+
+    return [
+        {
+            "saga": steps.strings[index],
+            "kind": "COMPENSATION" if kind == COMPENSATION else "TRANSACTION",
+            "name": steps.strings[name],
+            "status": status,
+            "count": count,
+            "share": rate(count, total),
+        }
+        for (index, kind, name, status), count in counts.most_common()
+        if wanted is None or index in wanted
+    ]
+
+
+QUERIES = {
+    "sagas": saga_summary,
+    "steps": step_summary,
+    "failures": failure_breakdown,
+}
+
+
+def format_table(results):
+    if not results:
+        return "no sagas recorded"
+
+    def flatten(result):
+        flat = {}
+        for key, value in result.items():
+            if isinstance(value, dict):
+                for inner, inner_value in value.items():
+                    flat[f"{key}.{inner}"] = inner_value
+            else:
+                flat[key] = value
+        return {key: str(value) for key, value in flat.items()}
+
+    flattened = [flatten(result) for result in results]
+    widths = {
+        key: max(len(key), *(len(row[key]) for row in flattened))
+        for key in flattened[0]
+    }
+    lines = ["  ".join(key.rjust(width) for key, width in widths.items())]
+    for row in flattened:
+        lines.append("  ".join(row[key].rjust(width) for key, width in widths.items()))
+    return "\n".join(lines)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("query", choices=sorted(QUERIES))
+    parser.add_argument("--dir", default=settings.ANALYTICS_DIR)
+    parser.add_argument(
+        "--since", type=float, help="only sagas that finished in the last N seconds"
+    )
+    parser.add_argument("--saga", help="only sagas whose name contains this")
+    parser.add_argument("--format", choices=("table", "json"), default="table")
+    args = parser.parse_args(argv)
+
+    if not args.dir:
+        parser.error("no analytics directory (--dir or QBOX_ANALYTICS_DIR)")
+
+    since = time.time() - args.since if args.since is not None else None
+    results = QUERIES[args.query](load(args.dir, since), args.saga)
+
+    if args.format == "json":
+        print(json.dumps(results, indent=2))
+    else:
+        print(format_table(results))
+
+
+writer = None
+if settings.ANALYTICS_DIR:
+    writer = AnalyticsWriter(settings.ANALYTICS_DIR)
+    atexit.register(writer.close)
+    metrics.register("analytics", writer.snapshot)
+
+
+def record(coordinator, success, failed_compensations):
+    if writer is not None:
+        writer.record(coordinator, success, failed_compensations)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
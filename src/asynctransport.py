@@ -0,0 +1,265 @@
+"""
+The asyncio transport (see transport.py).
+
+Requests are handed from the calling threads to one event loop running in the
+background, which speaks HTTP/1.1 over asyncio streams and keeps idle keep-alive
+connections per origin. Calling threads only wait for their own response.
+"""
+import ssl
+import asyncio
+import settings
+import threading
+import collections
+from urllib.parse import urlsplit
+
+import pool
+import spool
+from transport import Transport, Response, Headers, Timeout, Decoder
+
+# Hop-by-hop headers the asyncio transport sets itself.
+FRAMING_HEADERS = ("content-length", "transfer-encoding", "connection")
+
+
+class Connection(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def usable(self):
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncioTransport(Transport):
+    name = "asyncio"
+
+    def __init__(self):
+        super().__init__()
+        self.loop = asyncio.new_event_loop()
+        self.idle = collections.defaultdict(list)
+        self.tls = ssl.create_default_context()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="qbox-transport", daemon=True
+        )
+        self.thread.start()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def request(self, method, url, headers=None, body=None, timeout=None):
+        return self.run(self.send(method, url, headers, body, timeout))
+
+    def warm(self, url, connections):
+        return self.run(self.open_idle(url, connections))
+
+    def close(self):
+        def close_all():
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
+            self.loop.stop()
+
+        self.loop.call_soon_threadsafe(close_all)
+
+    @staticmethod
+    def origin(url):
+        parts = urlsplit(url if "://" in url else f"http://{url}")
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == "https" else 80)
+        return scheme, parts.hostname, port
+
+    async def connect(self, origin, timeout):
+        scheme, host, port = origin
+        tls = self.tls if scheme == "https" else None
+        # Resolving may block on a lookup, which mustn't hold up the event loop.
+        address = await asyncio.get_running_loop().run_in_executor(
+            None, pool.dns_cache.resolve, host
+        )
+        opened = asyncio.open_connection(
+            address,
+            port,
+            ssl=tls,
+            server_hostname=host if tls else None,
+        )
+        try:
+            reader, writer = await asyncio.wait_for(opened, timeout)
+        except asyncio.TimeoutError:
+            raise Timeout(f"Connecting to {host}:{port} timed out")
+        return Connection(reader, writer)
+
+    async def open_idle(self, url, connections):
+        origin = self.origin(url)
+        connections = min(connections, settings.POOL_CONNECTIONS_PER_HOST)
+        idle = self.idle[origin]
+        idle[:] = [connection for connection in idle if connection.usable()]
+        while len(idle) < connections:
+            idle.append(await self.connect(origin, None))
+        return len(idle)
+
+    def checkout(self, origin):
+        idle = self.idle[origin]
+        while idle:
+            connection = idle.pop()
+            if connection.usable():
+                return connection
+            connection.close()
+        return None
+
+    def checkin(self, origin, connection):
+        idle = self.idle[origin]
+        if len(idle) < settings.POOL_CONNECTIONS_PER_HOST:
+            idle.append(connection)
+        else:
+            connection.close()
+
+    async def send(self, method, url, headers, body, timeout):
+        parts = urlsplit(url if "://" in url else f"http://{url}")
+        origin = self.origin(url)
+        target = parts.path or "/"
+        if parts.query:
+            target = f"{target}?{parts.query}"
+        proxy = self.proxies(parts.geturl())
+        if proxy:
+            # Proxies are sent the absolute url (RFC 9112, 3.2.2).
+            origin = self.origin(proxy)
+            target = f"http://{parts.netloc}{target}"
+
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        body = body or b""
+
+        outgoing = Headers(
+            (name, value)
+            for name, value in (headers or {}).items()
+            if name.lower() not in FRAMING_HEADERS
+        )
+        outgoing.setdefault("Host", parts.netloc)
+        if body or method not in ("GET", "HEAD"):
+            outgoing["Content-Length"] = str(len(body))
+
+        head = f"{method} {target} HTTP/1.1\r\n" + "".join(
+            f"{name}: {value}\r\n" for name, value in outgoing.items()
+        )
+        head = head.encode("latin-1") + b"\r\n"
+
+        # A pooled connection may have been closed by the other end while it sat idle,
+        # which we only find out by using it. Those get one retry on a new connection.
+        connection = self.checkout(origin)
+        while True:
+            reused = connection is not None
+            if not reused:
+                connection = await self.connect(origin, timeout)
+            try:
+                response, keep_alive = await asyncio.wait_for(
+                    self.exchange(connection, method, head, body), timeout
+                )
+            except asyncio.TimeoutError:
+                connection.close()
+                raise Timeout(f"{method} {url} timed out after {timeout}s")
+            except (ConnectionError, asyncio.IncompleteReadError):
+                connection.close()
+                if reused:
+                    connection = None
+                    continue
+                raise
+
+            if keep_alive:
+                self.checkin(origin, connection)
+            else:
+                connection.close()
+            return response
+
+    async def exchange(self, connection, method, head, body):
+        writer = connection.writer
+        if isinstance(body, spool.SpooledBody):
+            writer.write(head)
+            for chunk in body.chunks():
+                writer.write(chunk)
+                await writer.drain()
+        else:
+            writer.write(head + body)
+        await writer.drain()
+        reader = connection.reader
+
+        # Skip interim responses, e.g. 100 Continue.
+        while True:
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionResetError("Connection closed before a response")
+            version, status = status_line.split(None, 2)[:2]
+            status = int(status)
+
+            headers = Headers()
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers.add(name.strip(), value.strip())
+
+            if not 100 <= status < 200:
+                break
+
+        keep_alive = (
+            version == b"HTTP/1.1" and headers.get("Connection", "").lower() != "close"
+        )
+
+        if method == "HEAD" or status in (204, 304):
+            chunks = None
+        elif "chunked" in headers.get("Transfer-Encoding", "").lower():
+            chunks = self.read_chunked(reader)
+        elif "Content-Length" in headers:
+            chunks = self.read_length(reader, int(headers["Content-Length"]))
+        else:
+            chunks = self.read_length(reader, None)
+            keep_alive = False
+
+        spooler = spool.Spooler()
+        if chunks is not None:
+            decoder = Decoder(headers)
+            try:
+                async for chunk in chunks:
+                    spooler.write(decoder.decode(chunk))
+                spooler.write(decoder.flush())
+            except BaseException:
+                spooler.discard()
+                raise
+
+        return Response(status, headers, spooler.finish()), keep_alive
+
+    @staticmethod
+    async def read_length(reader, length):
+        """
+        The chunks of a body of `length` bytes, or up to EOF if `length` is None.
+        """
+
+        while length is None or length > 0:
+            size = spool.CHUNK_SIZE if length is None else min(spool.CHUNK_SIZE, length)
+            chunk = await reader.read(size)
+            if not chunk:
+                if length is None:
+                    return
+                raise asyncio.IncompleteReadError(b"", length)
+            if length is not None:
+                length -= len(chunk)
+            yield chunk
+
+    @staticmethod
+    async def read_chunked(reader):
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # Trailers, up to the final empty line.
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            while size > 0:
+                chunk = await reader.read(min(spool.CHUNK_SIZE, size))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", size)
+                size -= len(chunk)
+                yield chunk
+            await reader.readexactly(2)
@@ -0,0 +1,191 @@
+"""
+Micro-batching for saga transactions.
+
+A transaction in `onMatchedRequest` that carries a `batch` block is not sent on its
+own. Instead, every saga that reaches that transaction (same method, interpolated url
+and interpolated headers, other than Qbox's own `X-Qbox-*` ones) within `maxWaitMs`
+milliseconds joins a batch of at most `maxItems` items. The first saga to join becomes
+the leader: once the batch is full or the wait elapses, it sends a single downstream request whose body is a JSON array of the individual
+(already interpolated) bodies, in the order the sagas joined.
+
+If the downstream answers with a JSON array of the same length, the Nth element is
+handed back to the Nth saga as its response body. Any other answer is handed back to
+every saga whole. Each saga then checks `isSuccessIfReceives` and issues its own
+compensating transactions, exactly as it would have without batching.
+"""
+import json
+import time
+import threading
+import collections
+from interpolate import as_text, as_bytes
+from spool import SpooledBody
+
+BATCH_SIZE_HEADER = "X-Qbox-Batch-Size"
+
+# Headers can be different for every saga, e.g. credentials, so idle batchers are let go
+# of beyond this many.
+MAX_BATCHERS = 1024
+
+
+class Batch(object):
+    def __init__(self):
+        self.nodes = []
+        self.results = []
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    """
+    Collects concurrent submissions into batches and fans the results back out.
+    """
+
+    def __init__(self, max_items, max_wait_ms):
+        self.max_items = max_items
+        self.max_wait = max_wait_ms / 1000
+        self.condition = threading.Condition()
+        self.current = None
+
+    def submit(self, node, request):
+        """
+        Add `node` to the open batch (opening one if needed) and block until the batch
+        has been sent. `request` is called by the leader with the batched url, headers
+        and body, and should return a response or None if nothing came back.
+
+        Returns a (status, headers, body) tuple, or None if the batch got no response.
+        """
+
+        with self.condition:
+            batch = self.current
+            is_leader = batch is None
+            if is_leader:
+                batch = self.current = Batch()
+
+            index = len(batch.nodes)
+            batch.nodes.append(node)
+
+            if len(batch.nodes) >= self.max_items:
+                self.current = None
+                self.condition.notify_all()
+
+        if not is_leader:
+            batch.done.wait()
+            return batch.results[index]
+
+        deadline = time.monotonic() + self.max_wait
+        with self.condition:
+            while self.current is batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.current = None
+                    break
+                self.condition.wait(remaining)
+
+        try:
+            batch.results = self.flush(batch.nodes, request)
+        finally:
+            if len(batch.results) != len(batch.nodes):
+                batch.results = [None] * len(batch.nodes)
+            batch.done.set()
+
+        return batch.results[index]
+
+    def flush(self, nodes, request):
+        leader = nodes[0]
+
+        headers = dict(leader.headers)
+        headers["X-Qbox-TransactionID"] = ", ".join(
+            node.headers.get("X-Qbox-TransactionID", "") for node in nodes
+        )
+        headers[BATCH_SIZE_HEADER] = str(len(nodes))
+        headers.setdefault("Content-Type", "application/json")
+
+        body = json.dumps([as_json_item(node.body) for node in nodes]).encode("utf-8")
+
+        response = request(leader.url, headers, body)
+        if response is None:
+            return [None] * len(nodes)
+
+        bodies = split_response_body(response.content, len(nodes))
+        return [
+            (response.status_code, response.headers, item_body) for item_body in bodies
+        ]
+
+
+def parse(body):
+    """
+    A body parsed as JSON, raising ValueError if it isn't JSON. Bodies spooled to disk
+    are read into memory: batched bodies are bounded by QBOX_MAX_BODY_BYTES, and have
+    to be in memory to be joined or split anyway.
+    """
+
+    if isinstance(body, SpooledBody):
+        body = bytes(body)
+    try:
+        return json.loads(body)
+    except TypeError as e:
+        raise ValueError(str(e)) from e
+
+
+def as_json_item(body):
+    """
+    Bodies that are valid JSON are embedded as-is, anything else is embedded as a string.
+    """
+
+    if not body:
+        return None
+    try:
+        return parse(body)
+    except ValueError:
+        return as_text(body)
+
+
+def split_response_body(body, count):
+    try:
+        items = parse(body)
+    except ValueError:
+        return [body] * count
+
+    if not isinstance(items, list) or len(items) != count:
+        return [body] * count
+
+    return [
+        as_bytes(item) if isinstance(item, str) else json.dumps(item).encode("utf-8")
+        for item in items
+    ]
+
+
+_batchers = collections.OrderedDict()
+_batchers_lock = threading.Lock()
+
+
+def get_batcher(transaction, url, headers=None):
+    """
+    Batchers are shared process-wide so that sagas on different handler threads end
+    up in the same batch. Only sagas sending the same headers share one, since the
+    batch goes out with the leader's.
+    """
+
+    key = (
+        transaction["method"],
+        url,
+        transaction["batch"]["maxItems"],
+        transaction["batch"]["maxWaitMs"],
+        tuple(
+            sorted(
+                (name.lower(), value)
+                for name, value in (headers or {}).items()
+                if not name.lower().startswith("x-qbox-")
+            )
+        ),
+    )
+
+    with _batchers_lock:
+        if key not in _batchers:
+            _batchers[key] = MicroBatcher(
+                transaction["batch"]["maxItems"], transaction["batch"]["maxWaitMs"]
+            )
+            # A batch still open on an evicted batcher is sent by its leader as usual.
+            while len(_batchers) > MAX_BATCHERS:
+                _batchers.popitem(last=False)
+        _batchers.move_to_end(key)
+        return _batchers[key]
@@ -0,0 +1,387 @@
+"""
+Micro-benchmarks for Qbox's hot paths.
+
+    python3 benchmark.py router matching configuration transport coalescing analytics
+
+Each benchmark prints a small table of timings. They are meant for comparing a
+change against its baseline on the same machine, not as absolute numbers.
+"""
+import os
+import sys
+import time
+import yaml
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import configuration
+from router import Router
+
+
+def timed(function, iterations):
+    """
+    Returns the mean wall-clock time of `function` in microseconds.
+    """
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def benchmark_router(route_counts=(10, 1000, 10000, 100000), lookups=2000):
+    """
+    Route lookup cost for the trie router against the linear scan over exact urls
+    that it replaced, at increasing numbers of configured sagas.
+    """
+
+    print(f"{'routes':>8} {'build ms':>10} {'trie us':>10} {'linear us':>10}")
+
+    for count in route_counts:
+        templates = [f"http://svc{i % 50}.svc/resource{i}/{{id}}" for i in range(count)]
+        literals = [
+            (f"http://svc{i % 50}.svc/resource{i}/{i}", "GET") for i in range(count)
+        ]
+
+        start = time.perf_counter()
+        router = Router()
+        for index, template in enumerate(templates):
+            router.add(index, "GET", template)
+        build = (time.perf_counter() - start) * 1000
+
+        requests = [
+            f"http://svc{i % 50}.svc/resource{i}/{i}"
+            for i in random.sample(range(count), min(count, 100))
+        ]
+
+        def trie():
+            for url in requests:
+                router.match("GET", url)
+
+        def linear():
+            for url in requests:
+                for literal, method in literals:
+                    if literal == url and method == "GET":
+                        break
+
+        iterations = max(1, lookups // len(requests))
+        linear_iterations = max(1, iterations // max(1, count // 1000))
+
+        print(
+            f"{count:>8} {build:>10.1f} "
+            f"{timed(trie, iterations) / len(requests):>10.2f} "
+            f"{timed(linear, linear_iterations) / len(requests):>10.2f}"
+        )
+
+
+def benchmark_content_matching(saga_counts=(10, 100, 1000), lookups=2000):
+    """
+    Cost of checking the headers of a request against sagas that share a url and are
+    told apart by a header, with compiled content matches against the header-by-header
+    lookups on the request's `Message` they replaced.
+    """
+
+    from email.message import Message
+    from router import Inbound
+
+    print(f"{'sagas':>8} {'compiled us':>12} {'message us':>11}")
+
+    for count in saga_counts:
+        configurations = [
+            {
+                "matchRequest": {
+                    "method": "POST",
+                    "url": "http://orders.svc/orders",
+                    "headers": {"X-Tenant": f"tenant-{i}", "Content-Type": "json"},
+                }
+            }
+            for i in range(count)
+        ]
+        router = Router.from_configurations(configurations)
+
+        headers = Message()
+        for name in ("Host", "User-Agent", "Accept", "Content-Type", "Content-Length"):
+            headers[name] = "json" if name == "Content-Type" else "x"
+        headers["X-Tenant"] = f"tenant-{count - 1}"
+
+        def compiled():
+            inbound = Inbound(headers, b"")
+            for index in range(count):
+                router.matches_content(index, inbound)
+
+        def message():
+            for configuration in configurations:
+                expected = configuration["matchRequest"]["headers"]
+                any(headers.get(name) != value for name, value in expected.items())
+
+        iterations = max(1, lookups // count)
+        print(
+            f"{count:>8} {timed(compiled, iterations):>12.1f} "
+            f"{timed(message, iterations):>11.1f}"
+        )
+
+
+def saga_configuration(index):
+    return {
+        "host": f"svc{index}.svc",
+        "matchRequest": {
+            "method": "POST",
+            "url": f"http://svc{index}.svc/orders/{{id}}",
+            "headers": {"Start-Saga": "True"},
+        },
+        "onMatchedRequest": [
+            {
+                "method": "POST",
+                "url": f"http://step{step}.svc/orders/${{root.path.id}}",
+                "headers": {"Order": "${root.path.id}"},
+                "timeout": 3,
+                "maxRetriesOnTimeout": 2,
+                "isSuccessIfReceives": [{"status-code": 200}],
+                "onFailure": [
+                    {
+                        "method": "DELETE",
+                        "url": f"http://step{step}.svc/orders/${{root.path.id}}",
+                        "timeout": 3,
+                        "isSuccessIfReceives": [{"status-code": 200}],
+                    }
+                ],
+            }
+            for step in range(3)
+        ],
+        "onAllSucceeded": {"status-code": 200},
+        "onAnyFailed": {"status-code": 500},
+    }
+
+
+def benchmark_configuration(saga_counts=(1, 100, 5000)):
+    """
+    Time to load the configuration at startup: compiled from scratch with the pure
+    Python and the LibYAML loader, read back from the on-disk cache, and memoized.
+    """
+
+    print(
+        f"{'sagas':>6} {'python ms':>10} {'libyaml ms':>11} "
+        f"{'disk cache ms':>14} {'memoized ms':>12}"
+    )
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        for count in saga_counts:
+            text = yaml.dump_all([saga_configuration(i) for i in range(count)])
+
+            def compile_with(loader):
+                start = time.perf_counter()
+                configuration.compile_configuration(text, loader=loader)
+                return (time.perf_counter() - start) * 1000
+
+            python = compile_with(yaml.SafeLoader)
+            libyaml = compile_with(configuration.yaml_loader())
+
+            configuration._memoized.clear()
+            configuration.load_configuration(text, directory)
+            configuration._memoized.clear()
+            start = time.perf_counter()
+            configuration.load_configuration(text, directory)
+            disk = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            configuration.load_configuration(text, directory)
+            memoized = (time.perf_counter() - start) * 1000
+
+            print(
+                f"{count:>6} {python:>10.1f} {libyaml:>11.1f} "
+                f"{disk:>14.1f} {memoized:>12.2f}"
+            )
+    finally:
+        shutil.rmtree(directory)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Otherwise the body waits on the client's delayed ACK of the headers.
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+def benchmark_transport(requests_per_backend=2000, concurrency=(1, 16)):
+    """
+    Throughput and latency of each transport backend against a local keep-alive stub
+    server, sending small POSTs from a number of threads at once. The stub server is
+    the same for every backend, so compare the rows rather than the absolute numbers.
+    """
+
+    import transport
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/orders"
+
+    print(f"{'backend':>9} {'threads':>8} {'req/s':>9} {'p50 us':>9} {'p99 us':>9}")
+
+    try:
+        for name in sorted(transport.BACKENDS):
+            backend = transport.create(name)
+            for threads in concurrency:
+                backend.request("POST", url, body=b"{}", timeout=5)
+                latencies = []
+                per_thread = requests_per_backend // threads
+
+                def send():
+                    for _ in range(per_thread):
+                        start = time.perf_counter()
+                        backend.request("POST", url, body=b"{}", timeout=5)
+                        latencies.append(time.perf_counter() - start)
+
+                workers = [threading.Thread(target=send) for _ in range(threads)]
+                start = time.perf_counter()
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                elapsed = time.perf_counter() - start
+
+                latencies.sort()
+                print(
+                    f"{name:>9} {threads:>8} {len(latencies) / elapsed:>9.0f} "
+                    f"{latencies[len(latencies) // 2] * 1e6:>9.0f} "
+                    f"{latencies[int(len(latencies) * 0.99)] * 1e6:>9.0f}"
+                )
+            backend.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def benchmark_coalescing(clients=(1, 16, 64), rounds=20, upstream_seconds=0.005):
+    """
+    Upstream requests made for bursts of identical concurrent GETs through the
+    pass-through coalescer, against an upstream taking a few milliseconds to answer.
+    """
+
+    import coalesce
+    from transport import Response, Headers
+
+    print(f"{'clients':>8} {'cache':>6} {'requests':>9} {'upstream':>9} {'saved':>7}")
+
+    for cache_seconds in (0, 1):
+        for count in clients:
+            coalescer = coalesce.Coalescer(
+                ["foo.svc"], ["Authorization"], cache_seconds
+            )
+            headers = Headers([("Host", "foo.svc")])
+            upstream = Headers([("Cache-Control", "max-age=60")])
+
+            def send():
+                time.sleep(upstream_seconds)
+                return Response(200, upstream, b"ok")
+
+            def client():
+                coalescer.fetch("GET", "http://foo.svc/items", headers, b"", send)
+
+            for _ in range(rounds):
+                workers = [threading.Thread(target=client) for _ in range(count)]
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+
+            total = count * rounds
+            made = coalescer.snapshot()["upstream"]
+            print(
+                f"{count:>8} {cache_seconds:>6} {total:>9} {made:>9} "
+                f"{1 - made / total:>7.1%}"
+            )
+
+
+def benchmark_analytics(saga_counts=(100000, 1000000), steps_per_saga=3):
+    """
+    Loading and querying analytics files holding that many sagas (and three steps for
+    each), written in segments as the writer would.
+    """
+
+    import array
+    import analytics
+
+    print(f"{'sagas':>9} {'MB':>6} {'load s':>7} {'sagas s':>8} {'steps s':>8}")
+
+    for count in saga_counts:
+        directory = tempfile.mkdtemp()
+        try:
+            writer = analytics.AnalyticsWriter(directory)
+            segment = analytics.SEGMENT_ROWS
+            now = time.time()
+            for offset in range(0, count, segment):
+                rows = min(segment, count - offset)
+                for name, per_saga in (("sagas", 1), ("steps", steps_per_saga)):
+                    table = analytics.Table(name)
+                    total = rows * per_saga
+                    for column, code in analytics.TABLES[name]:
+                        if column == "finished":
+                            values = [now] * total
+                        elif code in "fd":
+                            values = [random.expovariate(0.02) for _ in range(total)]
+                        else:
+                            values = [random.random() < 0.95 for _ in range(total)]
+                        table.columns[column] = array.array(code, values)
+                    for column in table.strings:
+                        table.strings[column] = {"POST http://orders.svc/": 0, "ok": 1}
+                    with writer.write_lock:
+                        writer.current_file().write(table.segment())
+            writer.close()
+            size = sum(os.path.getsize(path) for path in analytics.files(directory))
+
+            start = time.perf_counter()
+            tables = analytics.load(directory)
+            loaded = time.perf_counter()
+            analytics.saga_summary(tables)
+            summarized = time.perf_counter()
+            analytics.step_summary(tables)
+            analytics.failure_breakdown(tables)
+            done = time.perf_counter()
+
+            print(
+                f"{count:>9} {size / 1e6:>6.1f} {loaded - start:>7.2f} "
+                f"{summarized - loaded:>8.2f} {done - summarized:>8.2f}"
+            )
+        finally:
+            shutil.rmtree(directory)
+
+
+BENCHMARKS = {
+    "router": benchmark_router,
+    "matching": benchmark_content_matching,
+    "configuration": benchmark_configuration,
+    "transport": benchmark_transport,
+    "coalescing": benchmark_coalescing,
+    "analytics": benchmark_analytics,
+}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run Qbox micro-benchmarks.")
+    parser.add_argument(
+        "benchmarks", nargs="*", choices=sorted(BENCHMARKS), default=sorted(BENCHMARKS)
+    )
+    args = parser.parse_args(argv)
+
+    for name in args.benchmarks:
+        print(f"== {name}")
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
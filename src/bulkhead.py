@@ -0,0 +1,216 @@
+"""
+Bulkheads isolating saga configurations from each other.
+
+A saga configuration with a `bulkhead` block gets its own pool of resources, shared by
+every configuration with the same `host` (or the same bulkhead `name`, to group routes
+differently). A downstream that stops answering then only ties up the sagas in its
+bulkhead, instead of every thread and connection in the process.
+
+Each bulkhead limits:
+
+  - the sagas running at once (`maxConcurrentSagas`). Sagas beyond that wait in a queue
+    of `maxQueuedSagas` slots for up to `queueTimeout` seconds, and are answered with a
+    503 if the queue is full or the wait runs out.
+  - the requests its sagas have outstanding downstream (`maxConnections`). A forward
+    transaction that can't get a connection within its timeout counts as having timed
+    out. Compensations wait for as long as it takes, and go before forward
+    transactions waiting for one.
+
+Limits are reapplied whenever a configuration references the bulkhead, so the last
+configuration loaded wins if several sharing one disagree. Counts for every bulkhead
+are exposed under `bulkheads` on the admin metrics endpoint.
+"""
+import time
+import threading
+import contextlib
+
+import metrics
+
+QUEUE_TIMEOUT_SECONDS = 1.0
+
+
+class BulkheadFull(Exception):
+    pass
+
+
+class Bulkhead(object):
+    def __init__(self, name, configuration, clock=time.monotonic):
+        self.name = name
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.configuration = None
+        self.running = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.connections = 0
+        self.waiting_compensations = 0
+        self.waiting_connections = 0
+        self.connection_timeouts = 0
+        self.configure(configuration)
+
+    def configure(self, configuration):
+        if configuration == self.configuration:
+            return
+
+        with self.condition:
+            self.max_sagas = configuration.get("maxConcurrentSagas")
+            self.max_queued = configuration.get("maxQueuedSagas", 0)
+            self.queue_timeout = configuration.get(
+                "queueTimeout", QUEUE_TIMEOUT_SECONDS
+            )
+            self.max_connections = configuration.get("maxConnections")
+            self.configuration = configuration
+            self.condition.notify_all()
+
+    def has_room(self):
+        return self.max_sagas is None or self.running < self.max_sagas
+
+    def enter(self):
+        """
+        Take a saga slot, queueing for one if need be. Returns False if the saga
+        should be turned away.
+        """
+
+        with self.condition:
+            if not self.has_room():
+                if self.queued >= self.max_queued:
+                    self.rejected += 1
+                    return False
+
+                self.queued += 1
+                try:
+                    if not self.wait_for(self.has_room, self.queue_timeout):
+                        self.rejected += 1
+                        return False
+                finally:
+                    self.queued -= 1
+
+            self.running += 1
+            self.admitted += 1
+            return True
+
+    def leave(self):
+        with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def saga(self):
+        """
+        Hold a saga slot for the duration of the block. Raises BulkheadFull if none
+        could be had.
+        """
+
+        if not self.enter():
+            raise BulkheadFull(f"Too many sagas running for {self.name}")
+        try:
+            yield
+        finally:
+            self.leave()
+
+    def connect(self, compensation=False, timeout=None):
+        """
+        Take a connection slot for a downstream request. Returns False if none became
+        free within `timeout` seconds (None waits indefinitely).
+        """
+
+        def free():
+            if self.max_connections is not None:
+                if self.connections >= self.max_connections:
+                    return False
+            return compensation or not self.waiting_compensations
+
+        with self.condition:
+            self.waiting_connections += 1
+            if compensation:
+                self.waiting_compensations += 1
+            try:
+                if not self.wait_for(free, timeout):
+                    self.connection_timeouts += 1
+                    return False
+                self.connections += 1
+                return True
+            finally:
+                self.waiting_connections -= 1
+                if compensation:
+                    self.waiting_compensations -= 1
+                    # Forward requests yield to waiting compensations, see `free`.
+                    self.condition.notify_all()
+
+    def disconnect(self):
+        with self.condition:
+            self.connections -= 1
+            self.condition.notify_all()
+
+    def wait_for(self, predicate, timeout):
+        """
+        Condition.wait_for, on our clock. Must be called holding the condition.
+        """
+
+        deadline = None if timeout is None else self.clock() + timeout
+        while not predicate():
+            if deadline is None:
+                self.condition.wait()
+                continue
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                return False
+            self.condition.wait(remaining)
+        return True
+
+    def snapshot(self):
+        with self.condition:
+            return {
+                "running": self.running,
+                "queued": self.queued,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "connections": self.connections,
+                "waitingConnections": self.waiting_connections,
+                "connectionTimeouts": self.connection_timeouts,
+            }
+
+
+_bulkheads = {}
+_bulkheads_lock = threading.Lock()
+
+
+def bulkhead_for(configuration):
+    """
+    Returns the bulkhead of a saga configuration, creating or updating it from the
+    configuration's `bulkhead` block. Returns None if the saga isn't isolated.
+    """
+
+    block = configuration.get("bulkhead")
+    if block is None:
+        return None
+    name = block.get("name", configuration.get("host"))
+
+    with _bulkheads_lock:
+        bulkhead = _bulkheads.get(name)
+        if bulkhead is None:
+            bulkhead = _bulkheads[name] = Bulkhead(name, block)
+            return bulkhead
+
+    bulkhead.configure(block)
+    return bulkhead
+
+
+def admitted(configuration):
+    """
+    A context manager holding a saga slot in the configuration's bulkhead, if it has
+    one. Raises BulkheadFull if the saga should be turned away.
+    """
+
+    bulkhead = bulkhead_for(configuration)
+    return contextlib.nullcontext() if bulkhead is None else bulkhead.saga()
+
+
+def snapshot():
+    with _bulkheads_lock:
+        bulkheads = dict(_bulkheads)
+    return {name: bulkhead.snapshot() for name, bulkhead in bulkheads.items()}
+
+
+metrics.register("bulkheads", snapshot)
@@ -0,0 +1,163 @@
+"""
+Traffic capture for offline replay.
+
+When `QBOX_CAPTURE_PATH` is set, a sampled fraction of the requests reaching the
+sidecar are appended to that file, along with every downstream response received
+while handling them (by the saga coordinator or the pass-through path). replay.py
+reads the file back to serve those responses from a stub and replay the inbound
+traffic at its original pace.
+
+The file is append-only. It starts with a magic string, followed by records of
+
+    kind (1 byte) | unix timestamp (8 byte double) | payload length (4 bytes) | payload
+
+where the payload is a sequence of length-prefixed byte strings:
+
+    INBOUND:    capture id, method, path, headers, body
+    DOWNSTREAM: capture id, method, url, status code, headers, body
+
+Headers are stored in wire format ("Name: value\r\n" lines). All integers are
+big-endian.
+"""
+import os
+import time
+import uuid
+import random
+import struct
+import threading
+import collections
+
+import spool
+import settings
+
+MAGIC = b"QBOXCAP1"
+INBOUND = 1
+DOWNSTREAM = 2
+
+RECORD_HEADER = struct.Struct("!BdI")
+FIELD_LENGTH = struct.Struct("!I")
+
+Record = collections.namedtuple("Record", ["kind", "timestamp", "fields"])
+
+
+def encode_headers(headers):
+    return "".join(f"{name}: {value}\r\n" for name, value in headers.items()).encode(
+        "latin-1", "replace"
+    )
+
+
+def decode_headers(raw):
+    headers = []
+    for line in raw.decode("latin-1").split("\r\n"):
+        if line:
+            name, _, value = line.partition(": ")
+            headers.append((name, value))
+    return headers
+
+
+def to_bytes(value):
+    if value is None:
+        return b""
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value)
+    if isinstance(value, spool.SpooledBody):
+        # Written out a chunk at a time, see CaptureWriter.write.
+        return value
+    return str(value).encode("utf-8")
+
+
+class CaptureWriter(object):
+    def __init__(self, path, sample_rate=1.0):
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, "ab")
+        if is_new:
+            self.file.write(MAGIC)
+            self.file.flush()
+
+    def record_inbound(self, method, path, headers, body):
+        """
+        Record an inbound request if it is sampled. Returns the capture id that its
+        downstream responses should be recorded under, or None if it wasn't sampled.
+        """
+
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return None
+
+        capture_id = uuid.uuid4().hex
+        self.write(INBOUND, [capture_id, method, path, encode_headers(headers), body])
+        return capture_id
+
+    def record_downstream(self, capture_id, method, url, status, headers, body):
+        self.write(
+            DOWNSTREAM,
+            [capture_id, method, url, status, encode_headers(headers), body],
+        )
+
+    def write(self, kind, fields):
+        fields = [to_bytes(field) for field in fields]
+        length = sum(FIELD_LENGTH.size + len(field) for field in fields)
+
+        with self.lock:
+            self.file.write(RECORD_HEADER.pack(kind, time.time(), length))
+            for field in fields:
+                self.file.write(FIELD_LENGTH.pack(len(field)))
+                spool.write(self.file, field)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_records(path):
+    with open(path, "rb") as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a Qbox capture file")
+
+        while True:
+            header = capture.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+
+            kind, timestamp, length = RECORD_HEADER.unpack(header)
+            payload = capture.read(length)
+            if len(payload) < length:
+                # A partially written trailing record, e.g. from a crash mid-write.
+                return
+
+            fields = []
+            offset = 0
+            while offset < length:
+                (size,) = FIELD_LENGTH.unpack_from(payload, offset)
+                offset += FIELD_LENGTH.size
+                fields.append(payload[offset : offset + size])
+                offset += size
+
+            yield Record(kind, timestamp, fields)
+
+
+writer = None
+if settings.CAPTURE_PATH:
+    writer = CaptureWriter(settings.CAPTURE_PATH, settings.CAPTURE_SAMPLE_RATE)
+
+
+def record_inbound(method, path, headers, body):
+    if writer is None:
+        return None
+    return writer.record_inbound(method, path, headers, body)
+
+
+def record_downstream(capture_id, method, url, response):
+    if writer is None or capture_id is None:
+        return
+    writer.record_downstream(
+        capture_id,
+        method,
+        url,
+        response.status_code,
+        response.headers,
+        response.content,
+    )
@@ -0,0 +1,229 @@
+"""
+Coalescing of identical requests on the pass-through path.
+
+Under fan-in, many clients ask a host for the same thing at once. For hosts listed in
+QBOX_COALESCE_HOSTS, concurrent GET and HEAD requests with the same url that agree on
+the QBOX_COALESCE_VARY_HEADERS share a single upstream request: the first one is sent,
+and the others wait for and are answered with its response (or its error). Headers
+outside the vary set, e.g. tracing ids, are only sent upstream for the first request.
+
+With QBOX_RESPONSE_CACHE_SECONDS set, responses are also cached for as long as their
+Cache-Control allows, up to that many seconds. Responses marked no-store, no-cache or
+private, setting cookies, or varying on `*` or a header outside the vary set (which
+could hand them to clients they weren't meant for) are never cached, and neither are
+bodies spooled to disk. Requests with Cache-Control no-cache, no-store or max-age=0
+skip the cache but are still coalesced.
+
+Counts of upstream requests, coalesced requests and cache hits are exposed under
+`coalescing` on the admin metrics endpoint.
+"""
+import time
+import threading
+import collections
+
+import spool
+import metrics
+import settings
+
+METHODS = ("GET", "HEAD")
+MAX_CACHE_ENTRIES = 1024
+
+
+class Call(object):
+    """
+    An upstream request in flight, that identical requests wait on.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+def directives(value):
+    """
+    The directives of a Cache-Control header, as a dict of lowercased names to their
+    argument (or None).
+    """
+
+    parsed = {}
+    for directive in (value or "").split(","):
+        name, _, argument = directive.strip().partition("=")
+        if name:
+            parsed[name.lower()] = argument.strip('"') or None
+    return parsed
+
+
+def freshness(headers):
+    """
+    How many seconds a response with `headers` may be served from a shared cache for,
+    or None if it may not be cached.
+    """
+
+    control = directives(headers.get("Cache-Control"))
+    if {"no-store", "no-cache", "private"} & control.keys():
+        return None
+    if "Set-Cookie" in headers or headers.get("Vary", "").strip() == "*":
+        return None
+
+    max_age = control.get("s-maxage") or control.get("max-age")
+    try:
+        seconds = int(max_age) - int(headers.get("Age", 0))
+    except (TypeError, ValueError):
+        return None
+    return seconds if seconds > 0 else None
+
+
+def bypasses_cache(headers):
+    control = directives(headers.get("Cache-Control"))
+    return (
+        bool({"no-store", "no-cache"} & control.keys()) or control.get("max-age") == "0"
+    )
+
+
+class Coalescer(object):
+    def __init__(
+        self,
+        hosts,
+        vary_headers,
+        cache_seconds=0,
+        max_entries=MAX_CACHE_ENTRIES,
+        clock=time.monotonic,
+    ):
+        self.hosts = {host.lower() for host in hosts}
+        self.vary_headers = tuple(vary_headers)
+        self.keyed_headers = {name.lower() for name in self.vary_headers}
+        self.cache_seconds = cache_seconds
+        self.max_entries = max_entries
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.cache = collections.OrderedDict()
+        self.upstream = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+
+    def applies_to(self, method, host, body):
+        if method not in METHODS or body or not self.hosts:
+            return False
+        return "*" in self.hosts or (host or "").lower() in self.hosts
+
+    def key(self, method, url, headers):
+        return (method, url) + tuple(headers.get(name) for name in self.vary_headers)
+
+    def fetch(self, method, url, headers, body, send):
+        """
+        The response to a pass-through request, from `send()` unless an identical
+        request is already in flight or a fresh response to one is cached.
+        """
+
+        if not self.applies_to(method, headers.get("Host"), body):
+            return send()
+
+        key = self.key(method, url, headers)
+        use_cache = self.cache_seconds > 0 and not bypasses_cache(headers)
+
+        with self.lock:
+            if use_cache:
+                response = self.cached(key)
+                if response is not None:
+                    self.cache_hits += 1
+                    return response
+
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+                self.upstream += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.response
+
+        try:
+            call.response = send()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+                if call.response is not None and use_cache:
+                    self.store(key, call.response)
+            call.done.set()
+        return call.response
+
+    def cached(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        expires, response = entry
+        if expires <= self.clock():
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return response
+
+    def is_keyed(self, headers):
+        """
+        Whether every request header a response varies on is part of its cache key.
+        """
+
+        varies = {name.strip().lower() for name in headers.get("Vary", "").split(",")}
+        return varies - {""} <= self.keyed_headers
+
+    def store(self, key, response):
+        if isinstance(response.content, spool.SpooledBody):
+            return
+        if not self.is_keyed(response.headers):
+            return
+        seconds = freshness(response.headers)
+        if seconds is None:
+            return
+
+        self.cache[key] = (self.clock() + min(seconds, self.cache_seconds), response)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "upstream": self.upstream,
+                "coalesced": self.coalesced,
+                "cacheHits": self.cache_hits,
+                "inFlight": len(self.calls),
+                "cached": len(self.cache),
+            }
+
+
+def split(value):
+    return [item.strip() for item in (value or "").split(",") if item.strip()]
+
+
+_coalescer = None
+_coalescer_lock = threading.Lock()
+
+
+def get():
+    """
+    The process-wide coalescer for the pass-through path.
+    """
+
+    global _coalescer
+
+    with _coalescer_lock:
+        if _coalescer is None:
+            _coalescer = Coalescer(
+                split(settings.COALESCE_HOSTS),
+                split(settings.COALESCE_VARY_HEADERS),
+                settings.RESPONSE_CACHE_SECONDS,
+            )
+        return _coalescer
+
+
+metrics.register("coalescing", lambda: get().snapshot())
@@ -1,101 +1,124 @@
-""" 
-This file defines the structure of the configuration Qbox uses. 
-
-We perform schema validation for the entire configuration. This is 
-basically the power of protobufs without needing to use protobufs. We
-use the schema library (https://github.com/keleshev/schema) for this.
+"""
+Loading of the configuration Qbox uses.
 
-See configuration_test.py for example configurations.
+The structure of the configuration is defined (and validated) in schemas.py. This
+module turns the mounted configuration file into the compiled form request handling
+uses, and caches it. Parsing and validation only happen when a configuration is
+seen for the first time, so neither PyYAML nor the schema library is imported
+unless they are actually needed.
 """
-import re
 import os
-import yaml
-from interpolate import interpolate
-from schema import Schema, And, Or, Optional, Const
+import pickle
+import hashlib
+import logging
+import pool
+import settings
+import tempfile
+import threading
+import collections
+from router import Router
+from interpolate import compile_templates
+from predicates import compile_predicates
 
 CONFIGURATION_PATH = "configuration/config.yaml"
 
-# All messages need to have a source address and a destination address.
-# These addresses should resolve using cluster DNS.
-# Messages may optionally include a list of headers as string key/value pairs.
-# and an optional body. How these headers and bodies are included in new values
-# is dependent on where the message is defined in the schema - `matchRequest` messages
-# have different behaviour than `onFailue` messages.
-HTTP_REQUEST_SCHEMA = Schema(
-    {
-        "method": lambda t: t in ["GET", "HEAD", "PUT", "PATCH", "DELETE", "POST"],
-        "url": str,
-        Optional("headers"): Schema(Or({str: str}, {})),
-        Optional("body"): str,
-    },
-    ignore_extra_keys=True,
-)
-
-HTTP_RESPONSE_SCHEMA = Schema(
-    {
-        "status-code": int,
-        Optional("headers"): Schema(Or({str: str}, {})),
-        Optional("body"): str,
-    },
-    ignore_extra_keys=True,
-)
-
-# Some messages are part of a transaction. Such transactions need to specify a timeout,
-# a number of times to retry on a timeout, and a compensating transaction (marked in "onFailure").
-#
-# Messages in `onFailure` will always inherit headers/bodies from their parent message - if headers
-# and bodies are specified under `onFailure`, then headers will be upserted and bodies will be
-# overwritten.
-#
-# Messages in `matchSuccessRequest` are what responses are compared to to mark the transaction
-# as succeeded. Any response that does not match that criteria is automatic grounds for the
-# transaction as a whole to fail.
-
-COMPENSATING_TRANSACTION_SCHEMA = And(
-    Const(
-        HTTP_REQUEST_SCHEMA,
-        Schema(
-            {
-                "timeout": And(int, lambda timeout: timeout >= 0),
-                Optional("maxRetriesOnTimeout"): And(
-                    int, lambda maxRetries: maxRetries >= 0
-                ),
-                "isSuccessIfReceives": Schema([HTTP_RESPONSE_SCHEMA]),
-            },
-            ignore_extra_keys=True,
-        ),
-    ),
-)
-
-TRANSACTION_SCHEMA = And(
-    Const(
-        HTTP_REQUEST_SCHEMA,
-        Schema(
-            {
-                "timeout": And(int, lambda timeout: timeout >= 0),
-                Optional("maxRetriesOnTimeout"): And(
-                    int, lambda maxRetries: maxRetries >= 0
-                ),
-                "onFailure": Schema([COMPENSATING_TRANSACTION_SCHEMA]),
-                "isSuccessIfReceives": Schema([HTTP_RESPONSE_SCHEMA]),
-            },
-            ignore_extra_keys=True,
-        ),
-    ),
-)
-
-# The root of our configuration. The list of headers, bodies, etc. supplied in `matchRequest`
-# will be used to match the request to initiate the saga workflow.
-ROOT_SCHEMA = Schema(
-    {
-        "host": str,
-        "matchRequest": HTTP_REQUEST_SCHEMA,
-        "onMatchedRequest": Schema([TRANSACTION_SCHEMA]),
-        Optional("onAllSucceeded"): HTTP_RESPONSE_SCHEMA,
-        Optional("onAnyFailed"): HTTP_RESPONSE_SCHEMA,
-    },
-    ignore_extra_keys=True,
-)
+# Compiled configurations are cached by a hash of the configuration file, in memory
+# and (if QBOX_CONFIGURATION_CACHE_DIR is set) on disk, so that reloads and restarts
+# with an unchanged file skip parsing and validation. Bump the version whenever the
+# compiled form changes so that stale artifacts are ignored.
+COMPILED_FORMAT_VERSION = 6
+MEMOIZED_CONFIGURATIONS = 4
+
+
+def yaml_loader():
+    """
+    The C (LibYAML) loader is several times faster on large configurations. Fall back
+    to the pure Python one on builds of PyYAML without it.
+    """
+
+    import yaml
+
+    return getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+class CompiledConfiguration(object):
+    """
+    Everything derived from the configuration file that request handling needs: the
+    validated saga configurations, the router over their `matchRequest` urls and the
+    downstream hosts their transactions talk to.
+    """
+
+    def __init__(self, config, router, hosts=()):
+        self.config = config
+        self.router = router
+        self.hosts = list(hosts)
+
+
+def compile_configuration(text, loader=None):
+    import yaml
+    from schemas import CONFIGURATIONS_SCHEMA
+
+    documents = yaml.load_all(text, Loader=loader or yaml_loader())
+    config = CONFIGURATIONS_SCHEMA.validate(list(documents))
+    compile_templates(config)
+    compile_predicates(config)
+    return CompiledConfiguration(
+        config, Router.from_configurations(config), pool.downstream_hosts(config)
+    )
+
+
+_memoized = collections.OrderedDict()
+_memoized_lock = threading.Lock()
+
+
+def load_configuration(text, cache_directory=None):
+    digest = hashlib.sha256(
+        f"{COMPILED_FORMAT_VERSION}:{text}".encode("utf-8", "surrogateescape")
+    ).hexdigest()
+
+    with _memoized_lock:
+        if digest in _memoized:
+            _memoized.move_to_end(digest)
+            return _memoized[digest]
+
+    compiled = None
+    if cache_directory:
+        compiled = read_cached_configuration(cache_directory, digest)
+    if compiled is None:
+        compiled = compile_configuration(text)
+        if cache_directory:
+            write_cached_configuration(cache_directory, digest, compiled)
+
+    with _memoized_lock:
+        _memoized[digest] = compiled
+        while len(_memoized) > MEMOIZED_CONFIGURATIONS:
+            _memoized.popitem(last=False)
+
+    return compiled
+
+
+def read_cached_configuration(cache_directory, digest):
+    path = os.path.join(cache_directory, f"{digest}.pickle")
+    try:
+        with open(path, "rb") as cached:
+            return pickle.load(cached)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # The cache is only ever an optimization - recompile on anything unexpected.
+        logging.warning(f"Ignoring unreadable cached configuration {path}: {e}")
+        return None
+
+
+def write_cached_configuration(cache_directory, digest, compiled):
+    try:
+        os.makedirs(cache_directory, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=cache_directory)
+        with os.fdopen(descriptor, "wb") as cached:
+            pickle.dump(compiled, cached, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, os.path.join(cache_directory, f"{digest}.pickle"))
+    except OSError as e:
+        logging.warning(f"Could not cache compiled configuration: {e}")
 
 
 class ConfigurationStore(object):
@@ -104,14 +127,26 @@ class ConfigurationStore(object):
     The directory mounting in production is handled by Kubernetes ConfigMaps. 
     """
 
-    def __init__(self):
+    def __init__(self, path=None, cache_directory=None):
 
-        self.config = []
+        path = path or CONFIGURATION_PATH
+        cache_directory = cache_directory or settings.CONFIGURATION_CACHE_DIR
 
-        if os.path.exists(CONFIGURATION_PATH):
-            with open(CONFIGURATION_PATH) as config:
-                for c in yaml.safe_load_all(config):
-                    self.config.append(ROOT_SCHEMA.validate(c))
+        compiled = CompiledConfiguration([], Router())
+
+        if os.path.exists(path):
+            with open(path) as config:
+                compiled = load_configuration(config.read(), cache_directory)
+
+        self.config = compiled.config
+        self.router = compiled.router
+        self.hosts = compiled.hosts
 
     def get_config(self):
         return self.config
+
+    def get_router(self):
+        return self.router
+
+    def get_hosts(self):
+        return self.hosts
@@ -1,9 +1,24 @@
 import re
+import json
+import time
 import uuid
-import requests
+import capture
+import analytics
+import latency
+import ratelimit
+import bulkhead
+import transport
+import events
+import leases
+import settings
+import statestore
 import itertools
-from interpolate import interpolate
-from requests.exceptions import Timeout
+from functools import partial
+from interpolate import interpolate, as_bytes, SagaContext
+from batching import get_batcher
+from predicates import compile_predicate
+from spool import SpooledBody
+from outbox import outbox
 import random
 
 # TODO: Make this configurable
@@ -14,13 +29,24 @@ class RequestNode(object):
     def __init__(self):
         self.url = None
         self.headers = {}
-        self.body = ""
+        self.body = b""
         self.children = []
         self.parent = None
         self.response_status = None
         self.response_headers = {}
-        self.response_body = ""
+        self.response_body = b""
         self.configuration = {}
+        self.path_parameters = {}
+        # Positions in `onFailure` of the compensations that have been issued.
+        self.compensated = set()
+        # The transaction's position in `onMatchedRequest` (for compensations, that of
+        # the transaction they compensate).
+        self.step = None
+        # How many times the request was sent, and how long it took in seconds.
+        self.attempts = 0
+        self.elapsed = None
+        # Bodies parsed as JSON for interpolation, so each is parsed at most once.
+        self.parsed_bodies = {}
 
     def add_parent(self, parent):
         parent.children.append(self)
@@ -34,6 +60,7 @@ class RequestNode(object):
 
         if "body" in kwargs:
             self.body = kwargs["body"]
+            self.parsed_bodies.pop("request", None)
 
     def update_response(self, **kwargs):
         if "headers" in kwargs:
@@ -41,6 +68,7 @@ class RequestNode(object):
 
         if "body" in kwargs:
             self.response_body = kwargs["body"]
+            self.parsed_bodies.pop("response", None)
 
         if "status" in kwargs:
             self.response_status = kwargs["status"]
@@ -48,6 +76,54 @@ class RequestNode(object):
     def update_configuration(self, configuration={}):
         self.configuration = configuration
 
+    def json_body(self, response=False):
+        """
+        The request (or response) body parsed as JSON, or None if it isn't JSON.
+        """
+
+        key = "response" if response else "request"
+        if key not in self.parsed_bodies:
+            body = self.response_body if response else self.body
+            # Parsing would mean reading a body that was spooled to disk into memory.
+            if isinstance(body, SpooledBody):
+                return None
+            try:
+                self.parsed_bodies[key] = json.loads(body) if body else None
+            except ValueError:
+                self.parsed_bodies[key] = None
+        return self.parsed_bodies[key]
+
+    def to_state(self):
+        return {
+            "url": self.url,
+            "headers": dict(self.headers),
+            "body": self.body,
+            "responseStatus": self.response_status,
+            "responseHeaders": dict(self.response_headers),
+            "responseBody": self.response_body,
+            "configuration": self.configuration,
+            "compensated": sorted(self.compensated),
+            "step": self.step,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        node = cls()
+        node.update_configuration(state["configuration"])
+        node.update_request(
+            url=state["url"],
+            headers=state["headers"],
+            body=as_bytes(state["body"] or ""),
+        )
+        node.update_response(
+            status=state["responseStatus"],
+            headers=state["responseHeaders"],
+            body=as_bytes(state["responseBody"] or ""),
+        )
+        node.compensated = set(state["compensated"])
+        node.step = state.get("step")
+        return node
+
 
 class SagaCoordinator(object):
     """
@@ -55,18 +131,59 @@ class SagaCoordinator(object):
     if one of them fails.
     """
 
-    def __init__(self, configuration, start_request_headers={}, start_request_body=""):
+    # Whether transactions with a `batch` block join process-wide micro-batches.
+    batching = True
+
+    # Whether the saga's progress is written to the state store.
+    persistent = True
+
+    # Whether the saga's progress is published on the event bus.
+    observable = True
+
+    # Whether the saga's outcome is recorded for analytics.
+    analyzed = True
+
+    # Whether a failed saga may leave its compensations to the outbox (see outbox.py).
+    outboxed = True
+
+    # How many times a compensation without `maxRetriesOnTimeout` is sent before it
+    # counts as failed. None keeps sending it until it gets a response.
+    compensation_attempts = None
+
+    def __init__(
+        self,
+        configuration,
+        start_request_headers={},
+        start_request_body=b"",
+        path_parameters={},
+        capture_id=None,
+        store=None,
+    ):
         self.configuration = configuration
+        self.capture_id = capture_id
+        self.store = statestore.store if store is None else store
+        # The lease held on the saga when it was taken over from another replica.
+        self.lease = None
         self.identifier = str(uuid.uuid4())
         self.root = RequestNode()
         self.root.update_configuration(self.configuration.get("matchRequest", {}))
         self.root.update_request(headers=start_request_headers, body=start_request_body)
+        self.root.path_parameters = path_parameters
+        self.context = SagaContext(self.root)
+        self.started = time.monotonic()
+        # Every transaction and compensation sent, as (kind, node, succeeded).
+        self.history = []
+        self.attempts = 0
+        self.skipped = 0
+        self.exited_early = False
+        self.bulkhead = bulkhead.bulkhead_for(configuration)
 
     def execute_saga(self):
         """
         Perform a serial unicast over the set of transactions. If any of them
         fail, halt sending out more transactions, and issue compensating transactions
-        for all of the transactions sent out so far.
+        for all of the transactions sent out so far. Transactions whose `when` doesn't
+        hold are skipped, and one whose `exitWhen` holds ends the saga early.
 
         Returns:
             - `success`: Bool -> Whether all of the transactions succeeded without 
@@ -89,40 +206,180 @@ class SagaCoordinator(object):
         """
 
         transactions = self.configuration["onMatchedRequest"]
+        self.record(statestore.RUNNING)
+        self.publish("started", url=self.root.configuration.get("url"))
+
+        for step, transaction in enumerate(transactions):
+            if not self.holds(transaction, "when"):
+                self.context.skip()
+                self.skipped += 1
+                self.publish("skipped", method=transaction["method"], step=step)
+                continue
 
-        for transaction in transactions:
             node = self.send(transaction, kind="TRANSACTION", parent=self.root)
+            node.step = step
 
             if self.is_successful(node, transaction["isSuccessIfReceives"]):
+                self.history.append(("TRANSACTION", node, True))
                 node.add_parent(self.root)
+                self.context.add(node, transaction.get("name"))
+                self.record(statestore.RUNNING)
+                self.publish_step("succeeded", "TRANSACTION", node)
+                if self.holds(transaction, "exitWhen", default=False):
+                    self.exited_early = True
+                    break
                 continue
             else:
-                return (
-                    False,
-                    self.root.children,
-                    self.issue_compensating_transactions(self.root.children),
-                )
-
+                self.history.append(("TRANSACTION", node, False))
+                self.publish_step("failed", "TRANSACTION", node)
+                if self.outboxed and outbox.enabled():
+                    self.record(statestore.COMPENSATING)
+                    outbox.submit(self)
+                    return False, self.root.children, []
+                return False, self.root.children, self.compensate()
+
+        self.finish(True, [])
         return True, self.root.children, []
 
+    def compensate(self):
+        """
+        Issue the outstanding compensations for every transaction that succeeded, and
+        return the ones that failed.
+        """
+
+        self.record(statestore.COMPENSATING)
+        failed_compensations = self.issue_compensating_transactions(self.root.children)
+        self.finish(False, failed_compensations)
+        return failed_compensations
+
+    @classmethod
+    def resume(cls, record, lease, store=None):
+        """
+        Take over a saga from its record in the state store, left behind by another
+        replica, and compensate it for as long as we hold its `lease`.
+        """
+
+        root = record["root"]
+        coordinator = cls(
+            record["configuration"],
+            start_request_headers=root["headers"],
+            start_request_body=as_bytes(root["body"] or ""),
+            path_parameters=root["pathParameters"],
+            store=store,
+        )
+        coordinator.identifier = record["id"]
+        coordinator.lease = lease
+        for position, state in enumerate(record["transactions"]):
+            node = RequestNode.from_state(state)
+            node.add_parent(coordinator.root)
+            step = position if node.step is None else node.step
+            while len(coordinator.context.transactions) < step:
+                coordinator.context.skip()
+            coordinator.context.add(node, node.configuration.get("name"))
+
+        return coordinator.compensate()
+
+    def snapshot(self, status):
+        # A saga taken over is owned by whoever holds its lease.
+        owner = settings.REPLICA_ID if self.lease is None else self.lease.owner
+        return {
+            "id": self.identifier,
+            "status": status,
+            "owner": owner,
+            "updated": time.time(),
+            "configuration": self.configuration,
+            "root": {
+                "headers": dict(self.root.headers),
+                "body": self.root.body,
+                "pathParameters": self.root.path_parameters,
+            },
+            "transactions": [node.to_state() for node in self.root.children],
+        }
+
+    def record(self, status):
+        """
+        Write the saga's record. A store no other replica sees is never read back, so
+        only sagas kept for inspection (FAILED) are written to it.
+        """
+
+        if self.persistent and (self.store.shared or status == statestore.FAILED):
+            self.store.save(self.identifier, self.snapshot(status))
+
+    def finish(self, success, failed_compensations):
+        """
+        Sagas that are over are forgotten, unless compensations failed - those are
+        kept for inspection.
+        """
+
+        self.publish(
+            "finished",
+            success=success,
+            failedCompensations=len(failed_compensations),
+        )
+        if self.analyzed:
+            analytics.record(self, success, failed_compensations)
+
+        if not self.persistent:
+            return
+        if failed_compensations:
+            self.record(statestore.FAILED)
+        else:
+            self.store.delete(self.identifier)
+
+    def publish(self, kind, **fields):
+        if self.observable:
+            events.bus.publish(kind, self.identifier, **fields)
+
+    def publish_step(self, kind, message_type, node):
+        self.publish(
+            kind,
+            messageType=message_type,
+            method=node.configuration.get("method"),
+            url=node.url,
+            status=node.response_status,
+        )
+
+    def holds(self, transaction, key, default=True):
+        """
+        Whether the predicate under `key` of a transaction holds, or `default` if it
+        has none.
+        """
+
+        if key not in transaction:
+            return default
+        return compile_predicate(transaction[key]).evaluate(self.root, self.context)
+
     def issue_compensating_transactions(self, transactions_so_far):
 
         failed_compensations = []
 
         for node in transactions_so_far:
-            for compensating_transaction in node.configuration["onFailure"]:
+            for position, compensating_transaction in enumerate(
+                node.configuration["onFailure"]
+            ):
+                if position in node.compensated:
+                    continue
+                if self.lease is not None:
+                    self.lease.check()
 
                 response_node = self.send(
                     compensating_transaction, kind="COMPENSATION", parent=node
                 )
+                response_node.step = node.step
 
                 if self.is_successful(
                     response_node, compensating_transaction["isSuccessIfReceives"]
                 ):
+                    self.history.append(("COMPENSATION", response_node, True))
                     response_node.add_parent(node)
+                    node.compensated.add(position)
+                    self.record(statestore.COMPENSATING)
+                    self.publish_step("compensated", "COMPENSATION", response_node)
                     continue
 
                 else:
+                    self.history.append(("COMPENSATION", response_node, False))
+                    self.publish_step("failed", "COMPENSATION", response_node)
                     failed_compensations.append(response_node)
 
         return failed_compensations
@@ -151,7 +408,7 @@ class SagaCoordinator(object):
             ):
                 continue
 
-            if body and node.response_body != body:
+            if body and node.response_body != as_bytes(body):
                 continue
 
             return True
@@ -165,6 +422,8 @@ class SagaCoordinator(object):
         headers.update(
             {"X-Qbox-TransactionID": self.identifier, "X-Qbox-Message-Type": kind}
         )
+        if self.lease is not None:
+            headers["X-Qbox-Fencing-Token"] = str(self.lease.token)
 
         node = RequestNode()
         node.update_configuration(transaction)
@@ -178,38 +437,109 @@ class SagaCoordinator(object):
         """
 
         node = self.prepare_node(transaction, parent, kind)
+        attempts = self.attempts
+        start = time.monotonic()
+
+        if self.batching and kind == "TRANSACTION" and "batch" in transaction:
+            result = get_batcher(transaction, node.url, node.headers).submit(
+                node, partial(self.request, transaction, kind)
+            )
+            if result is not None:
+                status, headers, body = result
+                node.update_response(status=status, headers=headers, body=body)
+            # Only the saga leading the batch sends it, but every saga in it was sent.
+            node.attempts = max(1, self.attempts - attempts)
+            node.elapsed = time.monotonic() - start
+            return node
+
+        response = self.request(transaction, kind, node.url, node.headers, node.body)
+        if response is not None:
+            node.update_response(
+                status=response.status_code,
+                headers=response.headers,
+                body=response.content,
+            )
+        node.attempts = self.attempts - attempts
+        node.elapsed = time.monotonic() - start
+
+        return node
+
+    def request(self, transaction, kind, url, headers, body):
+        """
+        Send a request downstream, retrying on timeouts. Returns None if every attempt
+        timed out.
+        """
 
         # IF the number of retries is not specified:
-        #  - Always keep retrying compensating transactions unless one succeeds.
+        #  - Always keep retrying compensating transactions unless one succeeds
+        #    (the outbox retries them itself, see outbox.py).
         #  - Cap the number of retries for transactions to just one.
         # This ensures safety for other services.
         maxIterations = transaction.get(
-            "maxRetriesOnTimeout", None if kind == "COMPENSATION" else 1
+            "maxRetriesOnTimeout",
+            self.compensation_attempts if kind == "COMPENSATION" else 1,
+        )
+        attempts = (
+            itertools.repeat(0)
+            if maxIterations is None
+            else itertools.repeat(0, times=maxIterations)
         )
 
-        for _ in itertools.repeat(0, times=maxIterations):
+        limiter = ratelimit.limiter_for(url, transaction.get("rateLimit"))
+        # Compensations wait for a token or connection for as long as it takes, unless
+        # their attempts are bounded: the outbox reschedules those rather than have a
+        # worker wait.
+        waits = kind == "COMPENSATION" and self.compensation_attempts is None
+
+        for attempt, _ in enumerate(attempts, start=1):
+            timeout = latency.timeout_for(transaction, url)
+
+            # Requests that can't get a token within their timeout count as having
+            # timed out.
+            if limiter is not None and not limiter.acquire(
+                compensation=kind == "COMPENSATION",
+                timeout=None if waits else timeout,
+            ):
+                continue
+            # Likewise for a connection in the saga's bulkhead.
+            if self.bulkhead is not None and not self.bulkhead.connect(
+                compensation=kind == "COMPENSATION",
+                timeout=None if waits else timeout,
+            ):
+                continue
 
-            response = None
+            self.attempts += 1
+            self.publish(
+                "sent" if attempt == 1 else "retried",
+                messageType=kind,
+                method=transaction["method"],
+                url=url,
+                attempt=attempt,
+            )
+
+            start = time.monotonic()
             try:
-                response = requests.request(
-                    method=transaction["method"],
-                    url=node.url,
-                    headers=node.headers,
-                    data=node.body,
-                    timeout=transaction["timeout"],
-                    # proxies={"http": ENVOY_ADDRESS, "https": ENVOY_ADDRESS},
+                response = transport.get().request(
+                    transaction["method"],
+                    url,
+                    headers=headers,
+                    body=body,
+                    timeout=timeout,
                 )
-            except Timeout:
+            except transport.Timeout:
+                latency.observe(url, timeout)
                 continue
+            finally:
+                if self.bulkhead is not None:
+                    self.bulkhead.disconnect()
+            latency.observe(url, time.monotonic() - start)
 
-            node.update_response(
-                status=response.status_code,
-                headers=response.headers,
-                body=response.text,
+            capture.record_downstream(
+                self.capture_id, transaction["method"], url, response
             )
-            return node
+            return response
 
-        return node
+        return None
 
     def resolve_interpolations(self, transaction, parent=None):
 
@@ -217,13 +547,17 @@ class SagaCoordinator(object):
         if "url" in transaction:
             url = self.interpolate(transaction["url"], parent=parent)
 
-        headers = transaction.get("headers", {})
-        for header, value in headers.items():
+        # Configurations are shared between concurrent sagas, so resolve into a copy.
+        headers = {}
+        for header, value in transaction.get("headers", {}).items():
             headers[header] = self.interpolate(value, parent=parent)
 
-        body = self.interpolate(transaction.get("body", ""), parent=parent)
+        # Bodies go out as bytes, so that binary bodies spliced into text survive.
+        body = as_bytes(
+            self.interpolate(transaction.get("body", ""), parent=parent, body=True)
+        )
 
         return url, headers, body
 
-    def interpolate(self, line, parent):
-        return interpolate(line, parent=parent, root=self.root, transactions=[])
+    def interpolate(self, line, parent, body=False):
+        return interpolate(line, parent=parent, context=self.context, body=body)
@@ -0,0 +1,134 @@
+"""
+A stream of saga progress events.
+
+Coordinators publish an event on every state transition of a saga:
+
+    started      the saga was matched and is about to run
+    skipped      a transaction's `when` didn't hold, so it wasn't sent
+    sent         a request went out (with `attempt` 1)
+    retried      ... went out again after a timeout
+    succeeded    a transaction got one of the responses it was waiting for
+    failed       a transaction or compensation didn't
+    compensated  a compensation succeeded
+    deadLettered the outbox gave up on a saga's compensations, after `attempts`
+    finished     the saga is over, with `success`
+
+The admin events endpoint streams them, for one `X-Qbox-TransactionID` or for all
+sagas, as server-sent events or by long polling.
+
+Publishing never blocks on subscribers. Each subscriber has a bounded queue, and when
+it falls behind the oldest events are dropped (and counted) to make room. A bounded
+history of recent events lets pollers and reconnecting streams pick up where they left
+off, as long as they don't fall too far behind.
+"""
+import time
+import metrics
+import threading
+import itertools
+import collections
+
+SUBSCRIBER_CAPACITY = 256
+HISTORY_SIZE = 1024
+
+
+class Subscription(object):
+    def __init__(self, bus, transaction, capacity):
+        self.bus = bus
+        self.transaction = transaction
+        self.condition = threading.Condition()
+        self.events = collections.deque(maxlen=capacity)
+        self.dropped = 0
+
+    def matches(self, event):
+        return self.transaction is None or event["transaction"] == self.transaction
+
+    def put(self, event):
+        with self.condition:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append(event)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Returns the events published since the last call, waiting up to `timeout`
+        seconds for at least one.
+        """
+
+        with self.condition:
+            if not self.events:
+                self.condition.wait(timeout)
+            events = list(self.events)
+            self.events.clear()
+            return events
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class EventBus(object):
+    def __init__(self, history_size=HISTORY_SIZE):
+        self.lock = threading.Lock()
+        self.sequence = itertools.count(1)
+        self.history = collections.deque(maxlen=history_size)
+        self.subscriptions = []
+        self.published = 0
+
+    def publish(self, kind, transaction, **fields):
+        event = dict(fields, type=kind, transaction=transaction, time=time.time())
+
+        with self.lock:
+            event["sequence"] = next(self.sequence)
+            self.history.append(event)
+            self.published += 1
+            subscriptions = self.subscriptions
+
+        for subscription in subscriptions:
+            if subscription.matches(event):
+                subscription.put(event)
+        return event
+
+    def subscribe(self, transaction=None, since=None, capacity=SUBSCRIBER_CAPACITY):
+        """
+        Subscribe to events for `transaction`, or for all sagas. Events after the
+        sequence number `since` that are still in the history are delivered first.
+        """
+
+        subscription = Subscription(self, transaction, capacity)
+
+        with self.lock:
+            if since is not None:
+                for event in self.history:
+                    if event["sequence"] > since and subscription.matches(event):
+                        subscription.put(event)
+            # Copied on write, so that publishing can iterate without the lock.
+            self.subscriptions = self.subscriptions + [subscription]
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions = [
+                s for s in self.subscriptions if s is not subscription
+            ]
+
+    def snapshot(self):
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+            published = self.published
+        return {
+            "published": published,
+            "subscribers": len(subscriptions),
+            "dropped": sum(subscription.dropped for subscription in subscriptions),
+        }
+
+
+bus = EventBus()
+
+metrics.register("events", bus.snapshot)
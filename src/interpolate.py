@@ -1,95 +1,276 @@
+"""
+Interpolation of values from a saga into the configuration's templates.
+
+A template is any string in the configuration, in which references of the form
+`${<node>.<field>}` or `${<node>.<field>:<default>}` are replaced. <node> is one of
+
+    root                  the request that started the saga
+    parent                the transaction a compensation compensates, say
+    transaction[<i>]      the i-th transaction of the saga, if it has completed
+    steps.<name>          the completed transaction with that `name`
+
+and <field> one of `headers.<name>`, `body`, `path.<parameter>` (root only) or
+`body.json.<path>`, which extracts a single field from a JSON body with a JSON path
+such as `$.order.items[0].id` or `$['order-id']`. Fields can be prefixed with
+`request.` or `response.` to choose which side of a transaction they come from.
+References that don't resolve are replaced by their default (or nothing), and
+anything that isn't a reference is left alone.
+
+Templates are compiled once, when the configuration is loaded, so rendering one is
+a walk over its parts with no pattern matching.
+"""
 import re
+import json
+import functools
+from spool import SpooledBody
+
+# Bodies are kept as the raw bytes that came off the wire. They are only decoded when a
+# template splices them into surrounding text, and surrogateescape guarantees that bytes
+# which aren't valid UTF-8 come back out unchanged when the result is encoded again.
+ENCODING = "utf-8"
+ENCODING_ERRORS = "surrogateescape"
+
+
+def as_text(value):
+    if isinstance(value, (bytes, bytearray, SpooledBody)):
+        return value.decode(ENCODING, ENCODING_ERRORS)
+    return value
+
 
+def as_bytes(value):
+    if isinstance(value, str):
+        return value.encode(ENCODING, ENCODING_ERRORS)
+    return value
 
-def interpolate(line, parent, root, transactions):
+
+REFERENCE_PATTERN = re.compile(r"\$\{([^}]*)\}")
+
+REFERENCE_PARTS = re.compile(
+    r"(?:(?P<root>root)|(?P<parent>parent)"
+    r"|transaction\[(?P<index>[0-9]+)\]|steps\.(?P<step>[A-Za-z0-9_\-]+))"
+    r"\.(?:(?P<side>request|response)\.)?"
+    r"(?:headers\.(?P<header>[A-Za-z0-9_\-]+)"
+    r"|path\.(?P<parameter>[A-Za-z0-9_\-]+)"
+    r"|body(?:\.json\.(?P<path>\$.*))?)",
+    flags=re.IGNORECASE,
+)
+
+JSON_PATH_STEP = re.compile(
+    r"\.(?P<name>[A-Za-z0-9_\-]+)"
+    r"|\[(?P<index>-?[0-9]+)\]"
+    r"|\[(?P<quote>['\"])(?P<key>.*?)(?P=quote)\]"
+)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_json_path(path):
     """
-    Replace an interpolation pattern with the corresponding values.
+    Turns a JSON path into the keys and indices to walk down, e.g. "$.items[0].id"
+    into ("items", 0, "id").
     """
 
-    if not line:
-        return line
+    if not path.startswith("$"):
+        raise ValueError(f"JSON path {path} must start with $")
 
-    def replace_root_headers(match):
-        header, default = match.groups()
-        return root.headers.get(header, default)
-
-    def replace_root_body(match):
-        default = match.group("default")
-        return root.body if root.body else default
-
-    def replace_parent_headers(match):
-        header, default = match.groups()
-        return parent.headers.get(header, default)
-
-    def replace_parent_response_headers(match):
-        header, default = match.groups()
-        return parent.response_headers.get(header, default)
-
-    def replace_parent_response_body(match):
-        default = match.groups("default")
-        return parent.response_body if parent.response_body else default
-
-    def replace_parent_body(match):
-        default = match.groups("default")
-        return parent.body if parent.body else default
-
-    def replace_transaction_request_headers(match):
-        index, header, default = match.groups()
-        index = int(index)
-
-        if 0 <= index < len(transactions):
-            return (
-                transactions[index]
-                .get("request", {})
-                .get("headers", {})
-                .get(header, default)
-            )
+    steps = []
+    position = 1
+    while position < len(path):
+        match = JSON_PATH_STEP.match(path, position)
+        if not match:
+            raise ValueError(f"Invalid JSON path {path} at {path[position:]}")
+        if match.group("index") is not None:
+            steps.append(int(match.group("index")))
+        elif match.group("name") is not None:
+            steps.append(match.group("name"))
         else:
-            return default
+            steps.append(match.group("key"))
+        position = match.end()
 
-    def replace_transaction_response_headers(match):
-        index, header, default = match.groups()
-        index = int(index)
+    return tuple(steps)
 
-        if 0 <= index < len(transactions):
-            return transactions[index].response_headers.get(header, default)
-        else:
-            return default
 
-    def replace_transaction_request_body(match):
-        index, default = match.groups()
-        index = int(index)
+def extract_json(document, steps):
+    """
+    The value at `steps` in a parsed JSON document, as text. Raises LookupError if
+    there is none.
+    """
 
-        if 0 <= index < len(transactions):
-            body = transactions[index].body
-            return default if not body else body
+    value = document
+    for step in steps:
+        if isinstance(step, int) and isinstance(value, list):
+            value = value[step]
+        elif isinstance(step, str) and isinstance(value, dict):
+            value = value[step]
         else:
-            return default
+            raise LookupError(step)
 
-    def replace_transaction_response_body(match):
-        index, default = match.groups()
-        index = int(index)
+    return value if isinstance(value, str) else json.dumps(value)
 
-        if 0 <= index < len(transactions):
-            body = transactions[index].response_body
-            return default if not body else body
-        else:
-            return default
-
-    patterns = {
-        r"\$\{root\.headers\.(?P<header>[A-Za-z0-9\_\-]+):?(?P<default>.*?)\}": replace_root_headers,
-        r"\$\{root\.body:?(?P<default>.*?)\}": replace_root_body,
-        r"\$\{parent\.headers\.(?P<header>[A-Za-z0-9\_\-]+):?(?P<default>.*?)\}": replace_parent_headers,
-        r"\$\{parent\.body:?(?P<default>.*?)\}": replace_parent_body,
-        r"\$\{parent\.response\.headers\.(?P<header>[A-Za-z0-9\_\-]+):?(?P<default>.*?)\}": replace_parent_response_headers,
-        r"\$\{parent\.response\.body:?(?P<default>.*?)\}": replace_parent_response_body,
-        r"\$\{transaction\[(?P<index>[0-9]+)\]\.request\.headers\.(?P<header>[A-Za-z0-9\_\-]+):?(?P<default>.*?)\}": replace_transaction_request_headers,
-        r"\$\{transaction\[(?P<index>[0-9]+)\]\.response\.headers\.(?P<header>[A-Za-z0-9\_\-]+):?(?P<default>.*?)\}": replace_transaction_response_headers,
-        r"\$\{transaction\[(?P<index>[0-9]+)\]\.request\.body:?(?P<default>.*?)\}": replace_transaction_request_body,
-        r"\$\{transaction\[(?P<index>[0-9]+)\]\.response\.body:?(?P<default>.*?)\}": replace_transaction_response_body,
-    }
-
-    for pattern, replacement_function in patterns.items():
-        line = re.sub(pattern, replacement_function, line, flags=re.IGNORECASE)
-
-    return line
+
+class SagaContext(object):
+    """
+    Everything in a saga that templates can refer to. Coordinators add transactions
+    as they complete, so looking one up by index or name never scans anything.
+    """
+
+    def __init__(self, root, transactions=None, steps=None):
+        self.root = root
+        self.transactions = [] if transactions is None else transactions
+        self.steps = {} if steps is None else steps
+
+    def add(self, node, name=None):
+        self.transactions.append(node)
+        if name:
+            self.steps[name] = node
+
+    def skip(self):
+        # Skipped transactions keep their position, so later indices still line up
+        # with the configuration.
+        self.transactions.append(None)
+
+    def transaction(self, index):
+        if 0 <= index < len(self.transactions):
+            return self.transactions[index]
+        return None
+
+    def step(self, name):
+        return self.steps.get(name)
+
+
+class Reference(object):
+    def __init__(self, match, default):
+        self.default = default
+        self.source = next(
+            source
+            for source in ("root", "parent", "index", "step")
+            if match.group(source) is not None
+        )
+        self.index = int(match.group("index") or 0)
+        self.step = match.group("step")
+        self.response = (match.group("side") or "").lower() == "response"
+        self.header = match.group("header")
+        self.parameter = match.group("parameter")
+        self.json_path = None
+        if match.group("path") is not None:
+            self.json_path = compile_json_path(match.group("path"))
+
+    def node(self, parent, context):
+        if self.source == "root":
+            return context.root
+        if self.source == "parent":
+            return parent
+        if self.source == "index":
+            return context.transaction(self.index)
+        return context.step(self.step)
+
+    def body(self, node):
+        return node.response_body if self.response else node.body
+
+    def render(self, parent, context):
+        node = self.node(parent, context)
+        if node is None:
+            return self.default
+
+        if self.header is not None:
+            headers = node.response_headers if self.response else node.headers
+            return headers.get(self.header, self.default)
+
+        if self.parameter is not None:
+            return node.path_parameters.get(self.parameter, self.default)
+
+        if self.json_path is not None:
+            document = node.json_body(response=self.response)
+            if document is None:
+                return self.default
+            try:
+                return extract_json(document, self.json_path)
+            except LookupError:
+                return self.default
+
+        body = self.body(node)
+        return as_text(body) if body else self.default
+
+
+class Template(object):
+    def __init__(self, parts):
+        self.parts = parts
+        # A template that is nothing but one body evaluates to that body as-is.
+        self.whole_body = (
+            len(parts) == 1
+            and isinstance(parts[0], Reference)
+            and parts[0].header is None
+            and parts[0].parameter is None
+            and parts[0].json_path is None
+        )
+
+    def render(self, parent, context, body=False):
+        """
+        Rendering a `body`, bodies referenced on their own come out as the raw bytes
+        (never decoded), so binary payloads pass through untouched. Anything else, and
+        everything that isn't a body (urls, headers), comes out as text.
+        """
+
+        if body and self.whole_body:
+            reference = self.parts[0]
+            node = reference.node(parent, context)
+            if node is not None and reference.body(node):
+                return reference.body(node)
+
+        return "".join(
+            part if isinstance(part, str) else part.render(parent, context)
+            for part in self.parts
+        )
+
+
+@functools.lru_cache(maxsize=8192)
+def compile_template(line):
+    parts = []
+    position = 0
+
+    for match in REFERENCE_PATTERN.finditer(line):
+        reference, _, default = match.group(1).partition(":")
+        parsed = REFERENCE_PARTS.fullmatch(reference)
+        if parsed is None:
+            # Not something we know how to resolve - leave it be.
+            continue
+        if parsed.group("parameter") is not None and parsed.group("root") is None:
+            continue
+
+        if match.start() > position:
+            parts.append(line[position : match.start()])
+        parts.append(Reference(parsed, default))
+        position = match.end()
+
+    if position < len(line):
+        parts.append(line[position:])
+    return Template(parts)
+
+
+def compile_templates(configuration):
+    """
+    Compile every template in a configuration up front, so that invalid ones are
+    reported when it is loaded and rendering them later costs no parsing.
+    """
+
+    if isinstance(configuration, dict):
+        for value in configuration.values():
+            compile_templates(value)
+    elif isinstance(configuration, list):
+        for value in configuration:
+            compile_templates(value)
+    elif isinstance(configuration, str):
+        compile_template(configuration)
+
+
+def interpolate(line, parent, root=None, transactions=None, context=None, body=False):
+    """
+    Render a template against a saga: either its `context`, or its `root` request and
+    the list of its completed `transactions`. See `Template.render` for `body`.
+    """
+
+    if not line:
+        return line
+
+    if context is None:
+        context = SagaContext(root, transactions)
+    return compile_template(line).render(parent, context, body=body)
@@ -0,0 +1,139 @@
+"""
+Observed downstream latency, and timeouts adapted to it.
+
+Every downstream request the coordinators send is timed, and the latency recorded in
+a quantile sketch for the host of its url. Transactions configured with
+`timeout: adaptive` get a timeout for each attempt derived from their host's sketch:
+the configured quantile of recent latencies times a multiplier, bounded by a minimum
+and a maximum. Until a host has enough samples the maximum is used.
+
+Attempts that time out are recorded at their timeout - a lower bound of how long they
+would have taken - so that when a host slows down its timeouts grow with it instead of
+every attempt timing out at the old quantile.
+
+The sketches are exposed under `latency` on the admin metrics endpoint.
+"""
+import math
+import threading
+from urllib.parse import urlsplit
+
+import metrics
+
+# Quantiles are answered to within this relative error.
+ACCURACY = 0.02
+# Counts are halved once a sketch has seen this many samples, to forget old latency.
+MAX_COUNT = 10000
+# Latencies below this (in seconds) are recorded as this.
+MIN_LATENCY = 1e-6
+
+# Defaults for `adaptiveTimeout`.
+QUANTILE = 0.99
+MULTIPLIER = 2.0
+MIN_SECONDS = 0.05
+MAX_SECONDS = 30.0
+MIN_SAMPLES = 20
+
+
+class QuantileSketch(object):
+    """
+    A log-bucketed histogram (in the style of DDSketch). Values that are within the
+    relative `accuracy` of each other share a bucket, so any quantile can be answered
+    to that accuracy from a small, bounded number of buckets.
+    """
+
+    def __init__(self, accuracy=ACCURACY, max_count=MAX_COUNT):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_count = max_count
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.count = 0
+
+    def add(self, value):
+        index = math.ceil(math.log(max(value, MIN_LATENCY)) / self.log_gamma)
+
+        with self.lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            if self.count >= self.max_count:
+                self.decay()
+
+    def decay(self):
+        self.buckets = {
+            index: count // 2 for index, count in self.buckets.items() if count > 1
+        }
+        self.count = sum(self.buckets.values())
+
+    def quantile(self, q):
+        """
+        The `q`-quantile of the values seen, or None if there are none.
+        """
+
+        with self.lock:
+            if not self.count:
+                return None
+            rank = q * (self.count - 1)
+            seen = 0
+            for index in sorted(self.buckets):
+                seen += self.buckets[index]
+                if seen > rank:
+                    break
+
+        # The middle of the bucket, which is within `accuracy` of every value in it.
+        return 2 * self.gamma**index / (self.gamma + 1)
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+_sketches = {}
+_sketches_lock = threading.Lock()
+
+
+def sketch_for(url):
+    host = urlsplit(url).netloc
+
+    with _sketches_lock:
+        sketch = _sketches.get(host)
+        if sketch is None:
+            sketch = _sketches[host] = QuantileSketch()
+        return sketch
+
+
+def observe(url, seconds):
+    sketch_for(url).add(seconds)
+
+
+def timeout_for(transaction, url):
+    """
+    The timeout in seconds for the next attempt of `transaction` against `url`.
+    """
+
+    timeout = transaction["timeout"]
+    if timeout != "adaptive":
+        return timeout
+
+    options = transaction.get("adaptiveTimeout", {})
+    minimum = options.get("minSeconds", MIN_SECONDS)
+    maximum = options.get("maxSeconds", MAX_SECONDS)
+
+    sketch = sketch_for(url)
+    if sketch.count < MIN_SAMPLES:
+        return maximum
+
+    latency = sketch.quantile(options.get("quantile", QUANTILE))
+    return min(maximum, max(minimum, latency * options.get("multiplier", MULTIPLIER)))
+
+
+def snapshot():
+    with _sketches_lock:
+        sketches = dict(_sketches)
+    return {host: sketch.snapshot() for host, sketch in sketches.items()}
+
+
+metrics.register("latency", snapshot)
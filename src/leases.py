@@ -0,0 +1,262 @@
+"""
+Ownership of sagas across replicas.
+
+Every replica with a shared state store holds a lease named after itself
+(`replica:<id>`) for as long as it is alive, renewed by a heartbeat, and only reports
+ready once it does. A saga whose record is owned by a replica without a live lease has
+been orphaned, and so has one owned by this replica's ID but last written before this
+process started - left behind by an earlier process that went by the same ID.
+
+Recovery workers on every replica look for orphaned sagas and take one over only
+after acquiring its lease (`saga:<identifier>`), so no two replicas compensate the
+same saga. Orphans are visited in random order, so that workers on different
+replicas mostly pick different sagas and recovery throughput grows with the number
+of replicas rather than with contention.
+
+Each acquisition of a lease comes with a fencing token that is higher than the
+previous holder's. A coordinator resuming a saga sends its token downstream in the
+`X-Qbox-Fencing-Token` header, and stops compensating as soon as it can no longer
+be sure it still holds the lease - a replica that was merely slow won't compensate
+a saga another one took over. A saga it fails to resume is handed back with the owner
+it was orphaned by, so that recovery picks it up again.
+"""
+import time
+import random
+import logging
+import settings
+import threading
+import statestore
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def replica_lease(replica_id):
+    return f"replica:{replica_id}"
+
+
+def saga_lease(saga_id):
+    return f"saga:{saga_id}"
+
+
+class Lease(object):
+    def __init__(self, name, owner, token, ttl):
+        self.name = name
+        self.owner = owner
+        self.token = token
+        self.ttl = ttl
+        self.renewed = time.monotonic()
+        self.lost = False
+
+    def held(self):
+        """
+        Whether the lease is certainly still ours. Checked locally, so it errs on the
+        side of having lost it once a renewal is overdue.
+        """
+
+        return not self.lost and time.monotonic() - self.renewed < self.ttl
+
+    def check(self):
+        if not self.held():
+            raise LeaseLost(f"Lost the lease on {self.name} (token {self.token})")
+
+
+class LeaseKeeper(object):
+    """
+    Acquires leases in a store on behalf of this replica, and keeps the ones it holds
+    alive with a heartbeat every third of their TTL.
+    """
+
+    def __init__(self, store, owner=None, ttl=None):
+        self.store = store
+        self.owner = owner or settings.REPLICA_ID
+        self.ttl = ttl or settings.LEASE_SECONDS
+        self.lock = threading.Lock()
+        self.leases = {}
+        self.heartbeats = None
+        # Records of ours written before this are from an earlier process.
+        self.started = time.time()
+
+    def acquire(self, name):
+        token = self.store.acquire_lease(name, self.owner, self.ttl)
+        if token is None:
+            return None
+
+        lease = Lease(name, self.owner, token, self.ttl)
+        with self.lock:
+            self.leases[name] = lease
+        return lease
+
+    def hold(self, name, interval=None):
+        """
+        Acquire the lease `name`, retrying every `interval` seconds (a third of the
+        TTL by default) for as long as someone else holds it.
+        """
+
+        interval = self.ttl / 3 if interval is None else interval
+        while True:
+            try:
+                lease = self.acquire(name)
+            except Exception as e:
+                logging.warning(f"Could not acquire the lease on {name}: {e}")
+                lease = None
+            if lease is not None:
+                return lease
+
+            logging.error(f"The lease on {name} is held elsewhere, retrying")
+            time.sleep(interval)
+
+    def release(self, lease):
+        with self.lock:
+            self.leases.pop(lease.name, None)
+        lease.lost = True
+        self.store.release_lease(lease.name, lease.owner, lease.token)
+
+    def release_all(self):
+        """
+        Release every lease we hold, e.g. on shutdown so that others needn't wait for
+        them to expire.
+        """
+
+        with self.lock:
+            leases = list(self.leases.values())
+
+        for lease in leases:
+            try:
+                self.release(lease)
+            except Exception as e:
+                logging.warning(f"Could not release the lease on {lease.name}: {e}")
+
+    def heartbeat(self):
+        with self.lock:
+            leases = list(self.leases.values())
+
+        for lease in leases:
+            renewed = time.monotonic()
+            try:
+                held = self.store.renew_lease(
+                    lease.name, lease.owner, lease.token, lease.ttl
+                )
+            except Exception as e:
+                # The lease may well still be ours; `held` will tell once it's overdue.
+                logging.warning(f"Could not renew the lease on {lease.name}: {e}")
+                continue
+
+            if held:
+                lease.renewed = renewed
+            else:
+                logging.error(f"Lost the lease on {lease.name} to another replica")
+                lease.lost = True
+                with self.lock:
+                    self.leases.pop(lease.name, None)
+
+    def start(self):
+        if self.heartbeats is None:
+            self.heartbeats = threading.Thread(
+                target=self.run, name="qbox-lease-heartbeat", daemon=True
+            )
+            self.heartbeats.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.ttl / 3)
+            self.heartbeat()
+
+
+class Recovery(object):
+    """
+    Periodically takes over orphaned sagas and issues their outstanding compensations.
+    `resume` is called with each saga's record and the lease held on it.
+    """
+
+    def __init__(self, keeper, resume, interval=None):
+        self.keeper = keeper
+        self.store = keeper.store
+        self.resume = resume
+        self.interval = interval or settings.RECOVERY_INTERVAL_SECONDS
+        self.stopped = threading.Event()
+
+    def is_orphaned(self, record):
+        if record["status"] not in (statestore.RUNNING, statestore.COMPENSATING):
+            return False
+        if record["owner"] == self.keeper.owner:
+            return record["updated"] < self.keeper.started
+        return self.store.lease_owner(replica_lease(record["owner"])) is None
+
+    def orphans(self):
+        orphans = [
+            record for record in self.store.records() if self.is_orphaned(record)
+        ]
+        random.shuffle(orphans)
+        return orphans
+
+    def recover(self):
+        recovered = 0
+
+        for record in self.orphans():
+            lease = self.keeper.acquire(saga_lease(record["id"]))
+            if lease is None:
+                continue
+
+            try:
+                # Someone may have taken the saga over between listing and leasing.
+                record = self.store.get(record["id"])
+                if record is None or not self.is_orphaned(record):
+                    continue
+
+                logging.warning(
+                    f"Resuming saga {record['id']} orphaned by {record['owner']}"
+                )
+                self.resume(record, lease)
+                recovered += 1
+            except Exception as e:
+                logging.error(f"Could not resume saga {record['id']}: {e}")
+                self.abandon(record)
+            finally:
+                # Make sure the outcome is visible before anyone else can lease it.
+                self.store.flush(timeout=self.keeper.ttl)
+                self.keeper.release(lease)
+
+        return recovered
+
+    def abandon(self, orphaned):
+        """
+        Hand back a saga we failed to resume. Resuming made this replica its owner, and
+        a live replica's sagas are never orphaned, so its record gets back the owner
+        and update time it was orphaned with - keeping whatever progress we made.
+        """
+
+        try:
+            self.store.flush(timeout=self.keeper.ttl)
+            record = self.store.get(orphaned["id"])
+            if record is None or record["owner"] != self.keeper.owner:
+                return
+            if record["status"] not in (statestore.RUNNING, statestore.COMPENSATING):
+                return
+            # Leave it alone if another replica has taken it over in the meantime.
+            owner = self.store.lease_owner(saga_lease(record["id"]))
+            if owner not in (None, self.keeper.owner):
+                return
+
+            record["owner"] = orphaned["owner"]
+            record["updated"] = orphaned["updated"]
+            self.store.save(record["id"], record)
+        except Exception as e:
+            logging.error(f"Could not hand back saga {orphaned['id']}: {e}")
+
+    def start(self):
+        threading.Thread(target=self.run, name="qbox-recovery", daemon=True).start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.recover()
+            except Exception as e:
+                logging.error(f"Could not look for orphaned sagas: {e}")
+
+    def stop(self):
+        self.stopped.set()
+
+
+keeper = LeaseKeeper(statestore.store)
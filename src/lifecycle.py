@@ -0,0 +1,215 @@
+"""
+Graceful shutdown, and restarts that don't drop connections.
+
+On SIGTERM the sidecar drains: the readiness endpoint starts answering 503, the
+listening socket stops accepting, responses on kept-alive connections ask clients to
+reconnect (`Connection: close`), and sagas still running - including ones taken over
+from other replicas - get up to QBOX_DRAIN_SECONDS to finish, compensations and all.
+What is left after that is already in the state store, which is flushed before the
+process exits. With a shared store, the replica lease is released on the way out, so
+other replicas take over the leftovers right away instead of once it expires.
+
+On SIGHUP the sidecar first starts a replacement of itself that inherits the listening
+socket (as QBOX_LISTEN_FD), waits for it to report that it is serving, and then
+drains as above. Connections arriving in between wait in the socket's backlog for
+whichever process accepts next, so none are refused. If the replacement doesn't come
+up within QBOX_DRAIN_SECONDS, it is stopped and this process keeps serving.
+
+A process started with QBOX_LISTEN_FD serves on that socket instead of binding its own,
+which also works with any supervisor that opens the socket for it.
+"""
+import os
+import sys
+import socket
+import signal
+import logging
+import settings
+import functools
+import threading
+import contextlib
+from http.server import ThreadingHTTPServer
+
+import leases
+import statestore
+from readiness import readiness
+
+# Set on the replacement started on SIGHUP, to tell its parent it is serving.
+READY_FD_VARIABLE = "QBOX_READY_FD"
+
+
+class InFlight(object):
+    """
+    Counts the requests and sagas being worked on, and whether we are draining.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.count = 0
+        self.draining = False
+
+    def enter(self):
+        with self.condition:
+            self.count += 1
+
+    def exit(self):
+        with self.condition:
+            self.count -= 1
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def track(self):
+        self.enter()
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def wait(self, timeout=None):
+        """
+        Wait until nothing is in flight. Returns False if that didn't happen within
+        `timeout` seconds.
+        """
+
+        with self.condition:
+            return self.condition.wait_for(lambda: self.count == 0, timeout)
+
+
+in_flight = InFlight()
+
+
+def tracked(function):
+    """
+    Count calls of `function` as in flight, so that draining waits for them.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with in_flight.track():
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def create_server(address, handler):
+    """
+    An HTTP server on the socket inherited as QBOX_LISTEN_FD, or else bound to
+    `address`.
+    """
+
+    if settings.LISTEN_FD is None:
+        return ThreadingHTTPServer(address, handler)
+
+    httpd = ThreadingHTTPServer(address, handler, bind_and_activate=False)
+    httpd.socket.close()
+    httpd.socket = socket.socket(fileno=settings.LISTEN_FD)
+    httpd.server_address = httpd.socket.getsockname()
+    host, port = httpd.server_address[:2]
+    httpd.server_name = socket.getfqdn(host)
+    httpd.server_port = port
+    logging.info(f"Serving on inherited socket {settings.LISTEN_FD} ({host}:{port})")
+    return httpd
+
+
+def notify_ready():
+    """
+    Tell the process that started us to replace it that we are serving.
+    """
+
+    fd = os.environ.pop(READY_FD_VARIABLE, None)
+    if fd is not None:
+        os.write(int(fd), b"1")
+        os.close(int(fd))
+
+
+def start_replacement(httpd, timeout):
+    """
+    Start a copy of this process serving on our listening socket, and wait for it to
+    report that it is serving. Returns whether it did.
+    """
+
+    import select
+    import subprocess
+
+    listen_fd = httpd.fileno()
+    ready_read, ready_write = os.pipe()
+    env = dict(os.environ, QBOX_LISTEN_FD=str(listen_fd))
+    env[READY_FD_VARIABLE] = str(ready_write)
+    replacement = subprocess.Popen(
+        [sys.executable] + sys.argv, env=env, pass_fds=(listen_fd, ready_write)
+    )
+    os.close(ready_write)
+
+    try:
+        readable, _, _ = select.select([ready_read], [], [], timeout)
+        ready = bool(readable) and os.read(ready_read, 1) == b"1"
+    finally:
+        os.close(ready_read)
+
+    if not ready:
+        logging.error(
+            f"Replacement {replacement.pid} did not start serving, keeping on"
+        )
+        replacement.kill()
+        replacement.wait()
+        return False
+
+    logging.info(f"Handed the listening socket to replacement {replacement.pid}")
+    return True
+
+
+class Drain(object):
+    """
+    Shuts the server down gracefully (see the module docstring). `stopping` are called
+    once the server has stopped accepting, e.g. to stop taking over sagas.
+    """
+
+    def __init__(self, httpd, seconds=None, stopping=()):
+        self.httpd = httpd
+        self.seconds = settings.DRAIN_SECONDS if seconds is None else seconds
+        self.stopping = list(stopping)
+        self.thread = None
+
+    def install(self):
+        signal.signal(signal.SIGTERM, lambda *_: self.start(replace=False))
+        signal.signal(signal.SIGHUP, lambda *_: self.start(replace=True))
+
+    def start(self, replace):
+        # Signal handlers run on the thread serving, which shutting down waits for.
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(
+                target=self.run, args=(replace,), name="qbox-drain"
+            )
+            self.thread.start()
+
+    def run(self, replace):
+        if replace and not start_replacement(self.httpd, self.seconds):
+            return
+
+        logging.info(f"Draining, for up to {self.seconds}s")
+        readiness.drain()
+        with in_flight.condition:
+            in_flight.draining = True
+        self.httpd.shutdown()
+        for stop in self.stopping:
+            stop()
+
+        if not in_flight.wait(self.seconds):
+            logging.warning(
+                f"{in_flight.count} requests still in flight after {self.seconds}s, "
+                "leaving them to the state store"
+            )
+
+        if not statestore.store.flush(timeout=self.seconds):
+            logging.error("Could not write all saga state before shutting down")
+        if statestore.store.shared:
+            leases.keeper.release_all()
+        elif in_flight.count:
+            logging.error(
+                "Sagas cut off by the shutdown can't be taken over: the state store "
+                "isn't shared with other replicas"
+            )
+        logging.info("Drained")
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,22 @@
+"""
+A small registry of metric providers.
+
+Modules that keep statistics register a zero-argument callable returning a
+JSON-serializable snapshot. The server exposes all of them together on the
+admin metrics endpoint.
+"""
+import threading
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def register(name, provider):
+    with _providers_lock:
+        _providers[name] = provider
+
+
+def snapshot():
+    with _providers_lock:
+        providers = dict(_providers)
+    return {name: provider() for name, provider in providers.items()}
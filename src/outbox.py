@@ -0,0 +1,183 @@
+"""
+Compensations issued in the background.
+
+With QBOX_COMPENSATION_WORKERS above zero, a saga whose forward transaction fails
+doesn't compensate on the request thread. Its record goes to the state store as
+COMPENSATING - which is what makes the outbox durable: if this replica goes away, the
+saga is recovered from there like any other orphan (see leases.py) - and the saga is
+queued here. The client gets its `onAnyFailed` response right away.
+
+A pool of workers takes queued sagas highest `compensationPriority` first (0 unless
+configured) and issues their outstanding compensations, sending each at most once per
+pass unless it sets `maxRetriesOnTimeout`. A saga with compensations that failed is
+rescheduled with exponential backoff (from QBOX_COMPENSATION_BACKOFF_SECONDS, doubling
+up to MAX_BACKOFF_SECONDS, with jitter), and dead-lettered after
+QBOX_COMPENSATION_MAX_ATTEMPTS passes: its record is kept as FAILED for inspection,
+exactly as a synchronously compensated saga whose compensations failed would be.
+
+Queued sagas count as in flight while draining for shutdown (see lifecycle.py).
+"""
+import time
+import heapq
+import random
+import logging
+import metrics
+import settings
+import threading
+import itertools
+
+import lifecycle
+
+MAX_BACKOFF_SECONDS = 60.0
+
+
+class Job(object):
+    def __init__(self, coordinator, priority):
+        self.coordinator = coordinator
+        self.priority = priority
+        self.attempts = 0
+
+
+class Outbox(object):
+    def __init__(
+        self, workers=None, max_attempts=None, backoff_seconds=None, clock=None
+    ):
+        self.workers = settings.COMPENSATION_WORKERS if workers is None else workers
+        self.max_attempts = max_attempts or settings.COMPENSATION_MAX_ATTEMPTS
+        self.backoff_seconds = (
+            settings.COMPENSATION_BACKOFF_SECONDS
+            if backoff_seconds is None
+            else backoff_seconds
+        )
+        self.clock = clock or time.monotonic
+        self.condition = threading.Condition()
+        # Jobs that can run now, by (-priority, sequence), and jobs waiting for a
+        # retry, by (due, sequence).
+        self.ready = []
+        self.scheduled = []
+        self.sequence = itertools.count()
+        self.threads = []
+        self.running = 0
+        self.completed = 0
+        self.retried = 0
+        self.dead_lettered = 0
+
+    def enabled(self):
+        return self.workers > 0
+
+    def submit(self, coordinator):
+        """
+        Queue the compensations of a saga that failed. The saga's record must already
+        be in the state store.
+        """
+
+        # Timeouts, and waits for rate limits and bulkheads, are retried by
+        # rescheduling the saga, so that no worker is held by one compensation
+        # indefinitely.
+        coordinator.compensation_attempts = 1
+        priority = coordinator.configuration.get("compensationPriority", 0)
+        lifecycle.in_flight.enter()
+
+        with self.condition:
+            heapq.heappush(
+                self.ready, (-priority, next(self.sequence), Job(coordinator, priority))
+            )
+            if not self.threads:
+                self.start()
+            self.condition.notify()
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(
+                target=self.run, name=f"qbox-outbox-{number}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def take(self):
+        """
+        The next job to run, waiting for one to be ready.
+        """
+
+        with self.condition:
+            while True:
+                now = self.clock()
+                while self.scheduled and self.scheduled[0][0] <= now:
+                    _, _, job = heapq.heappop(self.scheduled)
+                    heapq.heappush(
+                        self.ready, (-job.priority, next(self.sequence), job)
+                    )
+
+                if self.ready:
+                    self.running += 1
+                    return heapq.heappop(self.ready)[2]
+
+                timeout = self.scheduled[0][0] - now if self.scheduled else None
+                self.condition.wait(timeout)
+
+    def run(self):
+        while True:
+            job = self.take()
+            try:
+                self.work(job)
+            finally:
+                with self.condition:
+                    self.running -= 1
+
+    def work(self, job):
+        coordinator = job.coordinator
+        job.attempts += 1
+
+        try:
+            failed = coordinator.issue_compensating_transactions(
+                coordinator.root.children
+            )
+        except Exception as e:
+            # E.g. a downstream refusing connections, retried like a failed one.
+            logging.error(f"Could not compensate saga {coordinator.identifier}: {e}")
+            failed = [e]
+
+        if failed and job.attempts < self.max_attempts:
+            return self.retry(job)
+
+        if failed:
+            logging.error(
+                f"Giving up on compensating saga {coordinator.identifier} after "
+                f"{job.attempts} attempts"
+            )
+            coordinator.publish("deadLettered", attempts=job.attempts)
+        coordinator.finish(False, failed)
+
+        with self.condition:
+            if failed:
+                self.dead_lettered += 1
+            else:
+                self.completed += 1
+        lifecycle.in_flight.exit()
+
+    def retry(self, job):
+        delay = min(MAX_BACKOFF_SECONDS, self.backoff_seconds * 2 ** (job.attempts - 1))
+        delay *= random.uniform(0.5, 1.0)
+
+        with self.condition:
+            self.retried += 1
+            heapq.heappush(
+                self.scheduled, (self.clock() + delay, next(self.sequence), job)
+            )
+            self.condition.notify()
+
+    def snapshot(self):
+        with self.condition:
+            return {
+                "workers": self.workers,
+                "ready": len(self.ready),
+                "scheduled": len(self.scheduled),
+                "running": self.running,
+                "completed": self.completed,
+                "retried": self.retried,
+                "deadLettered": self.dead_lettered,
+            }
+
+
+outbox = Outbox()
+metrics.register("outbox", outbox.snapshot)
@@ -0,0 +1,235 @@
+"""
+Shared, pre-warmed downstream connections.
+
+All outbound HTTP goes through one process-wide transport (see transport.py), so that
+connections to a host are reused across requests and sagas instead of being opened per
+request. This module holds what the transports share: the requests session, urllib3
+connection pools that resolve through the DNS cache, and the warming of connections.
+
+When a configuration is compiled we extract every distinct downstream host its sagas
+talk to (see `downstream_hosts`). On startup, and periodically afterwards, we open a
+configurable number of connections to each of them, so that the first sagas don't
+pay for DNS resolution and TCP connects. Hostnames are resolved through a small
+cache with a TTL, which every pooled connection uses, not just the warm ones.
+"""
+import re
+import time
+import socket
+import logging
+import settings
+import threading
+import itertools
+
+# A reference with a default, e.g. ${root.headers.Region:eu}
+DEFAULTED_REFERENCE = re.compile(r"\$\{[^}:]*:(?P<default>[^}]*)\}")
+REFERENCE = re.compile(r"\$\{[^}]*\}")
+
+
+def downstream_host(url):
+    """
+    Returns the "scheme://host[:port]" a (possibly templated) url points at, or None
+    if it can't be known before a saga runs. Interpolations in the host part are
+    resolved to their defaults when they all have one.
+    """
+
+    if "://" not in url:
+        url = f"http://{url}"
+
+    scheme, _, rest = url.partition("://")
+    host = re.split(r"[/?#]", rest, maxsplit=1)[0]
+
+    host = DEFAULTED_REFERENCE.sub(lambda match: match.group("default"), host)
+    if not host or REFERENCE.search(host) or "$" in host:
+        return None
+
+    return f"{scheme.lower()}://{host.lower()}"
+
+
+def downstream_hosts(configurations):
+    """
+    Every distinct downstream host in the `onMatchedRequest` and `onFailure` urls of
+    the given saga configurations.
+    """
+
+    hosts = set()
+    for configuration in configurations:
+        for transaction in configuration["onMatchedRequest"]:
+            for step in [transaction] + transaction.get("onFailure", []):
+                host = downstream_host(step["url"])
+                if host:
+                    hosts.add(host)
+    return sorted(hosts)
+
+
+class DNSCache(object):
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def resolve(self, host):
+        """
+        Returns an address for `host`, rotating through the ones it resolved to.
+        Falls back to stale entries if resolution fails, and to `host` itself if
+        there is nothing cached, so that the caller reports the failure as usual.
+        """
+
+        if is_address(host):
+            return host
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(host)
+        if entry is not None and entry[0] > now:
+            return next(entry[1])
+
+        try:
+            addresses = self.lookup(host)
+        except OSError as e:
+            if entry is not None:
+                logging.warning(f"Using stale DNS entry for {host}: {e}")
+                return next(entry[1])
+            return host
+
+        with self.lock:
+            self.entries[host] = (now + self.ttl, itertools.cycle(addresses))
+        return addresses[0]
+
+    def lookup(self, host):
+        addresses = []
+        for _, _, _, _, address in socket.getaddrinfo(
+            host, None, 0, socket.SOCK_STREAM
+        ):
+            if address[0] not in addresses:
+                addresses.append(address[0])
+        return addresses
+
+
+def is_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host.strip("[]"))
+            return True
+        except (OSError, ValueError):
+            continue
+    return False
+
+
+dns_cache = DNSCache(settings.DNS_TTL_SECONDS)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def session():
+    """
+    The process-wide session all downstream requests are sent through.
+    """
+
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+
+def create_session():
+    # Imported here rather than at module load to keep sidecar startup fast.
+    import requests
+    import http.cookiejar
+    from requests.adapters import HTTPAdapter
+
+    adapter = HTTPAdapter(
+        pool_connections=settings.POOL_HOSTS,
+        pool_maxsize=settings.POOL_CONNECTIONS_PER_HOST,
+    )
+    adapter.poolmanager.pool_classes_by_scheme = connection_pool_classes()
+
+    new_session = requests.Session()
+    # The session is shared by every client and saga, so cookies one response sets
+    # must never be sent with anyone else's request.
+    new_session.cookies.set_policy(
+        http.cookiejar.DefaultCookiePolicy(allowed_domains=[])
+    )
+    new_session.mount("http://", adapter)
+    new_session.mount("https://", adapter)
+    return new_session
+
+
+def connection_pool_classes():
+    """
+    urllib3 connection pool classes, by scheme, whose connections resolve hostnames
+    through the DNS cache.
+    """
+
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    def resolving(connection_class):
+        class CachedDNSConnection(connection_class):
+            def _new_conn(self):
+                # Only the connect itself uses the cached address. The hostname is
+                # restored before TLS and the request, which need the real name.
+                host = self._dns_host
+                self._dns_host = dns_cache.resolve(host)
+                try:
+                    return super(CachedDNSConnection, self)._new_conn()
+                finally:
+                    self._dns_host = host
+
+        return CachedDNSConnection
+
+    class CachedDNSHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = resolving(HTTPConnection)
+
+    class CachedDNSHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = resolving(HTTPSConnection)
+
+    return {"http": CachedDNSHTTPConnectionPool, "https": CachedDNSHTTPSConnectionPool}
+
+
+def warm(hosts, connections=None):
+    """
+    Make sure `connections` connections to each of `hosts` are open and pooled.
+    Returns the number of open connections per host. Hosts that can't be reached
+    are logged and skipped - they will simply be connected to on first use.
+    """
+
+    if connections is None:
+        connections = settings.WARM_CONNECTIONS
+    connections = min(connections, settings.POOL_CONNECTIONS_PER_HOST)
+
+    # Imported here, since the transports are built on the pools in this module.
+    import transport
+
+    warmed = {}
+    for host in hosts:
+        try:
+            warmed[host] = transport.get().warm(host, connections)
+        except Exception as e:
+            logging.warning(f"Could not pre-warm connections to {host}: {e}")
+            warmed[host] = 0
+    return warmed
+
+
+class Warmer(object):
+    """
+    Keeps connections to the configured downstream hosts warm. `hosts` is called
+    on every round so that configuration reloads are picked up.
+    """
+
+    def __init__(self, hosts, interval=None):
+        self.hosts = hosts
+        self.interval = interval or settings.DNS_TTL_SECONDS
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, name="qbox-warmer", daemon=True).start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            warm(self.hosts())
+
+    def stop(self):
+        self.stopped.set()
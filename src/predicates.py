@@ -0,0 +1,140 @@
+"""
+Conditions on saga steps.
+
+A transaction with `when` only runs if its predicate holds, and one with `exitWhen`
+ends the saga successfully once it has succeeded and its predicate holds. Predicates
+are expressions over references to the saga, written like templates, e.g.
+
+    ${root.headers.X-Amount:0} >= 100 and ${root.headers.X-Country} != "US"
+    ${steps.quote.response.body.json.$.risk} in ["high", "unknown"]
+
+They support comparisons (including `in`), `and`, `or`, `not`, arithmetic, and
+string, number, list and `true`/`false`/`null` literals. Each reference is replaced by
+its value, read as JSON if it is valid JSON (so numbers compare as numbers) and as a
+string otherwise. References that resolve to nothing are `null`.
+
+Predicates are parsed and checked once, when the configuration is loaded, and compiled
+to Python code objects that only ever see the references' values.
+"""
+import ast
+import json
+import logging
+import functools
+from interpolate import REFERENCE_PATTERN, Reference, compile_template, as_text
+
+ALLOWED_NODES = (
+    ast.Expression,
+    ast.BoolOp,
+    ast.And,
+    ast.Or,
+    ast.UnaryOp,
+    ast.Not,
+    ast.USub,
+    ast.UAdd,
+    ast.BinOp,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.Mod,
+    ast.Compare,
+    ast.Eq,
+    ast.NotEq,
+    ast.Lt,
+    ast.LtE,
+    ast.Gt,
+    ast.GtE,
+    ast.In,
+    ast.NotIn,
+    ast.Constant,
+    ast.List,
+    ast.Tuple,
+    ast.Name,
+    ast.Load,
+)
+
+LITERALS = {"true": True, "false": False, "null": None}
+
+# The keys of configurations whose values are predicates.
+PREDICATE_KEYS = ("when", "exitWhen")
+
+
+class Predicate(object):
+    def __init__(self, expression, references, code):
+        self.expression = expression
+        self.references = references
+        self.code = code
+
+    def evaluate(self, parent, context):
+        """
+        Whether the predicate holds for the saga in `context`. Predicates that can't
+        be evaluated, e.g. because they compare a string to a number, don't hold.
+        """
+
+        values = dict(LITERALS)
+        for name, template in self.references.items():
+            values[name] = coerce(template.render(parent, context))
+
+        try:
+            return bool(eval(self.code, {"__builtins__": {}}, values))
+        except (TypeError, ArithmeticError) as e:
+            logging.warning(f"Could not evaluate {self.expression}: {e}")
+            return False
+
+
+def coerce(value):
+    value = as_text(value)
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+@functools.lru_cache(maxsize=None)
+def compile_predicate(expression):
+    """
+    Compile a predicate, raising ValueError if it isn't one.
+    """
+
+    references = {}
+
+    def substitute(match):
+        template = compile_template(match.group(0))
+        if not isinstance(template.parts[0], Reference):
+            raise ValueError(f"Invalid predicate {expression}: {match.group(0)}")
+        name = f"_{len(references)}"
+        references[name] = template
+        return f" {name} "
+
+    source = REFERENCE_PATTERN.sub(substitute, expression)
+
+    try:
+        tree = ast.parse(source.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Invalid predicate {expression}: {e.msg}")
+
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ValueError(
+                f"Invalid predicate {expression}: {type(node).__name__} not allowed"
+            )
+        if isinstance(node, ast.Name) and node.id not in references:
+            if node.id not in LITERALS:
+                raise ValueError(f"Invalid predicate {expression}: unknown {node.id}")
+
+    return Predicate(expression, references, compile(tree, expression, "eval"))
+
+
+def compile_predicates(configuration):
+    """
+    Compile the predicates of every step in the saga configurations, so that invalid
+    ones are reported when they are loaded.
+    """
+
+    for saga in configuration:
+        for transaction in saga["onMatchedRequest"]:
+            for key in PREDICATE_KEYS:
+                if key in transaction:
+                    compile_predicate(transaction[key])
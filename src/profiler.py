@@ -0,0 +1,190 @@
+"""
+On-demand sampling profiler for request handling.
+
+A profiling session is started from the admin profile endpoint, for a bounded number
+of seconds and a fraction of requests. Handler threads serving a sampled request are
+registered with the session, and a sampler thread takes a stack sample of each of them
+every few milliseconds. When the session ends, samples are written as collapsed stacks
+(one `frame;frame;frame count` line per distinct stack, outermost frame first) to a
+file in QBOX_PROFILE_DIR, ready for flamegraph.pl or speedscope.
+
+With no session running, a profiled function costs one extra call and a None check.
+"""
+import os
+import sys
+import time
+import random
+import logging
+import settings
+import functools
+import threading
+import collections
+
+SAMPLE_INTERVAL_SECONDS = 0.005
+MAX_SECONDS = 300
+
+
+def check(seconds, fraction):
+    """
+    Raise ValueError unless a session can run for `seconds` on `fraction` of requests.
+    """
+
+    if not 0 < seconds < float("inf"):
+        raise ValueError("seconds must be a finite number above 0")
+    if not 0 < fraction <= 1:
+        raise ValueError("fraction must be above 0 and at most 1")
+
+
+class Session(object):
+    def __init__(
+        self, seconds, fraction=1.0, interval=SAMPLE_INTERVAL_SECONDS, directory=None
+    ):
+        check(seconds, fraction)
+        self.seconds = min(seconds, MAX_SECONDS)
+        self.fraction = fraction
+        self.interval = interval
+        self.started = time.time()
+        self.path = os.path.join(
+            directory or settings.PROFILE_DIR,
+            f"qbox-profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.folded",
+        )
+        self.lock = threading.Lock()
+        self.threads = set()
+        self.stacks = collections.Counter()
+        self.requests = 0
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(
+            target=self.run, name="qbox-profiler", daemon=True
+        )
+
+    def start(self):
+        self.sampler.start()
+
+    def enter(self):
+        """
+        Decide whether the current request is profiled, and if so register its thread.
+        """
+
+        if random.random() >= self.fraction or self.stopped.is_set():
+            return False
+        with self.lock:
+            self.threads.add(threading.get_ident())
+            self.requests += 1
+        return True
+
+    def exit(self):
+        with self.lock:
+            self.threads.discard(threading.get_ident())
+
+    def sample(self):
+        with self.lock:
+            threads = list(self.threads)
+        if not threads:
+            return
+
+        frames = sys._current_frames()
+        for thread in threads:
+            frame = frames.get(thread)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+                self.samples += 1
+
+    def run(self):
+        deadline = time.monotonic() + self.seconds
+        while not self.stopped.wait(self.interval):
+            if time.monotonic() >= deadline:
+                break
+            self.sample()
+
+        self.stopped.set()
+        try:
+            self.write()
+            logging.info(f"Wrote {self.samples} profile samples to {self.path}")
+        except OSError as e:
+            logging.error(f"Could not write profile to {self.path}: {e}")
+
+    def stop(self):
+        """
+        End the session early and wait for the profile to be written.
+        """
+
+        self.stopped.set()
+        if self.sampler.is_alive():
+            self.sampler.join()
+
+    def write(self):
+        with open(self.path, "w") as profile:
+            for stack, count in self.stacks.most_common():
+                profile.write(f"{stack} {count}\n")
+
+    def snapshot(self):
+        return {
+            "active": not self.stopped.is_set(),
+            "started": self.started,
+            "seconds": self.seconds,
+            "fraction": self.fraction,
+            "requests": self.requests,
+            "samples": self.samples,
+            "path": self.path,
+        }
+
+
+def collapse(frame):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        frames.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def start(seconds, fraction=1.0, **kwargs):
+    """
+    Start a profiling session, unless one is already running. Returns the session
+    that is running.
+    """
+
+    global _session
+
+    check(seconds, fraction)
+    with _session_lock:
+        if _session is None or _session.stopped.is_set():
+            _session = Session(seconds, fraction, **kwargs)
+            _session.start()
+        return _session
+
+
+def stop():
+    with _session_lock:
+        session = _session
+    if session is not None:
+        session.stop()
+    return session
+
+
+def current():
+    return _session
+
+
+def profiled(function):
+    """
+    Profile calls of `function` while a session is running.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        session = _session
+        if session is None or session.stopped.is_set() or not session.enter():
+            return function(*args, **kwargs)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            session.exit()
+
+    return wrapper
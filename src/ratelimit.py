@@ -0,0 +1,180 @@
+"""
+Per-host rate limiting for downstream traffic originating from sagas.
+
+Limits are configured on transactions (`rateLimit`) and keyed by the host of the
+interpolated url, so every coordinator in the process sending to the same host
+shares one limiter, no matter which saga or transaction the traffic comes from.
+Configurations setting different limits for one host are rejected on load.
+
+Each host has two token buckets: one for forward transactions and one for
+compensating transactions. Compensations draw from their own bucket first and may
+borrow from the forward bucket when it runs dry, but forward traffic never borrows
+from the compensation bucket and always yields to compensations that are waiting.
+Rollback traffic therefore cannot be starved by new sagas against a recovering host.
+"""
+import time
+import threading
+from urllib.parse import urlsplit
+
+import metrics
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, now):
+        """
+        Seconds until the bucket holds a whole token.
+        """
+
+        self.refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class HostLimiter(object):
+    def __init__(self, configuration, clock=time.monotonic):
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.waiting_compensations = 0
+        self.throttled = 0
+        self.configuration = None
+        self.forward = None
+        self.compensation = None
+        self.configure(configuration)
+
+    def configure(self, configuration):
+        """
+        (Re)apply a `rateLimit` block. Called whenever a transaction references this
+        host, so that configuration reloads take effect without losing state.
+        """
+
+        if configuration == self.configuration:
+            return
+
+        with self.condition:
+            now = self.clock()
+            rate = configuration["requestsPerSecond"]
+            burst = configuration.get("burst", max(1, int(rate)))
+            compensation_rate = configuration.get("compensationsPerSecond", rate)
+            compensation_burst = configuration.get(
+                "compensationBurst", max(1, int(compensation_rate))
+            )
+
+            forward = TokenBucket(rate, burst, now)
+            compensation = TokenBucket(compensation_rate, compensation_burst, now)
+
+            # Carry spent tokens over, so that reconfiguring never hands out a fresh burst.
+            if self.forward is not None:
+                self.forward.refill(now)
+                self.compensation.refill(now)
+                forward.tokens = min(forward.tokens, self.forward.tokens)
+                compensation.tokens = min(compensation.tokens, self.compensation.tokens)
+
+            self.forward = forward
+            self.compensation = compensation
+            self.configuration = configuration
+            self.condition.notify_all()
+
+    def acquire(self, compensation=False, timeout=None):
+        """
+        Block until a request may be sent. Returns False if no token became
+        available within `timeout` seconds (None waits indefinitely).
+        """
+
+        deadline = None if timeout is None else self.clock() + timeout
+
+        with self.condition:
+            if compensation:
+                self.waiting_compensations += 1
+
+            try:
+                while True:
+                    now = self.clock()
+
+                    if compensation:
+                        if self.compensation.take(now) or self.forward.take(now):
+                            return True
+                        wait = min(
+                            self.compensation.wait_time(now),
+                            self.forward.wait_time(now),
+                        )
+                    elif self.waiting_compensations:
+                        # Woken up explicitly once the compensations are through.
+                        wait = None
+                    else:
+                        if self.forward.take(now):
+                            return True
+                        wait = self.forward.wait_time(now)
+
+                    if deadline is not None:
+                        if now >= deadline:
+                            self.throttled += 1
+                            return False
+                        remaining = deadline - now
+                        wait = remaining if wait is None else min(wait, remaining)
+
+                    self.condition.wait(wait)
+            finally:
+                if compensation:
+                    self.waiting_compensations -= 1
+                    self.condition.notify_all()
+
+    def snapshot(self):
+        with self.condition:
+            now = self.clock()
+            self.forward.refill(now)
+            self.compensation.refill(now)
+            return {
+                "forwardTokens": self.forward.tokens,
+                "compensationTokens": self.compensation.tokens,
+                "waitingCompensations": self.waiting_compensations,
+                "throttled": self.throttled,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter_for(url, configuration=None):
+    """
+    Returns the limiter for the host of `url`, creating or updating it from
+    `configuration` if one is given. Returns None if the host isn't rate limited.
+    """
+
+    host = urlsplit(url).netloc
+
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if configuration is None:
+            return limiter
+        if limiter is None:
+            limiter = _limiters[host] = HostLimiter(configuration)
+            return limiter
+
+    limiter.configure(configuration)
+    return limiter
+
+
+def snapshot():
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {host: limiter.snapshot() for host, limiter in limiters.items()}
+
+
+metrics.register("rateLimits", snapshot)
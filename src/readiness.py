@@ -0,0 +1,47 @@
+"""
+Readiness of the sidecar to take traffic.
+
+A pod should only receive requests once the work the first requests would otherwise
+pay for has been done. Startup registers each such piece of work as a condition
+before it starts, and marks it done when it finishes. The admin readiness endpoint
+answers 200 once nothing is pending and 503 until then, and 503 again once the sidecar
+starts draining for shutdown (see lifecycle.py).
+"""
+import threading
+
+
+class Readiness(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.done = set()
+        self.draining = False
+
+    def require(self, *conditions):
+        with self.lock:
+            self.pending.update(set(conditions) - self.done)
+
+    def mark(self, condition):
+        with self.lock:
+            self.pending.discard(condition)
+            self.done.add(condition)
+
+    def drain(self):
+        with self.lock:
+            self.draining = True
+
+    def is_ready(self):
+        with self.lock:
+            return not self.pending and not self.draining
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "ready": not self.pending and not self.draining,
+                "pending": sorted(self.pending),
+                "done": sorted(self.done),
+                "draining": self.draining,
+            }
+
+
+readiness = Readiness()
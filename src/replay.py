@@ -0,0 +1,237 @@
+"""
+Replay a capture file (see capture.py) against a running Qbox.
+
+    python3 replay.py capture.bin --target http://localhost:3001 --speed 4
+
+This starts a local stub that answers downstream requests with the responses that
+were recorded for them, then replays the recorded inbound requests against
+`--target` with their original spacing divided by `--speed` (0 sends them as fast
+as possible). Point the Qbox under test at the stub by starting it with
+`QBOX_HTTP_PROXY=http://127.0.0.1:<stub port>`, which every transport honours, so that
+both saga transactions and pass-through traffic end up there. Traffic to https://
+urls isn't proxied, so captures of it can't be replayed safely.
+
+When it finishes it prints the number of requests replayed, errors, and latency
+percentiles, so runs before and after a change can be compared.
+"""
+import sys
+import time
+import json
+import argparse
+import threading
+import collections
+import http.client
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from capture import INBOUND, DOWNSTREAM, read_records, decode_headers
+
+HOP_BY_HOP_HEADERS = {"connection", "transfer-encoding", "content-length"}
+
+
+class RecordedResponses(object):
+    """
+    Recorded downstream responses, keyed by (method, url). Responses for the same key
+    are served in the order they were recorded, and the last one is repeated once
+    they run out.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses = collections.defaultdict(collections.deque)
+
+    def add(self, method, url, status, headers, body):
+        self.responses[(method, url)].append((status, headers, body))
+
+    def next(self, method, url):
+        with self.lock:
+            queue = self.responses.get((method, url))
+            if not queue:
+                return None
+            if len(queue) > 1:
+                return queue.popleft()
+            return queue[0]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def handle_one_request(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            return
+        self.respond()
+        self.wfile.flush()
+
+    def respond(self):
+        length = int(self.headers.get("content-length", 0))
+        if length:
+            self.rfile.read(length)
+
+        # Requests arrive in proxy form (absolute url) when we are QBOX_HTTP_PROXY.
+        if self.path.startswith("http://") or self.path.startswith("https://"):
+            url = self.path
+        else:
+            url = f"http://{self.headers['Host']}{self.path}"
+
+        recorded = self.server.responses.next(self.command, url)
+        if recorded is None:
+            self.send_error(502, f"Nothing recorded for {self.command} {url}")
+            return
+
+        status, headers, body = recorded
+        self.send_response(status)
+        for name, value in headers:
+            if name.lower() not in HOP_BY_HOP_HEADERS:
+                self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, responses):
+        super(StubServer, self).__init__(address, StubHandler)
+        self.responses = responses
+
+
+def load(path):
+    """
+    Returns the recorded downstream responses and the list of inbound requests as
+    (timestamp, method, path, headers, body) tuples in recorded order.
+    """
+
+    responses = RecordedResponses()
+    inbound = []
+
+    for record in read_records(path):
+        if record.kind == INBOUND:
+            _, method, request_path, headers, body = record.fields
+            inbound.append(
+                (
+                    record.timestamp,
+                    method.decode("ascii"),
+                    request_path.decode("latin-1"),
+                    decode_headers(headers),
+                    body,
+                )
+            )
+        elif record.kind == DOWNSTREAM:
+            _, method, url, status, headers, body = record.fields
+            responses.add(
+                method.decode("ascii"),
+                url.decode("latin-1"),
+                int(status),
+                decode_headers(headers),
+                body,
+            )
+
+    return responses, inbound
+
+
+def send(target, method, path, headers, body):
+    connection = http.client.HTTPConnection(target.hostname, target.port or 80)
+    try:
+        connection.putrequest(method, path, skip_host=True, skip_accept_encoding=True)
+        for name, value in headers:
+            if name.lower() not in HOP_BY_HOP_HEADERS:
+                connection.putheader(name, value)
+        connection.putheader("Content-Length", str(len(body)))
+        connection.endheaders(body)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def replay(inbound, target, speed=1.0, concurrency=64):
+    """
+    Replay inbound requests against `target`. Returns a summary dict.
+    """
+
+    target = urlsplit(target)
+    latencies = []
+    errors = collections.Counter()
+    lock = threading.Lock()
+
+    def run(method, path, headers, body):
+        start = time.monotonic()
+        try:
+            status = send(target, method, path, headers, body)
+        except OSError as e:
+            with lock:
+                errors[type(e).__name__] += 1
+            return
+        elapsed = (time.monotonic() - start) * 1000
+        with lock:
+            latencies.append(elapsed)
+            if status >= 500:
+                errors[str(status)] += 1
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        first = inbound[0][0] if inbound else 0
+        for timestamp, method, path, headers, body in inbound:
+            if speed > 0:
+                delay = (timestamp - first) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            executor.submit(run, method, path, headers, body)
+    duration = time.monotonic() - started
+
+    latencies.sort()
+
+    def percentile(p):
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+    return {
+        "requests": len(inbound),
+        "completed": len(latencies),
+        "errors": dict(errors),
+        "durationSeconds": duration,
+        "latencyMs": {
+            "p50": percentile(0.5),
+            "p90": percentile(0.9),
+            "p99": percentile(0.99),
+            "max": latencies[-1] if latencies else None,
+        },
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("capture", help="capture file written with QBOX_CAPTURE_PATH")
+    parser.add_argument("--target", default="http://127.0.0.1:3001")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--stub-address", default="127.0.0.1")
+    parser.add_argument("--stub-port", type=int, default=3101)
+    args = parser.parse_args(argv)
+
+    responses, inbound = load(args.capture)
+
+    stub = StubServer((args.stub_address, args.stub_port), responses)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    try:
+        summary = replay(inbound, args.target, args.speed, args.concurrency)
+    finally:
+        stub.shutdown()
+
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,230 @@
+"""
+Routing of inbound requests to saga configurations.
+
+`matchRequest.url` may be a path template rather than a literal url:
+
+    http://orders.svc/orders/{id}            `{id}` matches exactly one path segment
+    http://orders.svc/orders/{id}/items/*    `*` matches the rest of the path
+    http://orders.svc/files/{path*}          ... and `{name*}` captures it as `name`
+
+Captured parameters are available to interpolation as `${root.path.<name>}`.
+
+Routes are kept in a trie of path segments per host, built once when the
+configuration is loaded, so a lookup costs one walk down the request path rather
+than a comparison against every configured saga. A query string in a template must
+match the request's query string exactly.
+
+The headers and body `matchRequest` requires are compiled alongside the routes (see
+ContentMatch), and checked against an inbound request whose headers are normalized
+once (see Inbound), so sagas told apart by headers stay cheap to match however many
+there are.
+"""
+import zlib
+from urllib.parse import urlsplit
+
+from spool import SpooledBody
+from interpolate import as_bytes
+
+
+class RouteNode(object):
+    def __init__(self):
+        self.static = {}
+        self.parameter = None
+        self.wildcard = []
+        self.routes = []
+
+
+class Route(object):
+    def __init__(self, index, method, query, parameter_names, wildcard_name=None):
+        self.index = index
+        self.method = method
+        self.query = query
+        self.parameter_names = parameter_names
+        self.wildcard_name = wildcard_name
+
+
+def split_url(url):
+    """
+    Split a url into (host, path segments, query). Urls without a scheme are taken
+    to be http, the same as the rest of Qbox does.
+    """
+
+    if "://" not in url:
+        url = f"http://{url}"
+
+    parts = urlsplit(url)
+    segments = [segment for segment in parts.path.split("/") if segment]
+    return parts.netloc.lower(), segments, parts.query
+
+
+def parse_segment(segment):
+    """
+    Returns ("static", segment), ("parameter", name) or ("wildcard", name).
+    """
+
+    if segment == "*":
+        return "wildcard", None
+    if segment.startswith("{") and segment.endswith("}"):
+        name = segment[1:-1]
+        if name.endswith("*"):
+            return "wildcard", name[:-1]
+        return "parameter", name
+    return "static", segment
+
+
+def checksum(body):
+    if isinstance(body, SpooledBody):
+        value = 0
+        for chunk in body.chunks():
+            value = zlib.crc32(chunk, value)
+        return value
+    return zlib.crc32(body)
+
+
+class Inbound(object):
+    """
+    An inbound request as content matching sees it: headers in a dict by lowercase
+    name (the first of repeated headers wins, as with `Message.get`), and the body with
+    its checksum computed the first time a candidate needs it.
+    """
+
+    def __init__(self, headers, body):
+        self.headers = {}
+        for name, value in headers.items():
+            self.headers.setdefault(name.lower(), value)
+        self.body = body
+        self.body_checksum = None
+
+    def checksum(self):
+        if self.body_checksum is None:
+            self.body_checksum = checksum(self.body)
+        return self.body_checksum
+
+
+class ContentMatch(object):
+    """
+    The headers and body a `matchRequest` requires. Header names are lowercased once,
+    and bodies are told apart by length and checksum before being compared in full.
+    """
+
+    def __init__(self, headers, body):
+        self.headers = tuple((name.lower(), value) for name, value in headers.items())
+        self.body = as_bytes(body) if body else None
+        self.length = len(self.body) if self.body else 0
+        self.checksum = checksum(self.body) if self.body else None
+
+    def matches(self, inbound):
+        headers = inbound.headers
+        for name, value in self.headers:
+            if headers.get(name) != value:
+                return False
+
+        if self.body is None:
+            return True
+        return (
+            len(inbound.body) == self.length
+            and inbound.checksum() == self.checksum
+            and inbound.body == self.body
+        )
+
+
+class Router(object):
+    def __init__(self):
+        self.hosts = {}
+        self.content = {}
+
+    @classmethod
+    def from_configurations(cls, configurations):
+        router = cls()
+        for index, configuration in enumerate(configurations):
+            match = configuration["matchRequest"]
+            router.add(index, match["method"], match["url"])
+            if match.get("headers") or match.get("body"):
+                router.content[index] = ContentMatch(
+                    match.get("headers", {}), match.get("body", "")
+                )
+        return router
+
+    def matches_content(self, index, inbound):
+        """
+        Whether an inbound request has the headers and body configuration `index`
+        requires.
+        """
+
+        content = self.content.get(index)
+        return content is None or content.matches(inbound)
+
+    def add(self, index, method, url):
+        host, segments, query = split_url(url)
+        node = self.hosts.setdefault(host, RouteNode())
+        parameter_names = []
+
+        for position, segment in enumerate(segments):
+            kind, name = parse_segment(segment)
+
+            if kind == "wildcard":
+                if position != len(segments) - 1:
+                    raise ValueError(f"Wildcards must end the path in {url}")
+                node.wildcard.append(
+                    Route(index, method, query, parameter_names, wildcard_name=name)
+                )
+                return
+
+            if kind == "parameter":
+                if node.parameter is None:
+                    node.parameter = RouteNode()
+                node = node.parameter
+                parameter_names.append(name)
+            else:
+                node = node.static.setdefault(name, RouteNode())
+
+        node.routes.append(Route(index, method, query, parameter_names))
+
+    def match(self, method, url):
+        """
+        Returns a list of (configuration index, path parameters) for every route
+        matching the request, in configuration order.
+        """
+
+        host, segments, query = split_url(url)
+        root = self.hosts.get(host)
+        if root is None:
+            return []
+
+        matches = []
+        self.collect(root, segments, 0, [], method, query, matches)
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+    def collect(self, node, segments, position, values, method, query, matches):
+        for route in node.wildcard:
+            if route.method == method and route.query == query:
+                parameters = dict(zip(route.parameter_names, values))
+                if route.wildcard_name:
+                    parameters[route.wildcard_name] = "/".join(segments[position:])
+                matches.append((route.index, parameters))
+
+        if position == len(segments):
+            for route in node.routes:
+                if route.method == method and route.query == query:
+                    matches.append(
+                        (route.index, dict(zip(route.parameter_names, values)))
+                    )
+            return
+
+        segment = segments[position]
+
+        child = node.static.get(segment)
+        if child is not None:
+            self.collect(child, segments, position + 1, values, method, query, matches)
+
+        if node.parameter is not None:
+            self.collect(
+                node.parameter,
+                segments,
+                position + 1,
+                values + [segment],
+                method,
+                query,
+                matches,
+            )
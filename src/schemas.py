@@ -0,0 +1,202 @@
+""" 
+This file defines the structure of the configuration Qbox uses. 
+
+We perform schema validation for the entire configuration. This is 
+basically the power of protobufs without needing to use protobufs. We
+use the schema library (https://github.com/keleshev/schema) for this.
+
+See test_configuration.py for example configurations.
+"""
+from schema import Schema, And, Or, Optional, Const, Regex, SchemaError
+from pool import downstream_host
+
+# All messages need to have a source address and a destination address.
+# These addresses should resolve using cluster DNS.
+# Messages may optionally include a list of headers as string key/value pairs.
+# and an optional body. How these headers and bodies are included in new values
+# is dependent on where the message is defined in the schema - `matchRequest` messages
+# have different behaviour than `onFailue` messages.
+HTTP_REQUEST_SCHEMA = Schema(
+    {
+        "method": lambda t: t in ["GET", "HEAD", "PUT", "PATCH", "DELETE", "POST"],
+        "url": str,
+        Optional("headers"): Schema(Or({str: str}, {})),
+        Optional("body"): str,
+    },
+    ignore_extra_keys=True,
+)
+
+HTTP_RESPONSE_SCHEMA = Schema(
+    {
+        "status-code": int,
+        Optional("headers"): Schema(Or({str: str}, {})),
+        Optional("body"): str,
+    },
+    ignore_extra_keys=True,
+)
+
+# Some messages are part of a transaction. Such transactions need to specify a timeout,
+# a number of times to retry on a timeout, and a compensating transaction (marked in "onFailure").
+#
+# Messages in `onFailure` will always inherit headers/bodies from their parent message - if headers
+# and bodies are specified under `onFailure`, then headers will be upserted and bodies will be
+# overwritten.
+#
+# Messages in `matchSuccessRequest` are what responses are compared to to mark the transaction
+# as succeeded. Any response that does not match that criteria is automatic grounds for the
+# transaction as a whole to fail.
+
+# Transactions may opt in to micro-batching. Sagas that reach the same transaction (same
+# method, interpolated url and headers) within `maxWaitMs` milliseconds are collected,
+# up to `maxItems` at a time, and sent downstream as one request whose body is a JSON
+# array of the individual bodies. See batching.py for how responses are handed back.
+BATCH_SCHEMA = Schema(
+    {
+        "maxItems": And(int, lambda maxItems: maxItems >= 1),
+        "maxWaitMs": And(int, lambda maxWaitMs: maxWaitMs >= 0),
+    }
+)
+
+# Transactions may rate limit the traffic sagas send to their destination host. Limits
+# apply per host across every saga in the process. Compensating transactions get their
+# own budget (defaulting to the forward one), and may borrow from the forward budget
+# but never the other way round. See ratelimit.py.
+RATE_LIMIT_SCHEMA = Schema(
+    {
+        "requestsPerSecond": And(Or(int, float), lambda rate: rate > 0),
+        Optional("burst"): And(int, lambda burst: burst >= 1),
+        Optional("compensationsPerSecond"): And(Or(int, float), lambda rate: rate > 0),
+        Optional("compensationBurst"): And(int, lambda burst: burst >= 1),
+    }
+)
+
+# Transactions may be given a `name` that is unique within their saga, so that templates
+# can refer to them as `${steps.<name>...}` instead of by position.
+STEP_NAME_SCHEMA = Schema(Regex(r"^[A-Za-z0-9_\-]+$"))
+
+# Transactions may also be conditional. A transaction with a `when` predicate is skipped
+# (and never compensated) unless it holds, and one with `exitWhen` ends the saga
+# successfully after it succeeds if that holds. See predicates.py.
+
+# Timeouts are in seconds, or `adaptive` to derive each attempt's timeout from the
+# latency observed from the destination host: the `quantile` of recent latencies times
+# `multiplier`, bounded by `minSeconds` and `maxSeconds`. See latency.py.
+TIMEOUT_SCHEMA = Or(And(int, lambda timeout: timeout >= 0), "adaptive")
+
+ADAPTIVE_TIMEOUT_SCHEMA = Schema(
+    {
+        Optional("quantile"): And(Or(int, float), lambda quantile: 0 < quantile < 1),
+        Optional("multiplier"): And(Or(int, float), lambda multiplier: multiplier > 0),
+        Optional("minSeconds"): And(Or(int, float), lambda seconds: seconds > 0),
+        Optional("maxSeconds"): And(Or(int, float), lambda seconds: seconds > 0),
+    }
+)
+
+COMPENSATING_TRANSACTION_SCHEMA = And(
+    Const(
+        HTTP_REQUEST_SCHEMA,
+        Schema(
+            {
+                "timeout": TIMEOUT_SCHEMA,
+                Optional("adaptiveTimeout"): ADAPTIVE_TIMEOUT_SCHEMA,
+                Optional("maxRetriesOnTimeout"): And(
+                    int, lambda maxRetries: maxRetries >= 0
+                ),
+                "isSuccessIfReceives": Schema([HTTP_RESPONSE_SCHEMA]),
+                Optional("shadowResponse"): HTTP_RESPONSE_SCHEMA,
+                Optional("rateLimit"): RATE_LIMIT_SCHEMA,
+            },
+            ignore_extra_keys=True,
+        ),
+    ),
+)
+
+TRANSACTION_SCHEMA = And(
+    Const(
+        HTTP_REQUEST_SCHEMA,
+        Schema(
+            {
+                "timeout": TIMEOUT_SCHEMA,
+                Optional("adaptiveTimeout"): ADAPTIVE_TIMEOUT_SCHEMA,
+                Optional("maxRetriesOnTimeout"): And(
+                    int, lambda maxRetries: maxRetries >= 0
+                ),
+                "onFailure": Schema([COMPENSATING_TRANSACTION_SCHEMA]),
+                "isSuccessIfReceives": Schema([HTTP_RESPONSE_SCHEMA]),
+                Optional("name"): STEP_NAME_SCHEMA,
+                Optional("when"): str,
+                Optional("exitWhen"): str,
+                Optional("batch"): BATCH_SCHEMA,
+                Optional("shadowResponse"): HTTP_RESPONSE_SCHEMA,
+                Optional("rateLimit"): RATE_LIMIT_SCHEMA,
+            },
+            ignore_extra_keys=True,
+        ),
+    ),
+)
+
+
+def has_unique_names(transactions):
+    names = [t["name"] for t in transactions if "name" in t]
+    return len(names) == len(set(names)) and all(map(STEP_NAME_SCHEMA.is_valid, names))
+
+
+# A saga may run in a bulkhead of its own, shared with the sagas for the same `host`
+# (or bulkhead `name`), that limits how many of them run and queue at once and how many
+# requests they have outstanding downstream. See bulkhead.py.
+BULKHEAD_SCHEMA = Schema(
+    {
+        Optional("name"): str,
+        Optional("maxConcurrentSagas"): And(int, lambda limit: limit >= 1),
+        Optional("maxQueuedSagas"): And(int, lambda limit: limit >= 0),
+        Optional("queueTimeout"): And(Or(int, float), lambda seconds: seconds >= 0),
+        Optional("maxConnections"): And(int, lambda limit: limit >= 1),
+    }
+)
+
+# A saga marked `shadow` is dry-run in the background instead of answering the client,
+# which keeps going through the normal pass-through path. Downstream requests go to
+# `mirror` if one is set, and are otherwise answered from each transaction's
+# `shadowResponse` (or its first `isSuccessIfReceives`). See shadow.py.
+SHADOW_SCHEMA = Or(bool, Schema({Optional("mirror"): str}))
+
+# The root of our configuration. The list of headers, bodies, etc. supplied in `matchRequest`
+# will be used to match the request to initiate the saga workflow.
+ROOT_SCHEMA = Schema(
+    {
+        "host": str,
+        "matchRequest": HTTP_REQUEST_SCHEMA,
+        "onMatchedRequest": And(Schema([TRANSACTION_SCHEMA]), has_unique_names),
+        Optional("onAllSucceeded"): HTTP_RESPONSE_SCHEMA,
+        Optional("onAnyFailed"): HTTP_RESPONSE_SCHEMA,
+        Optional("shadow"): SHADOW_SCHEMA,
+        Optional("bulkhead"): BULKHEAD_SCHEMA,
+        # Which failed sagas are compensated first by the outbox (see outbox.py).
+        Optional("compensationPriority"): int,
+    },
+    ignore_extra_keys=True,
+)
+
+
+def has_consistent_rate_limits(configurations):
+    """
+    Limits are kept per host, so every transaction to a host that sets a `rateLimit`
+    must set the same one - otherwise the host's limiter would be reconfigured back and
+    forth between them. Hosts only known once a saga runs can't be checked.
+    """
+
+    limits = {}
+    for configuration in configurations:
+        for transaction in configuration["onMatchedRequest"]:
+            for step in [transaction] + transaction["onFailure"]:
+                host = downstream_host(step["url"])
+                if host is None or "rateLimit" not in step:
+                    continue
+                host = host.partition("://")[2]
+                if limits.setdefault(host, step["rateLimit"]) != step["rateLimit"]:
+                    raise SchemaError(f"Conflicting rateLimit blocks for {host}")
+    return True
+
+
+# Every document of the configuration file.
+CONFIGURATIONS_SCHEMA = And(Schema([ROOT_SCHEMA]), has_consistent_rate_limits)
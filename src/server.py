@@ -1,21 +1,57 @@
+import json
+import pool
+import spool
+import settings
+import transport
+import events
+import leases
+import statestore
+import capture
+import lifecycle
+import coalesce
+import bulkhead
 import logging
-import requests
+import metrics
+import profiler
+import threading
 from functools import partial
-from interpolate import interpolate
+from urllib.parse import urlsplit, parse_qs
+from interpolate import interpolate, as_bytes
+from router import Inbound
 from configuration import ConfigurationStore
 from coordinator import SagaCoordinator, RequestNode, ENVOY_ADDRESS
-from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from shadow import recorder as shadow_recorder
+from readiness import readiness
+from http.server import SimpleHTTPRequestHandler
 
 logging.basicConfig(level=logging.DEBUG)
 
 ADDRESS = "0.0.0.0"
 PORT = 3001
 
+# Requests under this path for one of QBOX_ADMIN_HOSTS are answered by Qbox itself
+# instead of being proxied.
+ADMIN_PREFIX = "/_qbox"
+
+# How long a long poll of the events endpoint waits for an event by default, and how
+# often an event stream sends a comment to keep idle connections open.
+EVENTS_POLL_SECONDS = 30
+EVENTS_KEEPALIVE_SECONDS = 15
+
+# How long a profile started from the admin endpoint runs for by default.
+PROFILE_SECONDS = 30
+
 
 class RequestHandler(SimpleHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
         self.body = None
-        self.configurations = ConfigurationStore().get_config()
+        self.inbound = None
+        self.capture_id = None
+        self.matches = None
+        self.path_parameters = {}
+        store = ConfigurationStore()
+        self.configurations = store.get_config()
+        self.router = store.get_router()
         logging.info(f"Configurations == {self.configurations}")
         super(RequestHandler, self).__init__(*args, **kwargs)
 
@@ -50,73 +86,265 @@ class RequestHandler(SimpleHTTPRequestHandler):
         content_len = int(self.headers.get("content-length", 0))
         if self.body:
             return self.body
-        body = self.rfile.read(content_len)
+        body = spool.read(self.rfile, content_len, limit=settings.MAX_BODY_BYTES)
         self.body = body
         return self.body
 
+    def end_headers(self):
+        # Send clients of a draining sidecar elsewhere for their next request.
+        if lifecycle.in_flight.draining:
+            self.send_header("Connection", "close")
+        super(RequestHandler, self).end_headers()
+
+    @profiler.profiled
     def handle_connection(self):
+        if self.path.startswith(ADMIN_PREFIX) and self.is_admin_request():
+            return self.handle_admin()
+
+        with lifecycle.in_flight.track():
+            return self.handle_request()
+
+    def handle_request(self):
+        try:
+            self.get_body()
+        except spool.BodyTooLarge as e:
+            # The body is left unread, so the connection can't be used again.
+            self.close_connection = True
+            return self.send_error(413, str(e))
+
         logging.info(f"Handling request {self.headers} {self.get_body()}")
+        self.capture_id = capture.record_inbound(
+            self.command, self.path, self.headers, self.get_body()
+        )
+
         if self.configurations:
+            self.run_shadow_sagas()
             is_request, configuration_index = self.is_saga_request()
             if is_request:
                 logging.info("Identified a transaction request!")
-                status, headers, body = self.execute(configuration_index)
+                try:
+                    status, headers, body = self.execute(configuration_index)
+                except bulkhead.BulkheadFull as e:
+                    return self.send_error(503, str(e))
                 self.send_response(status)
                 for header, value in headers.items():
                     self.send_header(header, value)
                 self.end_headers()
-                self.wfile.write(body.encode("utf-8"))
+                spool.write(self.wfile, as_bytes(body))
                 return
 
         logging.info("Decided it was not a transaction")
         url = self.headers["Host"]
+        # NOTE: We're assuming HTTPS traffic is never sent to us!
+        # This is fine for our proof-of-concept - Envoy in practice
+        # automatically upgrades all HTTP traffic to HTTPS if configured
+        # to do so with the appropriate TLS certificates.
+        url = url if url.startswith("http://") else f"http://{url}"
+        url = f"{url}{self.path}"
+
         try:
             logging.info(f"Sending request to {url}")
-            response = requests.request(
-                method=self.command,
-                # NOTE: We're assuming HTTPS traffic is never sent to us!
-                # This is fine for our proof-of-concept - Envoy in practice
-                # automatically upgrades all HTTP traffic to HTTPS if configured
-                # to do so with the appropriate TLS certificates.
-                url=url if url.startswith("http://") else f"http://{url}",
+            send = partial(
+                transport.get().request,
+                self.command,
+                url,
                 headers=self.headers,
-                data=self.get_body(),
-                # proxies={"http": ENVOY_ADDRESS, "https": ENVOY_ADDRESS},
+                body=self.get_body(),
+            )
+            response = coalesce.get().fetch(
+                self.command, url, self.headers, self.get_body(), send
             )
+            capture.record_downstream(self.capture_id, self.command, url, response)
             logging.info(f"Got response back of {response.status_code}")
             self.send_response(response.status_code)
             for header, value in response.headers.items():
                 self.send_header(header, value)
             self.end_headers()
-            self.wfile.write(response.content)
+            spool.write(self.wfile, response.content)
         except Exception as e:
             self.send_error(599, "Error proxying: {}".format(e))
 
     def is_saga_request(self):
 
         logging.info("Checking if Saga request...")
-        for index, configuration in enumerate(self.configurations):
-            config = configuration["matchRequest"]
-            headers = config.get("headers", {})
-            body = config.get("body", "")
+        for index, path_parameters in self.matching_sagas():
+            if self.configurations[index].get("shadow"):
+                continue
+            self.path_parameters = path_parameters
+            return (True, index)
+        return (False, None)
 
-            constructed_url = f"{self.headers['Host']}{self.path}"
-            if not constructed_url.startswith("http://"):
-                constructed_url = f"http://{constructed_url}"
+    def matching_sagas(self):
+        """
+        Every saga configuration matching this request, in configuration order, as
+        (index, path parameters) pairs. Candidates come from the router, which only
+        considers the url and method, and are then checked against headers and body.
+        """
 
-            if config["url"] != constructed_url:
-                continue
-            if config["method"] != self.command:
-                continue
-            if headers and any(
-                self.headers.get(header) != value for header, value in headers.items()
-            ):
-                continue
-            if body and self.get_body() != body:
+        if self.matches is not None:
+            return self.matches
+
+        constructed_url = f"{self.headers['Host']}{self.path}"
+        if not constructed_url.startswith("http://"):
+            constructed_url = f"http://{constructed_url}"
+
+        self.matches = [
+            (index, path_parameters)
+            for index, path_parameters in self.router.match(
+                self.command, constructed_url
+            )
+            if self.matches_content(index)
+        ]
+        return self.matches
+
+    def matches_content(self, index):
+        if self.inbound is None:
+            self.inbound = Inbound(self.headers, self.get_body())
+        return self.router.matches_content(index, self.inbound)
+
+    def run_shadow_sagas(self):
+        """
+        Kick off a background dry run for every matching saga in shadow mode.
+        These never affect how the request itself is handled.
+        """
+
+        matches = dict(self.matching_sagas())
+
+        for index, configuration in enumerate(self.configurations):
+            if not configuration.get("shadow"):
                 continue
 
-            return (True, index)
-        return (False, None)
+            matched = index in matches
+            shadow_recorder.observe(configuration, matched)
+            if matched:
+                shadow_recorder.submit(
+                    configuration,
+                    self.headers,
+                    self.get_body(),
+                    path_parameters=matches[index],
+                )
+
+    def is_admin_request(self):
+        """
+        Whether the request is addressed to the sidecar itself rather than to a service
+        behind it.
+        """
+
+        host = self.headers["Host"] or ""
+        try:
+            hostname = urlsplit(host if "://" in host else f"//{host}").hostname
+        except ValueError:
+            return False
+        admin_hosts = {name.lower() for name in coalesce.split(settings.ADMIN_HOSTS)}
+        return hostname is not None and hostname in admin_hosts
+
+    def handle_admin(self):
+        routes = {
+            ("GET", f"{ADMIN_PREFIX}/metrics"): self.respond_metrics,
+            ("GET", f"{ADMIN_PREFIX}/ready"): self.respond_readiness,
+            ("GET", f"{ADMIN_PREFIX}/events"): self.respond_events,
+            ("GET", f"{ADMIN_PREFIX}/profile"): self.respond_profile,
+            ("POST", f"{ADMIN_PREFIX}/profile"): self.start_profile,
+            ("DELETE", f"{ADMIN_PREFIX}/profile"): self.stop_profile,
+        }
+
+        route = routes.get((self.command, self.path.split("?", 1)[0]))
+        if route is None:
+            return self.send_error(404, "No such admin endpoint")
+        return route()
+
+    def respond_metrics(self):
+        self.respond_json(200, metrics.snapshot())
+
+    def respond_readiness(self):
+        state = readiness.snapshot()
+        self.respond_json(200 if state["ready"] else 503, state)
+
+    def respond_events(self):
+        """
+        Saga progress events, for the saga given by `?transaction=` or all of them. As
+        a stream of server-sent events if the client accepts them, or else as a long
+        poll: the events after `?since=` (a sequence number), waiting up to
+        `?timeout=` seconds for the first one.
+        """
+
+        query = parse_qs(urlsplit(self.path).query)
+        transaction = query.get("transaction", [None])[0]
+        since = self.headers.get("Last-Event-ID") or query.get("since", [None])[0]
+        try:
+            since = int(since) if since else None
+            timeout = float(query.get("timeout", [EVENTS_POLL_SECONDS])[0])
+        except ValueError:
+            return self.send_error(400, "since must be an integer, timeout a number")
+        if not 0 <= timeout < float("inf"):
+            return self.send_error(400, "timeout must be a finite number, at least 0")
+
+        if "text/event-stream" in self.headers.get("Accept", ""):
+            return self.stream_events(transaction, since)
+
+        with events.bus.subscribe(transaction, since) as subscription:
+            published = subscription.get(timeout)
+        self.respond_json(200, {"events": published, "dropped": subscription.dropped})
+
+    def stream_events(self, transaction, since):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        with events.bus.subscribe(transaction, since) as subscription:
+            while True:
+                published = subscription.get(EVENTS_KEEPALIVE_SECONDS)
+                try:
+                    if not published:
+                        self.wfile.write(b": keep-alive\n\n")
+                    for event in published:
+                        self.wfile.write(
+                            f"id: {event['sequence']}\nevent: {event['type']}\n"
+                            f"data: {json.dumps(event)}\n\n".encode("utf-8")
+                        )
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+
+                # The stream of a single saga ends with it.
+                if transaction and any(e["type"] == "finished" for e in published):
+                    return
+
+    def respond_profile(self):
+        session = profiler.current()
+        self.respond_json(200, session.snapshot() if session else {"active": False})
+
+    def start_profile(self):
+        """
+        Profile `?fraction=` of the requests (all by default) for the next `?seconds=`
+        seconds (PROFILE_SECONDS by default). See profiler.py.
+        """
+
+        query = parse_qs(urlsplit(self.path).query)
+        try:
+            seconds = float(query.get("seconds", [PROFILE_SECONDS])[0])
+            fraction = float(query.get("fraction", [1.0])[0])
+        except ValueError:
+            return self.send_error(400, "seconds and fraction must be numbers")
+
+        try:
+            session = profiler.start(seconds, fraction)
+        except ValueError as e:
+            return self.send_error(400, str(e))
+        self.respond_json(202, session.snapshot())
+
+    def stop_profile(self):
+        session = profiler.stop()
+        self.respond_json(200, session.snapshot() if session else {"active": False})
+
+    def respond_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
     def execute(self, index):
         """
@@ -127,33 +355,84 @@ class RequestHandler(SimpleHTTPRequestHandler):
             self.configurations[index],
             start_request_headers=self.headers,
             start_request_body=self.get_body(),
+            path_parameters=self.path_parameters,
+            capture_id=self.capture_id,
         )
-        success, transactions, failed_compensations = coordinator.execute_saga()
-        context = {
-            "parent": RequestNode(),
-            "root": coordinator.root,
-            "transactions": transactions,
-        }
+        with bulkhead.admitted(self.configurations[index]):
+            success, transactions, failed_compensations = coordinator.execute_saga()
+        context = {"parent": RequestNode(), "context": coordinator.context}
+
+        configuration = self.configurations[index]
+        outcome = configuration["onAllSucceeded" if success else "onAnyFailed"]
+        status, headers, body = self.respond(outcome, context)
 
-        if success:
-            return self.respond(self.configurations[index]["onAllSucceeded"], context)
-        else:
-            return self.respond(self.configurations[index]["onAnyFailed"], context)
+        # Let callers follow up on the saga, e.g. on the events endpoint.
+        headers.setdefault("X-Qbox-TransactionID", coordinator.identifier)
+        return status, headers, body
 
     def respond(self, config, context):
 
         headers = {}
-        for header, value in config.get("headers", {}):
+        for header, value in config.get("headers", {}).items():
             headers[header] = interpolate(value, **context)
-        body = interpolate(config.get("body", ""), **context)
-        return config["status-code"], headers, body
+        body = interpolate(config.get("body", ""), body=True, **context)
+        return config["status-code"], headers, as_bytes(body)
+
+
+def warm_up(drain):
+    """
+    Do the work that the first requests would otherwise pay for, then report ready.
+    Runs in the background so that the listening socket (and the readiness endpoint)
+    come up immediately.
+    """
+
+    store = ConfigurationStore()
+    logging.info(f"Loaded {len(store.get_config())} saga configurations")
+    readiness.mark("configuration")
+
+    # The outbound HTTP client is imported lazily everywhere else.
+    transport.get()
+    readiness.mark("transport")
+
+    hosts = store.get_hosts()
+    warmed = [host for host, connections in pool.warm(hosts).items() if connections]
+    logging.info(
+        f"Pre-warmed connections to {len(warmed)}/{len(hosts)} downstream hosts"
+    )
+    readiness.mark("pools")
+
+    # Connections get closed by idle timeouts and DNS records change, so keep at it.
+    pool.Warmer(lambda: ConfigurationStore().get_hosts()).start()
+
+    # Only a store other replicas write to can hold sagas for us to take over.
+    if statestore.store.shared:
+        leases.keeper.hold(leases.replica_lease(leases.keeper.owner))
+        leases.keeper.start()
+        readiness.mark("lease")
+        # Sagas taken over are waited for when draining, but no new ones are.
+        recovery = leases.Recovery(
+            leases.keeper, lifecycle.tracked(SagaCoordinator.resume)
+        )
+        drain.stopping.append(recovery.stop)
+        recovery.start()
 
 
 if __name__ == "__main__":
 
     logging.info("Started our request")
 
-    config = ConfigurationStore().get_config()
+    readiness.require("configuration", "transport", "pools")
+    if statestore.store.shared:
+        readiness.require("lease")
+
+    httpd = lifecycle.create_server((ADDRESS, PORT), RequestHandler)
+    drain = lifecycle.Drain(httpd)
+    drain.install()
+    threading.Thread(
+        target=warm_up, args=(drain,), name="qbox-warm-up", daemon=True
+    ).start()
 
-    httpd = ThreadingHTTPServer((ADDRESS, PORT), RequestHandler)
+    lifecycle.notify_ready()
     httpd.serve_forever()
+    drain.wait()
+    httpd.server_close()
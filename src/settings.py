@@ -0,0 +1,98 @@
+"""
+Process-wide settings.
+
+Saga behaviour lives in the mounted configuration, but knobs that apply to the
+sidecar as a whole are read from the environment so that they can be set in the
+pod spec next to the container.
+"""
+import os
+import uuid
+import socket
+
+# Record-and-replay traffic capture (see capture.py). Capture is off unless a path is set.
+CAPTURE_PATH = os.environ.get("QBOX_CAPTURE_PATH")
+CAPTURE_SAMPLE_RATE = float(os.environ.get("QBOX_CAPTURE_SAMPLE_RATE", "1.0"))
+
+# Directory to cache compiled configurations in (see configuration.py). Point it at a
+# volume that survives container restarts to skip parsing on restart as well as reload.
+CONFIGURATION_CACHE_DIR = os.environ.get("QBOX_CONFIGURATION_CACHE_DIR")
+
+# Downstream connection pooling (see pool.py). Connections to every host the sagas talk
+# to are opened ahead of time, and hostnames are re-resolved after the DNS TTL.
+WARM_CONNECTIONS = int(os.environ.get("QBOX_WARM_CONNECTIONS", "2"))
+POOL_HOSTS = int(os.environ.get("QBOX_POOL_HOSTS", "256"))
+POOL_CONNECTIONS_PER_HOST = int(os.environ.get("QBOX_POOL_CONNECTIONS_PER_HOST", "32"))
+DNS_TTL_SECONDS = float(os.environ.get("QBOX_DNS_TTL_SECONDS", "30"))
+
+# The HTTP client downstream requests are sent with: requests, urllib3 or asyncio (see
+# transport.py).
+TRANSPORT = os.environ.get("QBOX_TRANSPORT", "requests")
+
+# A forward proxy that every transport sends plain http:// downstream requests through,
+# e.g. the stub of replay.py. https:// requests are sent directly.
+HTTP_PROXY = os.environ.get("QBOX_HTTP_PROXY")
+
+# Bodies larger than the threshold are spooled to temporary files in SPOOL_DIR (the
+# system default if unset) instead of being kept in memory, and requests with bodies
+# over the maximum are refused (see spool.py).
+SPOOL_THRESHOLD_BYTES = int(os.environ.get("QBOX_SPOOL_THRESHOLD_BYTES", str(1 << 20)))
+MAX_BODY_BYTES = int(os.environ.get("QBOX_MAX_BODY_BYTES", str(64 << 20)))
+SPOOL_DIR = os.environ.get("QBOX_SPOOL_DIR")
+
+# Identical concurrent GET and HEAD requests passed through to these hosts (comma
+# separated, or * for all) share one upstream request if they agree on the vary
+# headers, and responses are cached for as long as their Cache-Control allows, up to
+# RESPONSE_CACHE_SECONDS (0 to cache nothing). Off unless hosts are set (see
+# coalesce.py).
+COALESCE_HOSTS = os.environ.get("QBOX_COALESCE_HOSTS", "")
+COALESCE_VARY_HEADERS = os.environ.get(
+    "QBOX_COALESCE_VARY_HEADERS",
+    "Accept,Accept-Encoding,Accept-Language,Authorization,Cookie",
+)
+RESPONSE_CACHE_SECONDS = float(os.environ.get("QBOX_RESPONSE_CACHE_SECONDS", "0"))
+
+# Where saga state is kept (see statestore.py). With a store other replicas can see,
+# each replica holds a lease for as long as it is alive (see leases.py), and takes over
+# the sagas of replicas whose lease has expired. Replica IDs are unique per process by
+# default, since a restarted container has the same hostname and often the same pid.
+STATE_STORE = os.environ.get("QBOX_STATE_STORE", "memory://")
+REPLICA_ID = os.environ.get(
+    "QBOX_REPLICA_ID",
+    f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}",
+)
+LEASE_SECONDS = float(os.environ.get("QBOX_LEASE_SECONDS", "15"))
+RECOVERY_INTERVAL_SECONDS = float(
+    os.environ.get("QBOX_RECOVERY_INTERVAL_SECONDS", "30")
+)
+
+# Where finished sagas are recorded for analytics (see analytics.py), off unless set.
+# Rows are written every FLUSH_SECONDS to files rolled at FILE_BYTES, keeping MAX_FILES.
+ANALYTICS_DIR = os.environ.get("QBOX_ANALYTICS_DIR")
+ANALYTICS_FLUSH_SECONDS = float(os.environ.get("QBOX_ANALYTICS_FLUSH_SECONDS", "5"))
+ANALYTICS_FILE_BYTES = int(os.environ.get("QBOX_ANALYTICS_FILE_BYTES", str(64 << 20)))
+ANALYTICS_MAX_FILES = int(os.environ.get("QBOX_ANALYTICS_MAX_FILES", "16"))
+
+# How long a shutting down sidecar waits for running sagas to finish, and the socket
+# to serve on instead of binding one, e.g. inherited from the process it replaces
+# (see lifecycle.py).
+DRAIN_SECONDS = float(os.environ.get("QBOX_DRAIN_SECONDS", "25"))
+LISTEN_FD = (
+    int(os.environ["QBOX_LISTEN_FD"]) if os.environ.get("QBOX_LISTEN_FD") else None
+)
+
+# How many background workers compensate failed sagas, off (compensating on the
+# request thread) unless above zero, and how often and how far apart a saga's
+# compensations are retried before it is dead-lettered (see outbox.py).
+COMPENSATION_WORKERS = int(os.environ.get("QBOX_COMPENSATION_WORKERS", "0"))
+COMPENSATION_MAX_ATTEMPTS = int(os.environ.get("QBOX_COMPENSATION_MAX_ATTEMPTS", "10"))
+COMPENSATION_BACKOFF_SECONDS = float(
+    os.environ.get("QBOX_COMPENSATION_BACKOFF_SECONDS", "1")
+)
+
+# The hosts (comma separated, ports ignored) that the admin endpoints under /_qbox are
+# served for. Requests for any other host are passed through, so clients of the
+# services behind the sidecar can't reach them.
+ADMIN_HOSTS = os.environ.get("QBOX_ADMIN_HOSTS", "localhost,127.0.0.1,::1")
+
+# Where profiles taken from the admin profile endpoint are written (see profiler.py).
+PROFILE_DIR = os.environ.get("QBOX_PROFILE_DIR", "/tmp")
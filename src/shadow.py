@@ -0,0 +1,217 @@
+"""
+Shadow-mode dry runs of saga configurations.
+
+A saga configured with `shadow` never answers the client itself - matching requests
+keep going through the normal pass-through path. In the background, off the request
+thread, we run the full saga plan against either
+
+    - a mirror host (`shadow.mirror`), which receives every request in the plan with
+      the scheme and host of its url swapped for the mirror's, or
+    - stubbed responses, taken from a transaction's `shadowResponse` if it has one and
+      otherwise from its first `isSuccessIfReceives` entry,
+
+and record how often the saga matched, how long it took, how it ended and how many
+compensating transactions it would have issued. The numbers are exposed under
+`shadow` on the admin metrics endpoint.
+"""
+import time
+import logging
+import threading
+import collections
+from urllib.parse import urlsplit, urlunsplit
+
+import metrics
+from coordinator import SagaCoordinator
+
+SHADOW_WORKERS = 4
+MAX_PENDING_SHADOW_RUNS = 64
+LATENCY_SAMPLES = 1024
+
+
+class StubResponse(object):
+    def __init__(self, configuration):
+        self.status_code = configuration["status-code"]
+        self.headers = dict(configuration.get("headers", {}))
+        self.content = configuration.get("body", "").encode("utf-8")
+
+
+class ShadowCoordinator(SagaCoordinator):
+    """
+    A coordinator whose downstream requests go to a mirror host, or nowhere at all.
+    """
+
+    batching = False
+    persistent = False
+    observable = False
+    analyzed = False
+    outboxed = False
+
+    def __init__(self, configuration, *args, **kwargs):
+        super(ShadowCoordinator, self).__init__(configuration, *args, **kwargs)
+        shadow = configuration.get("shadow")
+        self.mirror = shadow.get("mirror") if isinstance(shadow, dict) else None
+        self.compensations = 0
+
+    def request(self, transaction, kind, url, headers, body):
+        if kind == "COMPENSATION":
+            self.compensations += 1
+
+        if self.mirror:
+            return super(ShadowCoordinator, self).request(
+                transaction, kind, mirrored(url, self.mirror), headers, body
+            )
+
+        if "shadowResponse" in transaction:
+            return StubResponse(transaction["shadowResponse"])
+        return StubResponse(transaction["isSuccessIfReceives"][0])
+
+
+def mirrored(url, mirror):
+    original = urlsplit(url)
+    target = urlsplit(mirror)
+    return urlunsplit(
+        (target.scheme, target.netloc, original.path, original.query, original.fragment)
+    )
+
+
+class ShadowStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.matched = 0
+        self.runs = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.errors = 0
+        self.dropped = 0
+        self.projected_compensations = 0
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+
+    def snapshot(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        return {
+            "requests": self.requests,
+            "matched": self.matched,
+            "matchRate": self.matched / self.requests if self.requests else 0.0,
+            "runs": self.runs,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "errors": self.errors,
+            "dropped": self.dropped,
+            "projectedCompensations": self.projected_compensations,
+            "latencyMs": {
+                "p50": percentile(0.5),
+                "p99": percentile(0.99),
+                "max": latencies[-1] if latencies else None,
+            },
+        }
+
+
+class ShadowRecorder(object):
+    """
+    Runs shadow sagas on a small pool of background threads and keeps per-saga
+    statistics. Runs are dropped, not queued, once too many are pending, so a slow
+    mirror can never build up unbounded work.
+    """
+
+    def __init__(self, workers=SHADOW_WORKERS, max_pending=MAX_PENDING_SHADOW_RUNS):
+        self.lock = threading.Lock()
+        self.stats = collections.defaultdict(ShadowStats)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.workers = workers
+        self.executor = None
+
+    def observe(self, configuration, matched):
+        with self.lock:
+            stats = self.stats[saga_name(configuration)]
+            stats.requests += 1
+            if matched:
+                stats.matched += 1
+
+    def submit(
+        self,
+        configuration,
+        start_request_headers,
+        start_request_body,
+        path_parameters={},
+    ):
+        """
+        Schedule a shadow run. Returns a future, or None if the run was dropped.
+        """
+
+        if not self.pending.acquire(blocking=False):
+            with self.lock:
+                self.stats[saga_name(configuration)].dropped += 1
+            return None
+
+        try:
+            return self.get_executor().submit(
+                self.run,
+                configuration,
+                start_request_headers,
+                start_request_body,
+                path_parameters,
+            )
+        except RuntimeError:
+            self.pending.release()
+            return None
+
+    def get_executor(self):
+        # Created on first use, since most deployments never run a shadow saga.
+        with self.lock:
+            if self.executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="qbox-shadow"
+                )
+            return self.executor
+
+    def run(
+        self, configuration, start_request_headers, start_request_body, path_parameters
+    ):
+        try:
+            coordinator = ShadowCoordinator(
+                configuration,
+                start_request_headers=start_request_headers,
+                start_request_body=start_request_body,
+                path_parameters=path_parameters,
+            )
+
+            start = time.monotonic()
+            try:
+                success, _, _ = coordinator.execute_saga()
+            except Exception:
+                logging.exception("Shadow saga raised")
+                with self.lock:
+                    self.stats[saga_name(configuration)].errors += 1
+                return
+            elapsed = (time.monotonic() - start) * 1000
+
+            with self.lock:
+                stats = self.stats[saga_name(configuration)]
+                stats.runs += 1
+                stats.succeeded += 1 if success else 0
+                stats.failed += 0 if success else 1
+                stats.projected_compensations += coordinator.compensations
+                stats.latencies.append(elapsed)
+        finally:
+            self.pending.release()
+
+    def snapshot(self):
+        with self.lock:
+            return {name: stats.snapshot() for name, stats in self.stats.items()}
+
+
+def saga_name(configuration):
+    match = configuration["matchRequest"]
+    return f"{match['method']} {match['url']}"
+
+
+recorder = ShadowRecorder()
+metrics.register("shadow", recorder.snapshot)
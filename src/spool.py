@@ -0,0 +1,175 @@
+"""
+Request and response bodies that don't have to fit in memory.
+
+Bodies up to QBOX_SPOOL_THRESHOLD_BYTES are plain bytes. Larger ones are spilled to an
+anonymous temporary file as they are read, and come back as a `SpooledBody`: a
+read-only, bytes-like view of the file through a memory map. Sagas keep every body
+for their whole lifetime, so this bounds the memory a saga holds on to regardless of
+what clients and downstream services send.
+
+Spooled bodies can be compared with other bodies (as matching does), passed through
+whole-body interpolations, sent downstream and written back to clients without being
+loaded into memory - they are iterated in chunks and the memory map pages them in and
+out as needed. Splicing one into a larger text template does load it. Spooled bodies
+are not parsed as JSON and are not persisted in the state store.
+
+Inbound requests declaring a body larger than QBOX_MAX_BODY_BYTES are rejected with
+413 before any of it is read.
+"""
+import mmap
+import tempfile
+import settings
+
+CHUNK_SIZE = 64 * 1024
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class SpooledBody(object):
+    def __init__(self, file, length):
+        self.file = file
+        self.length = length
+        self.view = mmap.mmap(file.fileno(), length, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __iter__(self):
+        return self.chunks()
+
+    def chunks(self, size=CHUNK_SIZE):
+        for offset in range(0, self.length, size):
+            yield self.view[offset : offset + size]
+
+    def __eq__(self, other):
+        if isinstance(other, SpooledBody):
+            other = other.view
+        elif isinstance(other, str) or not hasattr(other, "__len__"):
+            return NotImplemented
+        if len(other) != self.length:
+            return False
+
+        # Compare a chunk at a time, so that neither body is read into memory whole.
+        for offset in range(0, self.length, CHUNK_SIZE):
+            end = offset + CHUNK_SIZE
+            if self.view[offset:end] != other[offset:end]:
+                return False
+        return True
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __bytes__(self):
+        return self.view[:]
+
+    def decode(self, encoding="utf-8", errors="strict"):
+        return self.view[:].decode(encoding, errors)
+
+    def close(self):
+        self.view.close()
+        self.file.close()
+
+    def __repr__(self):
+        return f"<SpooledBody of {self.length} bytes>"
+
+
+class Spooler(object):
+    """
+    Gathers a body written a chunk at a time, in memory while it stays within
+    `threshold` bytes and in a temporary file once it doesn't. Raises BodyTooLarge
+    once it grows past `limit` bytes.
+    """
+
+    def __init__(self, threshold=None, limit=None):
+        if threshold is None:
+            threshold = settings.SPOOL_THRESHOLD_BYTES
+        self.threshold = threshold
+        self.limit = limit
+        self.buffered = bytearray()
+        self.spilled = None
+        self.length = 0
+
+    def write(self, chunk):
+        self.length += len(chunk)
+        if self.limit is not None and self.length > self.limit:
+            self.discard()
+            raise BodyTooLarge(f"Body is larger than {self.limit} bytes")
+
+        if self.spilled is not None:
+            self.spilled.write(chunk)
+            return
+
+        self.buffered += chunk
+        if len(self.buffered) > self.threshold:
+            self.spilled = tempfile.TemporaryFile(dir=settings.SPOOL_DIR)
+            self.spilled.write(self.buffered)
+            self.buffered = None
+
+    def finish(self):
+        """
+        The body written so far, as bytes or a SpooledBody.
+        """
+
+        if self.spilled is None:
+            return bytes(self.buffered)
+        self.spilled.flush()
+        return SpooledBody(self.spilled, self.length)
+
+    def discard(self):
+        if self.spilled is not None:
+            self.spilled.close()
+
+
+def collect(chunks, threshold=None, limit=None):
+    """
+    Gather a body from an iterable of chunks (see Spooler).
+    """
+
+    spooler = Spooler(threshold, limit)
+    try:
+        for chunk in chunks:
+            spooler.write(chunk)
+    except BaseException:
+        spooler.discard()
+        raise
+    return spooler.finish()
+
+
+def read(stream, length, threshold=None, limit=None):
+    """
+    Read a body of `length` bytes from a file-like `stream`.
+    """
+
+    if limit is not None and length > limit:
+        raise BodyTooLarge(f"Body of {length} bytes is larger than {limit} bytes")
+
+    def chunks():
+        remaining = length
+        while remaining > 0:
+            chunk = stream.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+    return collect(chunks(), threshold, limit)
+
+
+def write(stream, body):
+    """
+    Write a body, spooled or not, to a file-like `stream`.
+    """
+
+    if isinstance(body, SpooledBody):
+        for chunk in body.chunks():
+            stream.write(chunk)
+    else:
+        stream.write(body)
@@ -0,0 +1,605 @@
+"""
+Saga state, kept outside of the coordinator that runs the saga.
+
+Every saga the coordinator runs is written to a state store as one record (see
+`SagaCoordinator.snapshot`): its configuration, the inbound request, the transactions
+that have succeeded so far with their responses, and which of their compensations
+have already been issued. Records are removed once a saga is over, except for sagas
+whose compensations failed, which are kept for inspection.
+
+The store is chosen with QBOX_STATE_STORE:
+
+    memory://                       this process only (the default)
+    sqlite:///var/lib/qbox/state.db a file shared by the replicas on one node
+    redis://:password@host:6379/0   anything speaking the Redis protocol
+
+Writes never block the saga. They are queued as they are, and serialized and written
+behind by one thread per store, with every write queued while the previous batch was being written going out
+together - in one SQLite transaction, or one Redis pipeline - so the cost per saga
+step stays low under load. Repeated writes of the same saga's record are coalesced.
+
+Stores also hold leases (see leases.py): named, expiring claims with a fencing token
+that increases every time the lease changes hands. Unlike saga records, lease
+operations are atomic and synchronous.
+"""
+import json
+import time
+import socket
+import logging
+import metrics
+import settings
+import threading
+from urllib.parse import urlsplit, unquote
+
+from spool import SpooledBody
+from interpolate import as_text
+
+RUNNING = "RUNNING"
+COMPENSATING = "COMPENSATING"
+FAILED = "FAILED"
+
+# Backoff before retrying a batch the backend failed to write.
+RETRY_SECONDS = 1.0
+
+
+def encode(value):
+    """
+    JSON for what records hold besides JSON types: bodies, as text. Bodies spooled to
+    disk are too large to keep in the state store.
+    """
+
+    if isinstance(value, SpooledBody):
+        return None
+    if isinstance(value, (bytes, bytearray)):
+        return as_text(value)
+    raise TypeError(f"Can't store {type(value).__name__} in a saga record")
+
+
+def serialize(record):
+    return None if record is None else json.dumps(record, default=encode)
+
+
+class StateStore(object):
+    """
+    Base class for state stores. Backends implement `write_batch`, `get` and `records`.
+    """
+
+    # Whether other replicas can see what is written here.
+    shared = True
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.writing = False
+        self.flusher = None
+        self.writes = 0
+        self.batches = 0
+        self.errors = 0
+
+    def save(self, saga_id, record):
+        """
+        Queue a record for writing. It is serialized later, on the flusher thread, so
+        it mustn't be changed after being saved.
+        """
+
+        self.write(saga_id, record)
+
+    def delete(self, saga_id):
+        self.write(saga_id, None)
+
+    def write(self, saga_id, record):
+        with self.condition:
+            self.pending[saga_id] = record
+            self.writes += 1
+            if self.flusher is None:
+                self.flusher = threading.Thread(
+                    target=self.run, name="qbox-state-store", daemon=True
+                )
+                self.flusher.start()
+            self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Wait until everything written so far has reached the backend. Returns False if
+        that didn't happen within `timeout` seconds.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.pending or self.writing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                batch, self.pending = self.pending, {}
+                self.writing = True
+
+            try:
+                self.write_batch(
+                    {saga_id: serialize(record) for saga_id, record in batch.items()}
+                )
+                failed = False
+            except Exception as e:
+                logging.error(f"Could not write {len(batch)} saga states: {e}")
+                failed = True
+
+            with self.condition:
+                self.batches += 1
+                if failed:
+                    # Keep anything written since - it is newer than what failed.
+                    self.errors += 1
+                    for saga_id, value in batch.items():
+                        self.pending.setdefault(saga_id, value)
+                self.writing = False
+                self.condition.notify_all()
+
+            if failed:
+                time.sleep(RETRY_SECONDS)
+
+    def write_batch(self, batch):
+        """
+        Write {saga id: serialized record, or None to delete it} to the backend.
+        """
+
+        raise NotImplementedError
+
+    def get(self, saga_id):
+        raise NotImplementedError
+
+    def records(self):
+        raise NotImplementedError
+
+    def acquire_lease(self, name, owner, ttl):
+        """
+        Claim the lease `name` for `ttl` seconds, unless someone holds it. Returns the
+        fencing token of the new claim, or None.
+        """
+
+        raise NotImplementedError
+
+    def renew_lease(self, name, owner, token, ttl):
+        """
+        Extend a claim that is still held. Returns False if it was lost.
+        """
+
+        raise NotImplementedError
+
+    def release_lease(self, name, owner, token):
+        raise NotImplementedError
+
+    def lease_owner(self, name):
+        """
+        Who holds the lease `name`, or None if nobody does.
+        """
+
+        raise NotImplementedError
+
+    def snapshot(self):
+        with self.condition:
+            return {
+                "backend": type(self).__name__,
+                "writes": self.writes,
+                "batches": self.batches,
+                "pending": len(self.pending),
+                "errors": self.errors,
+            }
+
+
+class MemoryStore(StateStore):
+    """
+    Keeps records in this process. Writes are applied immediately.
+    """
+
+    shared = False
+
+    def __init__(self):
+        super(MemoryStore, self).__init__()
+        self.values = {}
+        # name -> [owner, token, expiry]
+        self.leases = {}
+
+    def write(self, saga_id, record):
+        with self.condition:
+            self.writes += 1
+            self.batches += 1
+            self.write_batch({saga_id: serialize(record)})
+
+    def write_batch(self, batch):
+        for saga_id, value in batch.items():
+            if value is None:
+                self.values.pop(saga_id, None)
+            else:
+                self.values[saga_id] = value
+
+    def get(self, saga_id):
+        with self.condition:
+            value = self.values.get(saga_id)
+        return None if value is None else json.loads(value)
+
+    def records(self):
+        with self.condition:
+            values = list(self.values.values())
+        return [json.loads(value) for value in values]
+
+    def acquire_lease(self, name, owner, ttl):
+        now = time.time()
+        with self.condition:
+            lease = self.leases.setdefault(name, [None, 0, 0])
+            if lease[0] is not None and lease[2] > now:
+                return None
+            lease[:] = [owner, lease[1] + 1, now + ttl]
+            return lease[1]
+
+    def renew_lease(self, name, owner, token, ttl):
+        now = time.time()
+        with self.condition:
+            lease = self.leases.get(name)
+            if lease is None or lease[:2] != [owner, token] or lease[2] <= now:
+                return False
+            lease[2] = now + ttl
+            return True
+
+    def release_lease(self, name, owner, token):
+        with self.condition:
+            lease = self.leases.get(name)
+            if lease is not None and lease[:2] == [owner, token]:
+                lease[0] = None
+
+    def lease_owner(self, name):
+        with self.condition:
+            lease = self.leases.get(name)
+            if lease is None or lease[2] <= time.time():
+                return None
+            return lease[0]
+
+
+class SQLiteStore(StateStore):
+    def __init__(self, path):
+        super(SQLiteStore, self).__init__()
+        self.path = path
+        self.connection = None
+        self.connection_lock = threading.Lock()
+
+    def connect(self):
+        if self.connection is None:
+            import sqlite3
+
+            self.connection = sqlite3.connect(
+                self.path, check_same_thread=False, isolation_level=None
+            )
+            # Let replicas sharing the file read while one of them writes.
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS sagas (id TEXT PRIMARY KEY, record TEXT)"
+            )
+            # Released leases keep their row so that tokens keep increasing.
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS leases "
+                "(name TEXT PRIMARY KEY, owner TEXT, token INTEGER, expiry REAL)"
+            )
+        return self.connection
+
+    def write_batch(self, batch):
+        with self.connection_lock:
+            connection = self.connect()
+            connection.execute("BEGIN")
+            try:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO sagas (id, record) VALUES (?, ?)",
+                    [(k, v) for k, v in batch.items() if v is not None],
+                )
+                connection.executemany(
+                    "DELETE FROM sagas WHERE id = ?",
+                    [(k,) for k, v in batch.items() if v is None],
+                )
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+    def get(self, saga_id):
+        with self.connection_lock:
+            row = (
+                self.connect()
+                .execute("SELECT record FROM sagas WHERE id = ?", (saga_id,))
+                .fetchone()
+            )
+        return None if row is None else json.loads(row[0])
+
+    def records(self):
+        with self.connection_lock:
+            rows = self.connect().execute("SELECT record FROM sagas").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def acquire_lease(self, name, owner, ttl):
+        now = time.time()
+        with self.connection_lock:
+            connection = self.connect()
+            # IMMEDIATE takes the write lock up front, so that replicas sharing the
+            # file can't both read the lease as free.
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT owner, token, expiry FROM leases WHERE name = ?", (name,)
+                ).fetchone()
+                if row is not None and row[0] is not None and row[2] > now:
+                    connection.execute("ROLLBACK")
+                    return None
+
+                token = (row[1] if row else 0) + 1
+                connection.execute(
+                    "INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?)",
+                    (name, owner, token, now + ttl),
+                )
+                connection.execute("COMMIT")
+                return token
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+    def renew_lease(self, name, owner, token, ttl):
+        now = time.time()
+        with self.connection_lock:
+            cursor = self.connect().execute(
+                "UPDATE leases SET expiry = ? "
+                "WHERE name = ? AND owner = ? AND token = ? AND expiry > ?",
+                (now + ttl, name, owner, token, now),
+            )
+        return cursor.rowcount == 1
+
+    def release_lease(self, name, owner, token):
+        with self.connection_lock:
+            self.connect().execute(
+                "UPDATE leases SET owner = NULL "
+                "WHERE name = ? AND owner = ? AND token = ?",
+                (name, owner, token),
+            )
+
+    def lease_owner(self, name):
+        with self.connection_lock:
+            row = (
+                self.connect()
+                .execute(
+                    "SELECT owner FROM leases WHERE name = ? AND expiry > ?",
+                    (name, time.time()),
+                )
+                .fetchone()
+            )
+        return None if row is None else row[0]
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnection(object):
+    """
+    Just enough of a client for the Redis serialization protocol (RESP) to send
+    pipelines of commands. Connects lazily, and reconnects after errors.
+    """
+
+    def __init__(self, host, port, db=0, password=None, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.socket = None
+        self.reader = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        self.socket = socket.create_connection((self.host, self.port), self.timeout)
+        self.reader = self.socket.makefile("rb")
+
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            self.send(setup)
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+        self.socket = None
+        self.reader = None
+
+    def execute(self, *command):
+        return self.pipeline([command])[0]
+
+    def pipeline(self, commands):
+        """
+        Send all of `commands` at once and return their replies, in order.
+        """
+
+        with self.lock:
+            if self.socket is None:
+                self.connect()
+            try:
+                return self.send(commands)
+            except (OSError, RedisError):
+                self.close()
+                raise
+
+    def send(self, commands):
+        self.socket.sendall(b"".join(encode_command(command) for command in commands))
+        replies = [self.read_reply() for _ in commands]
+
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise OSError("Connection closed by Redis")
+
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode("utf-8")
+        if kind == b"-":
+            return RedisError(payload.decode("utf-8"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [self.read_reply() for _ in range(length)]
+        raise RedisError(f"Unexpected reply {line!r}")
+
+
+def encode_command(command):
+    parts = [f"*{len(command)}\r\n".encode("ascii")]
+    for argument in command:
+        if not isinstance(argument, bytes):
+            argument = str(argument).encode("utf-8")
+        parts.append(f"${len(argument)}\r\n".encode("ascii") + argument + b"\r\n")
+    return b"".join(parts)
+
+
+# Lease operations need to compare and set atomically, so they run as scripts. A lease
+# is a key holding "<token> <owner>" that expires with the lease, and its fencing
+# token is a counter next to it.
+ACQUIRE_LEASE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then return nil end
+local token = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], token .. ' ' .. ARGV[1], 'PX', ARGV[2])
+return token
+"""
+
+RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+"""
+
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+return redis.call('DEL', KEYS[1])
+"""
+
+
+class RedisStore(StateStore):
+    """
+    Records are stored as `<prefix>saga:<id>` strings, with the set `<prefix>sagas`
+    indexing them. Leases are `<prefix>lease:<name>`, with `<prefix>fence:<name>`
+    counting their tokens.
+    """
+
+    def __init__(self, connection, prefix="qbox:"):
+        super(RedisStore, self).__init__()
+        self.connection = connection
+        self.prefix = prefix
+
+    def key(self, saga_id):
+        return f"{self.prefix}saga:{saga_id}"
+
+    def write_batch(self, batch):
+        index = f"{self.prefix}sagas"
+        commands = []
+        for saga_id, value in batch.items():
+            if value is None:
+                commands.append(("DEL", self.key(saga_id)))
+                commands.append(("SREM", index, saga_id))
+            else:
+                commands.append(("SET", self.key(saga_id), value))
+                commands.append(("SADD", index, saga_id))
+        self.connection.pipeline(commands)
+
+    def get(self, saga_id):
+        value = self.connection.execute("GET", self.key(saga_id))
+        return None if value is None else json.loads(value)
+
+    def records(self):
+        saga_ids = self.connection.execute("SMEMBERS", f"{self.prefix}sagas")
+        if not saga_ids:
+            return []
+
+        values = self.connection.pipeline(
+            [("GET", self.key(saga_id.decode("utf-8"))) for saga_id in saga_ids]
+        )
+        return [json.loads(value) for value in values if value is not None]
+
+    def lease_keys(self, name):
+        return f"{self.prefix}lease:{name}", f"{self.prefix}fence:{name}"
+
+    def acquire_lease(self, name, owner, ttl):
+        return self.connection.execute(
+            "EVAL",
+            ACQUIRE_LEASE_SCRIPT,
+            2,
+            *self.lease_keys(name),
+            owner,
+            milliseconds(ttl),
+        )
+
+    def renew_lease(self, name, owner, token, ttl):
+        return (
+            self.connection.execute(
+                "EVAL",
+                RENEW_LEASE_SCRIPT,
+                1,
+                self.lease_keys(name)[0],
+                f"{token} {owner}",
+                milliseconds(ttl),
+            )
+            == 1
+        )
+
+    def release_lease(self, name, owner, token):
+        self.connection.execute(
+            "EVAL",
+            RELEASE_LEASE_SCRIPT,
+            1,
+            self.lease_keys(name)[0],
+            f"{token} {owner}",
+        )
+
+    def lease_owner(self, name):
+        value = self.connection.execute("GET", self.lease_keys(name)[0])
+        return None if value is None else value.decode("utf-8").split(" ", 1)[1]
+
+
+def milliseconds(seconds):
+    return max(1, int(seconds * 1000))
+
+
+def from_url(url):
+    parts = urlsplit(url)
+
+    if parts.scheme == "memory":
+        return MemoryStore()
+    if parts.scheme == "sqlite":
+        return SQLiteStore(url[len("sqlite://") :] or ":memory:")
+    if parts.scheme == "redis":
+        database = parts.path.strip("/")
+        return RedisStore(
+            RedisConnection(
+                parts.hostname or "127.0.0.1",
+                parts.port or 6379,
+                db=int(database) if database else 0,
+                password=unquote(parts.password) if parts.password else None,
+            )
+        )
+    raise ValueError(f"Unsupported state store {url}")
+
+
+store = from_url(settings.STATE_STORE)
+
+metrics.register("stateStore", lambda: store.snapshot())
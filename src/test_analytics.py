@@ -0,0 +1,144 @@
+import io
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import contextlib
+import analytics
+import requests_mock
+from coordinator import SagaCoordinator
+
+
+def configuration():
+    return {
+        "host": "me.svc",
+        "matchRequest": {"method": "POST", "url": "http://qbox.me.svc/orders"},
+        "onMatchedRequest": [
+            {
+                "method": "POST",
+                "url": "http://billing.svc/charges",
+                "name": "charge",
+                "onFailure": [
+                    {
+                        "method": "DELETE",
+                        "url": "http://billing.svc/charges",
+                        "timeout": 3,
+                        "isSuccessIfReceives": [{"status-code": 200}],
+                    }
+                ],
+                "isSuccessIfReceives": [{"status-code": 200}],
+                "timeout": 3,
+            },
+            {
+                "method": "POST",
+                "url": "http://shipping.svc/shipments",
+                "onFailure": [],
+                "isSuccessIfReceives": [{"status-code": 200}],
+                "timeout": 3,
+            },
+        ],
+    }
+
+
+class TestAnalytics(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.writer = analytics.AnalyticsWriter(self.directory)
+        self.addCleanup(self.writer.close)
+
+    def run_sagas(self, successes, failures):
+        with requests_mock.Mocker() as m:
+            m.post("http://billing.svc/charges", status_code=200)
+            m.delete("http://billing.svc/charges", status_code=200)
+
+            m.post("http://shipping.svc/shipments", status_code=200)
+            for _ in range(successes):
+                coordinator = SagaCoordinator(configuration())
+                coordinator.execute_saga()
+                self.writer.record(coordinator, True, [])
+
+            m.post("http://shipping.svc/shipments", status_code=503)
+            for _ in range(failures):
+                coordinator = SagaCoordinator(configuration())
+                success, _, failed = coordinator.execute_saga()
+                self.writer.record(coordinator, success, failed)
+
+        self.writer.flush()
+
+    def test_sagas_are_summarized(self):
+        self.run_sagas(successes=3, failures=1)
+        tables = analytics.load(self.directory)
+
+        self.assertEqual(len(tables["sagas"]), 4)
+        self.assertEqual(len(tables["steps"]), 9)
+
+        (saga,) = analytics.saga_summary(tables)
+        self.assertEqual(saga["saga"], "POST http://qbox.me.svc/orders")
+        self.assertEqual(saga["count"], 4)
+        self.assertEqual(saga["successRate"], 0.75)
+        self.assertEqual(saga["compensationRate"], 0.25)
+        self.assertEqual(saga["failedCompensations"], 0)
+        self.assertIsNotNone(saga["durationMs"]["p99"])
+
+        steps = analytics.step_summary(tables)
+        self.assertEqual(
+            [(s["kind"], s["name"], s["count"], s["failureRate"]) for s in steps],
+            [
+                ("TRANSACTION", "charge", 4, 0.0),
+                ("TRANSACTION", "1", 4, 0.25),
+                ("COMPENSATION", "charge", 1, 0.0),
+            ],
+        )
+        self.assertEqual(steps[0]["attemptsPerStep"], 1.0)
+
+        (failure,) = analytics.failure_breakdown(tables)
+        self.assertEqual((failure["name"], failure["status"]), ("1", 503))
+        self.assertEqual(analytics.failure_breakdown(tables, saga="payments"), [])
+
+    def test_segments_accumulate_and_roll(self):
+        self.writer.file_bytes = 1
+        self.writer.max_files = 2
+        for _ in range(3):
+            self.run_sagas(successes=1, failures=0)
+            # Files are ordered by modification time.
+            time.sleep(0.01)
+
+        self.assertEqual(len(analytics.files(self.directory)), 2)
+        self.assertEqual(len(analytics.load(self.directory)["sagas"]), 2)
+
+    def test_since(self):
+        self.run_sagas(successes=2, failures=0)
+        self.assertEqual(len(analytics.load(self.directory, since=0)["sagas"]), 2)
+        future = time.time() + 60
+        self.assertEqual(len(analytics.load(self.directory, since=future)["sagas"]), 0)
+
+    def test_truncated_segments_are_ignored(self):
+        self.run_sagas(successes=2, failures=0)
+        (path,) = analytics.files(self.directory)
+        with open(path, "r+b") as data:
+            data.truncate(os.path.getsize(path) - 1)
+
+        tables = analytics.load(self.directory)
+        self.assertEqual(len(tables["sagas"]), 2)
+        self.assertEqual(len(tables["steps"]), 0)
+
+    def test_query_cli(self):
+        self.run_sagas(successes=1, failures=1)
+        output = io_capture(analytics.main, ["sagas", "--dir", self.directory])
+        self.assertIn("successRate", output)
+        self.assertIn("POST http://qbox.me.svc/orders", output)
+
+        output = io_capture(
+            analytics.main, ["failures", "--dir", self.directory, "--format", "json"]
+        )
+        self.assertEqual(json.loads(output)[0]["status"], 503)
+
+
+def io_capture(function, *args):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        function(*args)
+    return output.getvalue()
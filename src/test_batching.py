@@ -0,0 +1,202 @@
+import json
+import unittest
+import threading
+import spool
+import requests_mock
+from unittest.mock import patch
+from coordinator import SagaCoordinator
+from batching import MicroBatcher, split_response_body
+
+
+def batched_configuration(max_items, max_wait_ms):
+    return {
+        "host": "me.svc",
+        "matchRequest": {"method": "POST", "url": "http://qbox.me.svc/orders"},
+        "onMatchedRequest": [
+            {
+                "method": "POST",
+                "url": "http://orders.svc/bulk",
+                "body": "${root.body}",
+                "batch": {"maxItems": max_items, "maxWaitMs": max_wait_ms},
+                "onFailure": [
+                    {
+                        "method": "POST",
+                        "url": "http://orders.svc/cancel",
+                        "body": "${parent.response.body}",
+                        "timeout": 3,
+                        "maxRetriesOnTimeout": 1,
+                        "isSuccessIfReceives": [{"status-code": 200}],
+                    }
+                ],
+                "isSuccessIfReceives": [{"status-code": 200, "body": "ok"}],
+                "timeout": 30,
+            },
+            {
+                "method": "POST",
+                "url": "http://billing.svc/charge",
+                "body": "${root.body}",
+                "onFailure": [],
+                "isSuccessIfReceives": [{"status-code": 200}],
+                "timeout": 30,
+            },
+        ],
+    }
+
+
+def run_sagas(configuration, bodies, headers=None):
+    results = [None] * len(bodies)
+
+    def run(index):
+        coordinator = SagaCoordinator(
+            configuration,
+            start_request_headers=headers[index] if headers else {},
+            start_request_body=bodies[index],
+        )
+        results[index] = coordinator.execute_saga()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(bodies))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+class TestMicroBatching(unittest.TestCase):
+    def test_batch_fills_up_and_fans_results_out(self):
+
+        configuration = batched_configuration(max_items=3, max_wait_ms=5000)
+
+        with requests_mock.Mocker() as m:
+            m.post("http://orders.svc/bulk", status_code=200, text='["ok", "ok", "ok"]')
+            m.post("http://billing.svc/charge", status_code=200)
+
+            results = run_sagas(configuration, ['{"id": 1}', '{"id": 2}', "three"])
+
+            bulk = [r for r in m.request_history if r.url == "http://orders.svc/bulk"]
+            self.assertEqual(len(bulk), 1)
+            self.assertCountEqual(
+                [{"id": 1}, {"id": 2}, "three"], json.loads(bulk[0].body)
+            )
+            self.assertEqual(bulk[0].headers["X-Qbox-Batch-Size"], "3")
+
+            charges = [
+                r for r in m.request_history if r.url == "http://billing.svc/charge"
+            ]
+            self.assertEqual(len(charges), 3)
+
+            for success, transactions, failed_compensations in results:
+                self.assertTrue(success)
+                self.assertEqual(len(transactions), 2)
+                self.assertEqual(transactions[0].response_body, b"ok")
+
+    def test_batch_is_sent_when_wait_elapses(self):
+
+        configuration = batched_configuration(max_items=10, max_wait_ms=10)
+
+        with requests_mock.Mocker() as m:
+            m.post("http://orders.svc/bulk", status_code=200, text='["ok"]')
+            m.post("http://billing.svc/charge", status_code=200)
+
+            [(success, transactions, _)] = run_sagas(configuration, ['{"id": 1}'])
+
+            self.assertTrue(success)
+            self.assertEqual(
+                ["http://orders.svc/bulk", "http://billing.svc/charge"],
+                [request.url for request in m.request_history],
+            )
+            self.assertEqual([{"id": 1}], json.loads(m.request_history[0].body))
+
+    def test_sagas_with_different_headers_are_not_batched_together(self):
+
+        configuration = batched_configuration(max_items=2, max_wait_ms=200)
+        configuration["onMatchedRequest"][0]["headers"] = {
+            "Authorization": "${root.headers.Authorization}"
+        }
+
+        with requests_mock.Mocker() as m:
+            m.post("http://orders.svc/bulk", status_code=200, text='["ok"]')
+            m.post("http://billing.svc/charge", status_code=200)
+
+            results = run_sagas(
+                configuration,
+                ['{"id": 1}', '{"id": 2}'],
+                headers=[{"Authorization": "alice"}, {"Authorization": "bob"}],
+            )
+
+            bulk = [r for r in m.request_history if r.url == "http://orders.svc/bulk"]
+            self.assertCountEqual(
+                [(r.headers["Authorization"], json.loads(r.body)) for r in bulk],
+                [("alice", [{"id": 1}]), ("bob", [{"id": 2}])],
+            )
+            self.assertTrue(all(success for success, _, _ in results))
+
+    def test_spooled_bodies(self):
+
+        configuration = batched_configuration(max_items=2, max_wait_ms=5000)
+        padding = "x" * 4096
+        # Over the threshold, but with items that are each what the sagas wait for.
+        items = '["ok", ' + " " * 4096 + '"ok"]'
+
+        with requests_mock.Mocker() as m, patch("settings.SPOOL_THRESHOLD_BYTES", 1024):
+            m.post("http://orders.svc/bulk", status_code=200, text=items)
+            m.post("http://billing.svc/charge", status_code=200)
+
+            results = run_sagas(configuration, [json.dumps({"id": padding}), "two"])
+
+            bulk = [r for r in m.request_history if r.url == "http://orders.svc/bulk"]
+            self.assertEqual(len(bulk), 1)
+            self.assertCountEqual(json.loads(bulk[0].body), [{"id": padding}, "two"])
+
+        for success, transactions, _ in results:
+            self.assertTrue(success)
+            self.assertEqual(transactions[0].response_body, b"ok")
+
+    def test_split_spooled_response_body(self):
+        with patch("settings.SPOOL_THRESHOLD_BYTES", 4):
+            spooled = spool.collect([b'[1, "a"]'])
+            not_json = spool.collect([b"not json at all"])
+        self.assertIsInstance(spooled, spool.SpooledBody)
+        self.assertEqual(split_response_body(spooled, 2), [b"1", b"a"])
+        self.assertEqual(split_response_body(not_json, 2), [not_json, not_json])
+
+    def test_per_item_compensation(self):
+
+        configuration = batched_configuration(max_items=2, max_wait_ms=5000)
+
+        with requests_mock.Mocker() as m:
+            m.post("http://orders.svc/bulk", status_code=200, text='["ok", "full"]')
+            m.post("http://orders.svc/cancel", status_code=200)
+            m.post("http://billing.svc/charge", status_code=500)
+
+            results = run_sagas(configuration, ['{"id": 1}', '{"id": 2}'])
+
+            cancels = [
+                r.text for r in m.request_history if r.url == "http://orders.svc/cancel"
+            ]
+            self.assertEqual(cancels, ["ok"])
+
+            for success, _, _ in results:
+                self.assertFalse(success)
+
+    def test_leader_failure_releases_followers(self):
+
+        batcher = MicroBatcher(max_items=1, max_wait_ms=0)
+
+        def request(url, headers, body):
+            raise RuntimeError("boom")
+
+        class Node(object):
+            url = "http://orders.svc/bulk"
+            headers = {}
+            body = b""
+
+        with self.assertRaises(RuntimeError):
+            batcher.submit(Node(), request)
+        self.assertIsNone(batcher.current)
+
+    def test_split_response_body(self):
+        self.assertEqual(split_response_body(b'[1, "a"]', 2), [b"1", b"a"])
+        self.assertEqual(split_response_body(b"[1]", 2), [b"[1]", b"[1]"])
+        self.assertEqual(split_response_body(b"nope", 2), [b"nope", b"nope"])
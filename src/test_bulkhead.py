@@ -0,0 +1,143 @@
+import unittest
+import threading
+import requests_mock
+import bulkhead
+from bulkhead import Bulkhead, BulkheadFull, bulkhead_for
+from unittest.mock import patch
+from coordinator import SagaCoordinator
+
+
+class TestBulkhead(unittest.TestCase):
+    def test_sagas_beyond_the_limit_are_rejected(self):
+        pool = Bulkhead("orders.svc", {"maxConcurrentSagas": 2})
+
+        self.assertTrue(pool.enter())
+        self.assertTrue(pool.enter())
+        self.assertFalse(pool.enter())
+
+        pool.leave()
+        with pool.saga():
+            with self.assertRaises(BulkheadFull):
+                with pool.saga():
+                    pass
+
+        snapshot = pool.snapshot()
+        self.assertEqual((snapshot["admitted"], snapshot["rejected"]), (3, 2))
+        self.assertEqual(snapshot["running"], 1)
+
+    def test_queued_sagas_run_once_a_slot_frees_up(self):
+        pool = Bulkhead(
+            "orders.svc",
+            {"maxConcurrentSagas": 1, "maxQueuedSagas": 1, "queueTimeout": 5},
+        )
+        self.assertTrue(pool.enter())
+
+        admitted = []
+        waiter = threading.Thread(target=lambda: admitted.append(pool.enter()))
+        waiter.start()
+        while not pool.snapshot()["queued"]:
+            pass
+
+        # The queue only has room for one.
+        self.assertFalse(pool.enter())
+        pool.leave()
+        waiter.join()
+        self.assertEqual(admitted, [True])
+
+    def test_queued_sagas_give_up(self):
+        pool = Bulkhead(
+            "orders.svc",
+            {"maxConcurrentSagas": 1, "maxQueuedSagas": 1, "queueTimeout": 0.01},
+        )
+        self.assertTrue(pool.enter())
+        self.assertFalse(pool.enter())
+        self.assertEqual(pool.snapshot()["queued"], 0)
+
+    def test_connections(self):
+        pool = Bulkhead("orders.svc", {"maxConnections": 1})
+
+        self.assertTrue(pool.connect(timeout=0))
+        self.assertFalse(pool.connect(timeout=0))
+        self.assertEqual(pool.snapshot()["connectionTimeouts"], 1)
+
+        pool.disconnect()
+        self.assertTrue(pool.connect(compensation=True, timeout=0))
+
+    def test_compensations_go_first(self):
+        pool = Bulkhead("orders.svc", {"maxConnections": 1})
+        self.assertTrue(pool.connect())
+
+        forward = threading.Thread(target=pool.connect, kwargs={"timeout": 5})
+        forward.start()
+        while not pool.snapshot()["waitingConnections"]:
+            pass
+        compensation = threading.Thread(target=pool.connect, args=(True,))
+        compensation.start()
+        while pool.snapshot()["waitingConnections"] < 2:
+            pass
+
+        pool.disconnect()
+        compensation.join()
+        self.assertEqual(pool.snapshot()["waitingConnections"], 1)
+
+        pool.disconnect()
+        forward.join()
+        self.assertEqual(pool.snapshot()["connections"], 1)
+
+
+class TestBulkheadFor(unittest.TestCase):
+    def setUp(self):
+        patcher = patch.dict("bulkhead._bulkheads", clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_shared_by_host_unless_named(self):
+        block = {"maxConcurrentSagas": 1}
+        orders = bulkhead_for({"host": "orders.svc", "bulkhead": block})
+        self.assertIs(orders, bulkhead_for({"host": "orders.svc", "bulkhead": block}))
+        self.assertIsNot(orders, bulkhead_for({"host": "users.svc", "bulkhead": block}))
+
+        named = dict(block, name="checkout")
+        checkout = bulkhead_for({"host": "orders.svc", "bulkhead": named})
+        self.assertIsNot(orders, checkout)
+        self.assertIs(checkout, bulkhead_for({"host": "users.svc", "bulkhead": named}))
+
+        self.assertIsNone(bulkhead_for({"host": "orders.svc"}))
+        self.assertEqual(
+            set(bulkhead.snapshot()), {"orders.svc", "users.svc", "checkout"}
+        )
+
+    def test_limits_are_reapplied(self):
+        pool = bulkhead_for({"host": "orders.svc", "bulkhead": {"maxConnections": 1}})
+        bulkhead_for({"host": "orders.svc", "bulkhead": {"maxConnections": 2}})
+        self.assertEqual(pool.max_connections, 2)
+
+    def test_forward_transactions_without_a_connection_time_out(self):
+        configuration = {
+            "host": "orders.svc",
+            "bulkhead": {"maxConnections": 1},
+            "matchRequest": {"method": "POST", "url": "/orders"},
+            "onMatchedRequest": [
+                {
+                    "method": "POST",
+                    "url": "http://billing.svc/charges",
+                    "onFailure": [],
+                    "isSuccessIfReceives": [{"status-code": 200}],
+                    "timeout": 0.01,
+                }
+            ],
+        }
+        # Another saga of the same host holds the only connection.
+        bulkhead_for(configuration).connect()
+
+        with requests_mock.Mocker() as m:
+            m.post("http://billing.svc/charges", status_code=200)
+            success, _, _ = SagaCoordinator(configuration).execute_saga()
+
+        self.assertFalse(success)
+        self.assertEqual(m.request_history, [])
+        self.assertEqual(bulkhead_for(configuration).snapshot()["connections"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
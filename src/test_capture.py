@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import unittest
+import threading
+import http.client
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from capture import CaptureWriter, read_records, decode_headers, INBOUND, DOWNSTREAM
+from replay import RecordedResponses, StubServer, load, replay
+
+
+class FakeResponse(object):
+    status_code = 201
+    headers = {"Content-Type": "application/octet-stream"}
+    content = b"\x00\xffbinary"
+
+
+class TestCapture(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "capture.bin")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+
+        writer = CaptureWriter(self.path)
+        capture_id = writer.record_inbound(
+            "POST", "/orders", {"Host": "qbox.svc", "X-Id": "1"}, b"body"
+        )
+        writer.record_downstream(
+            capture_id,
+            "POST",
+            "http://orders.svc/create",
+            FakeResponse.status_code,
+            FakeResponse.headers,
+            FakeResponse.content,
+        )
+        writer.close()
+
+        inbound, downstream = list(read_records(self.path))
+
+        self.assertEqual(inbound.kind, INBOUND)
+        self.assertEqual(inbound.fields[0], capture_id.encode())
+        self.assertEqual(
+            decode_headers(inbound.fields[3]), [("Host", "qbox.svc"), ("X-Id", "1")]
+        )
+        self.assertEqual(inbound.fields[4], b"body")
+
+        self.assertEqual(downstream.kind, DOWNSTREAM)
+        self.assertEqual(downstream.fields[3], b"201")
+        self.assertEqual(downstream.fields[5], b"\x00\xffbinary")
+        self.assertLessEqual(inbound.timestamp, downstream.timestamp)
+
+    def test_appends_to_existing_capture(self):
+
+        for _ in range(2):
+            writer = CaptureWriter(self.path)
+            writer.record_inbound("GET", "/", {}, b"")
+            writer.close()
+
+        self.assertEqual(len(list(read_records(self.path))), 2)
+
+    def test_sampling(self):
+
+        writer = CaptureWriter(self.path, sample_rate=0.0)
+        self.assertIsNone(writer.record_inbound("GET", "/", {}, b""))
+        writer.close()
+
+        self.assertEqual(list(read_records(self.path)), [])
+
+    def test_truncated_trailing_record_is_ignored(self):
+
+        writer = CaptureWriter(self.path)
+        writer.record_inbound("GET", "/", {}, b"")
+        writer.record_inbound("GET", "/", {}, b"")
+        writer.close()
+
+        with open(self.path, "r+b") as capture:
+            capture.truncate(os.path.getsize(self.path) - 3)
+
+        self.assertEqual(len(list(read_records(self.path))), 1)
+
+
+class TargetHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.received.append((self.path, self.headers["Host"]))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestReplay(unittest.TestCase):
+    def serve(self, server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_stub_serves_recorded_responses_in_order(self):
+
+        responses = RecordedResponses()
+        responses.add("GET", "http://a.svc/x", 200, [("X-N", "1")], b"first")
+        responses.add("GET", "http://a.svc/x", 404, [], b"second")
+        stub = self.serve(StubServer(("127.0.0.1", 0), responses))
+
+        results = []
+        for _ in range(3):
+            connection = http.client.HTTPConnection(*stub.server_address)
+            connection.request("GET", "http://a.svc/x")
+            response = connection.getresponse()
+            results.append((response.status, response.read()))
+            connection.close()
+
+        self.assertEqual(results, [(200, b"first"), (404, b"second"), (404, b"second")])
+
+    def test_replays_inbound_traffic(self):
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "capture.bin")
+
+        writer = CaptureWriter(path)
+        writer.record_inbound("POST", "/one", {"Host": "qbox.svc"}, b"1")
+        writer.record_inbound("POST", "/two", {"Host": "qbox.svc"}, b"22")
+        writer.close()
+
+        target = ThreadingHTTPServer(("127.0.0.1", 0), TargetHandler)
+        target.received = []
+        self.serve(target)
+
+        _, inbound = load(path)
+        summary = replay(
+            inbound, "http://%s:%d" % target.server_address, speed=0, concurrency=1
+        )
+
+        self.assertEqual(summary["requests"], 2)
+        self.assertEqual(summary["completed"], 2)
+        self.assertEqual(summary["errors"], {})
+        self.assertEqual(target.received, [("/one", "qbox.svc"), ("/two", "qbox.svc")])
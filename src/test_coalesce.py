@@ -0,0 +1,143 @@
+import unittest
+import threading
+import coalesce
+from transport import Response, Headers
+
+
+class TestCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.coalescer = coalesce.Coalescer(
+            ["foo.svc"], ["Authorization"], cache_seconds=60, clock=lambda: self.now
+        )
+        self.sent = 0
+
+    def send(self, headers=(), status=200, content=b"ok"):
+        def send():
+            self.sent += 1
+            return Response(status, Headers(headers), content)
+
+        return send
+
+    def fetch(self, send, url="http://foo.svc/items", headers=None, method="GET"):
+        headers = Headers((headers or {}).items())
+        headers.setdefault("Host", "foo.svc")
+        return self.coalescer.fetch(method, url, headers, b"", send)
+
+    def test_concurrent_identical_requests_share_one_call(self):
+        release = threading.Event()
+        responses = []
+
+        def send():
+            release.wait()
+            self.sent += 1
+            return Response(200, Headers(), b"shared")
+
+        threads = [
+            threading.Thread(target=lambda: responses.append(self.fetch(send)))
+            for _ in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+        while self.coalescer.snapshot()["coalesced"] < 9:
+            pass
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.sent, 1)
+        self.assertEqual([r.content for r in responses], [b"shared"] * 10)
+        snapshot = self.coalescer.snapshot()
+        self.assertEqual((snapshot["upstream"], snapshot["inFlight"]), (1, 0))
+
+    def test_errors_are_shared(self):
+        release = threading.Event()
+        errors = []
+
+        def send():
+            release.wait()
+            raise ConnectionError("refused")
+
+        def fetch():
+            try:
+                self.fetch(send)
+            except ConnectionError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fetch) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while self.coalescer.snapshot()["coalesced"] < 2:
+            pass
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(errors), 3)
+
+    def test_only_opted_in_safe_requests_are_coalesced(self):
+        coalescer = self.coalescer
+        self.assertTrue(coalescer.applies_to("GET", "FOO.svc", b""))
+        self.assertFalse(coalescer.applies_to("POST", "foo.svc", b""))
+        self.assertFalse(coalescer.applies_to("GET", "foo.svc", b"body"))
+        self.assertFalse(coalescer.applies_to("GET", "bar.svc", b""))
+        self.assertTrue(coalesce.Coalescer(["*"], []).applies_to("HEAD", "x", b""))
+
+    def test_responses_are_cached_for_their_max_age(self):
+        send = self.send([("Cache-Control", "public, max-age=10")])
+        self.fetch(send)
+        self.fetch(send)
+        self.assertEqual(self.sent, 1)
+
+        # Different vary headers, urls and methods are cached separately.
+        self.fetch(send, headers={"Authorization": "Bearer other"})
+        self.fetch(send, url="http://foo.svc/other")
+        self.fetch(send, method="HEAD")
+        self.assertEqual(self.sent, 4)
+
+        # Clients can ask for a fresh response.
+        self.fetch(send, headers={"Cache-Control": "no-cache"})
+        self.assertEqual(self.sent, 5)
+
+        self.now = 11
+        self.fetch(send)
+        self.assertEqual(self.sent, 6)
+        self.assertEqual(self.coalescer.snapshot()["cacheHits"], 1)
+
+    def test_cache_ttl_is_capped(self):
+        send = self.send([("Cache-Control", "max-age=3600")])
+        self.fetch(send)
+        self.now = 61
+        self.fetch(send)
+        self.assertEqual(self.sent, 2)
+
+    def test_uncacheable_responses(self):
+        for headers in (
+            [],
+            [("Cache-Control", "no-store, max-age=10")],
+            [("Cache-Control", "private, max-age=10")],
+            [("Cache-Control", "max-age=10"), ("Set-Cookie", "session=1")],
+            [("Cache-Control", "max-age=10"), ("Vary", "*")],
+            [("Cache-Control", "max-age=10"), ("Vary", "Authorization, Accept")],
+            [("Cache-Control", "max-age=10"), ("Age", "10")],
+        ):
+            self.coalescer.cache.clear()
+            self.sent = 0
+            send = self.send(headers)
+            self.fetch(send)
+            self.fetch(send)
+            self.assertEqual(self.sent, 2, headers)
+
+    def test_responses_varying_on_keyed_headers_are_cached(self):
+        send = self.send([("Cache-Control", "max-age=10"), ("Vary", "authorization")])
+        self.fetch(send, headers={"Authorization": "Bearer one"})
+        self.fetch(send, headers={"Authorization": "Bearer one"})
+        self.fetch(send, headers={"Authorization": "Bearer two"})
+        self.assertEqual(self.sent, 2)
+
+    def test_freshness(self):
+        self.assertEqual(
+            coalesce.freshness(Headers([("Cache-Control", 's-maxage="5", max-age=1')])),
+            5,
+        )
+        self.assertIsNone(coalesce.freshness(Headers([("Cache-Control", "max-age=x")])))
@@ -1,14 +1,22 @@
+import os
 import yaml
+import shutil
+import tempfile
 import unittest
+import configuration
 from schema import SchemaError
 from unittest.mock import patch, mock_open
-from configuration import (
+from schemas import (
     ROOT_SCHEMA,
     TRANSACTION_SCHEMA,
     HTTP_REQUEST_SCHEMA,
     HTTP_RESPONSE_SCHEMA,
+)
+from configuration import (
     ConfigurationStore,
     CONFIGURATION_PATH,
+    compile_configuration,
+    load_configuration,
 )
 
 
@@ -119,6 +127,58 @@ class TestConfiguration(unittest.TestCase):
 
         ROOT_SCHEMA.validate(validRoot)
 
+    def test_step_names_are_unique(self):
+
+        step = {
+            "name": "reserve",
+            "method": "POST",
+            "url": "foo.svc",
+            "onFailure": [],
+            "isSuccessIfReceives": [{"status-code": 200}],
+            "timeout": 30,
+        }
+        root = {
+            "host": "me.svc",
+            "matchRequest": {"method": "POST", "url": "qbox.me.svc"},
+            "onMatchedRequest": [step, dict(step, name="charge")],
+        }
+        ROOT_SCHEMA.validate(root)
+
+        with self.assertRaises(SchemaError):
+            ROOT_SCHEMA.validate(dict(root, onMatchedRequest=[step, step]))
+        with self.assertRaises(SchemaError):
+            ROOT_SCHEMA.validate(
+                dict(root, onMatchedRequest=[dict(step, name="not a name")])
+            )
+
+    def test_rate_limits_agree_per_host(self):
+
+        def root(url, limit):
+            step = {
+                "method": "POST",
+                "url": url,
+                "onFailure": [],
+                "isSuccessIfReceives": [{"status-code": 200}],
+                "timeout": 30,
+                "rateLimit": {"requestsPerSecond": limit},
+            }
+            return {
+                "host": "me.svc",
+                "matchRequest": {"method": "POST", "url": "qbox.me.svc"},
+                "onMatchedRequest": [step],
+            }
+
+        compile_configuration(
+            yaml.dump_all([root("http://foo.svc/a", 5), root("http://foo.svc/b", 5)])
+        )
+        compile_configuration(
+            yaml.dump_all([root("http://foo.svc/a", 5), root("http://bar.svc/a", 1)])
+        )
+        with self.assertRaises(SchemaError):
+            compile_configuration(
+                yaml.dump_all([root("http://foo.svc/a", 5), root("https://foo.svc", 1)])
+            )
+
 
 class TestConfigurationManager(unittest.TestCase):
 
@@ -200,3 +260,53 @@ class TestConfigurationManager(unittest.TestCase):
             configuration = configurations[1]
             self.assertIn("matchRequest", configuration)
             self.assertIn("onMatchedRequest", configuration)
+
+
+class TestCompiledConfigurationCache(unittest.TestCase):
+    def setUp(self):
+        configuration._memoized.clear()
+        self.directory = tempfile.mkdtemp()
+        self.text = yaml.dump(TestConfigurationManager.validRoot)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_unchanged_configuration_is_compiled_once(self):
+
+        with patch(
+            "configuration.compile_configuration",
+            wraps=configuration.compile_configuration,
+        ) as compile_mock:
+            first = load_configuration(self.text)
+            second = load_configuration(self.text)
+            load_configuration(self.text + "\n---\n" + self.text)
+
+        self.assertIs(first, second)
+        self.assertEqual(compile_mock.call_count, 2)
+
+    def test_restarts_load_the_cached_artifact(self):
+
+        compiled = load_configuration(self.text, self.directory)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+        configuration._memoized.clear()
+        with patch("configuration.compile_configuration") as compile_mock:
+            cached = load_configuration(self.text, self.directory)
+
+        compile_mock.assert_not_called()
+        self.assertEqual(cached.config, compiled.config)
+        self.assertEqual(
+            cached.router.match("GET", "http://qbox.me.svc"),
+            compiled.router.match("GET", "http://qbox.me.svc"),
+        )
+
+    def test_unreadable_cached_artifact_is_recompiled(self):
+
+        load_configuration(self.text, self.directory)
+        [artifact] = os.listdir(self.directory)
+        with open(os.path.join(self.directory, artifact), "wb") as cached:
+            cached.write(b"not a pickle")
+
+        configuration._memoized.clear()
+        compiled = load_configuration(self.text, self.directory)
+        self.assertEqual(len(compiled.config), 1)
@@ -1,6 +1,9 @@
+import json
 import unittest
 import requests_mock
-from interpolate import interpolate
+from unittest.mock import patch
+from configuration import compile_configuration
+from interpolate import interpolate, as_bytes, compile_json_path
 from coordinator import SagaCoordinator, RequestNode
 
 
@@ -322,3 +325,357 @@ class TestSagaCoordinator(unittest.TestCase):
             self.assertFalse(success)
             self.assertEqual(len(transactions), 1)
             self.assertEqual(len(failed_compensations), 0)
+
+    def test_binary_bodies_pass_through_untouched(self):
+
+        payload = b"\x89PNG\r\n\x1a\n\xff\xfe\x00"
+
+        configuration = {
+            "host": "me.svc",
+            "matchRequest": {"method": "POST", "url": "http://qbox.me.svc/upload"},
+            "onMatchedRequest": [
+                {
+                    "method": "POST",
+                    "url": "http://images.svc/store",
+                    "body": "${root.body}",
+                    "onFailure": [],
+                    "isSuccessIfReceives": [{"status-code": 200}],
+                    "timeout": 30,
+                },
+                {
+                    "method": "POST",
+                    "url": "http://thumbnails.svc/store",
+                    "body": "prefix:${transaction[0].response.body}",
+                    "onFailure": [],
+                    "isSuccessIfReceives": [{"status-code": 200}],
+                    "timeout": 30,
+                },
+            ],
+        }
+
+        with requests_mock.Mocker() as m:
+            m.post("http://images.svc/store", status_code=200, content=payload)
+            m.post("http://thumbnails.svc/store", status_code=200)
+            coordinator = SagaCoordinator(configuration, start_request_body=payload)
+            success, transactions, _ = coordinator.execute_saga()
+
+            self.assertTrue(success)
+            self.assertEqual(m.request_history[0].body, payload)
+            self.assertEqual(transactions[0].response_body, payload)
+
+            out = interpolate(
+                "${transaction[0].response.body}",
+                parent=RequestNode(),
+                root=coordinator.root,
+                transactions=transactions,
+                body=True,
+            )
+            self.assertEqual(out, payload)
+
+            out = interpolate(
+                "image=${transaction[0].response.body}",
+                parent=RequestNode(),
+                root=coordinator.root,
+                transactions=transactions,
+            )
+            self.assertEqual(as_bytes(out), b"image=" + payload)
+
+    def test_bodies_in_headers_are_text(self):
+
+        configuration = {
+            "host": "me.svc",
+            "matchRequest": {"method": "POST", "url": "http://qbox.me.svc/echo"},
+            "onMatchedRequest": [
+                {
+                    "method": "POST",
+                    "url": "http://echo.svc/store",
+                    "headers": {"X-Echo": "${root.body}"},
+                    "onFailure": [],
+                    "isSuccessIfReceives": [
+                        {"status-code": 200, "headers": {"X-Echo": "${root.body}"}}
+                    ],
+                    "timeout": 30,
+                },
+            ],
+        }
+
+        with requests_mock.Mocker() as m:
+            m.post(
+                "http://echo.svc/store", status_code=200, headers={"X-Echo": "hello"}
+            )
+            coordinator = SagaCoordinator(configuration, start_request_body=b"hello")
+            success, _, _ = coordinator.execute_saga()
+
+            self.assertTrue(success)
+            self.assertEqual(m.request_history[0].headers["X-Echo"], "hello")
+
+
+class TestJSONInterpolation(unittest.TestCase):
+    def setUp(self):
+        self.order = RequestNode()
+        self.order.update_response(
+            status=200,
+            body=json.dumps(
+                {
+                    "order": {"id": "o-7", "total": 12.5, "paid": False},
+                    "items": [{"sku": "a"}, {"sku": "b"}],
+                    "shipping-address": {"city": "Providence"},
+                }
+            ).encode("utf-8"),
+        )
+
+    def render(self, line):
+        return interpolate(
+            line, parent=self.order, root=RequestNode(), transactions=[self.order]
+        )
+
+    def test_compile_json_path(self):
+        self.assertEqual(compile_json_path("$.items[0].sku"), ("items", 0, "sku"))
+        self.assertEqual(
+            compile_json_path("$['shipping-address']"), ("shipping-address",)
+        )
+        self.assertEqual(compile_json_path("$"), ())
+
+        with self.assertRaises(ValueError):
+            compile_json_path("$.items[")
+
+    def test_field_extraction(self):
+        self.assertEqual(
+            self.render("/orders/${parent.response.body.json.$.order.id}"),
+            "/orders/o-7",
+        )
+        self.assertEqual(
+            self.render("${transaction[0].response.body.json.$.items[-1].sku}"), "b"
+        )
+        self.assertEqual(
+            self.render("${parent.response.body.json.$.shipping-address.city}"),
+            "Providence",
+        )
+        self.assertEqual(
+            self.render('{"total": ${parent.response.body.json.$.order.total}}'),
+            '{"total": 12.5}',
+        )
+        self.assertEqual(
+            self.render("${parent.response.body.json.$.order.paid}"), "false"
+        )
+
+    def test_missing_fields_use_the_default(self):
+        self.assertEqual(
+            self.render("${parent.response.body.json.$.order.coupon:none}"), "none"
+        )
+        self.assertEqual(
+            self.render("${transaction[3].response.body.json.$.order.id:none}"),
+            "none",
+        )
+        self.assertEqual(self.render("${parent.body.json.$.order:none}"), "none")
+
+    def test_bodies_are_parsed_once(self):
+        with patch("coordinator.json.loads", wraps=json.loads) as loads:
+            for _ in range(3):
+                self.render("${parent.response.body.json.$.order.id}")
+            self.assertEqual(loads.call_count, 1)
+
+            self.order.update_response(body=b'{"order": {"id": "o-8"}}')
+            self.assertEqual(
+                self.render("${parent.response.body.json.$.order.id}"), "o-8"
+            )
+            self.assertEqual(loads.call_count, 2)
+
+    def test_invalid_paths_are_rejected_on_load(self):
+
+        configuration = """
+host: me.svc
+matchRequest:
+  method: POST
+  url: http://qbox.me.svc/orders
+onMatchedRequest:
+  - method: POST
+    url: http://billing.svc/charge/${root.body.json.$.order[}
+    onFailure: []
+    isSuccessIfReceives:
+      - status-code: 200
+    timeout: 3
+onAllSucceeded:
+  status-code: 200
+onAnyFailed:
+  status-code: 500
+"""
+        with self.assertRaises(ValueError):
+            compile_configuration(configuration)
+
+
+class TestSagaContext(unittest.TestCase):
+    def test_earlier_transactions_are_interpolated(self):
+
+        configuration = {
+            "host": "me.svc",
+            "matchRequest": {"method": "POST", "url": "http://qbox.me.svc/orders"},
+            "onMatchedRequest": [
+                {
+                    "name": "reserve",
+                    "method": "POST",
+                    "url": "http://inventory.svc/reservations",
+                    "onFailure": [],
+                    "isSuccessIfReceives": [{"status-code": 201}],
+                    "timeout": 3,
+                },
+                {
+                    "method": "POST",
+                    "url": "http://billing.svc/charges",
+                    "headers": {
+                        "X-Reservation": "${transaction[0].response.headers.Location}",
+                        "X-Missing": "${transaction[5].response.headers.Location:no}",
+                    },
+                    "body": "${steps.reserve.response.body}",
+                    "onFailure": [],
+                    "isSuccessIfReceives": [{"status-code": 200}],
+                    "timeout": 3,
+                },
+                {
+                    "method": "PUT",
+                    "url": "http://shipping.svc/${steps.reserve.request.headers.X-Id}",
+                    "headers": {
+                        "X-Id": "${transaction[1].request.headers.X-Reservation}"
+                    },
+                    "onFailure": [],
+                    "isSuccessIfReceives": [{"status-code": 200}],
+                    "timeout": 3,
+                },
+            ],
+        }
+
+        with requests_mock.Mocker() as m:
+            m.post(
+                "http://inventory.svc/reservations",
+                status_code=201,
+                headers={"Location": "/reservations/r-1"},
+                content=b"\xffreserved",
+            )
+            m.post("http://billing.svc/charges", status_code=200)
+            m.put("http://shipping.svc/", status_code=200)
+
+            coordinator = SagaCoordinator(configuration)
+            success, _, _ = coordinator.execute_saga()
+
+            self.assertTrue(success)
+            charge = m.request_history[1]
+            self.assertEqual(charge.headers["X-Reservation"], "/reservations/r-1")
+            self.assertEqual(charge.headers["X-Missing"], "no")
+            self.assertEqual(charge.body, b"\xffreserved")
+            self.assertEqual(m.request_history[2].headers["X-Id"], "/reservations/r-1")
+
+        self.assertIs(coordinator.context.step("reserve"), coordinator.root.children[0])
+        self.assertEqual(len(coordinator.context.transactions), 3)
+
+    def test_unknown_references_are_left_alone(self):
+        self.assertEqual(
+            interpolate(
+                "${env.HOME} and ${root.body:empty}",
+                parent=RequestNode(),
+                root=RequestNode(),
+            ),
+            "${env.HOME} and empty",
+        )
+
+
+class TestConditionalSteps(unittest.TestCase):
+    def configuration(self):
+        return {
+            "host": "me.svc",
+            "matchRequest": {"method": "POST", "url": "http://qbox.me.svc/orders"},
+            "onMatchedRequest": [
+                {
+                    "method": "POST",
+                    "url": "http://fraud.svc/checks",
+                    "when": "${root.headers.X-Amount:0} >= 100",
+                    "onFailure": [
+                        {
+                            "method": "DELETE",
+                            "url": "http://fraud.svc/checks",
+                            "timeout": 3,
+                            "isSuccessIfReceives": [{"status-code": 200}],
+                        }
+                    ],
+                    "isSuccessIfReceives": [{"status-code": 200}],
+                    "timeout": 3,
+                },
+                {
+                    "method": "POST",
+                    "url": "http://billing.svc/charges",
+                    "headers": {
+                        "X-Check": "${transaction[0].response.headers.Id:none}"
+                    },
+                    "exitWhen": '${transaction[1].response.body.json.$.status} == "done"',
+                    "onFailure": [
+                        {
+                            "method": "DELETE",
+                            "url": "http://billing.svc/charges",
+                            "timeout": 3,
+                            "isSuccessIfReceives": [{"status-code": 200}],
+                        }
+                    ],
+                    "isSuccessIfReceives": [{"status-code": 200}],
+                    "timeout": 3,
+                },
+                {
+                    "method": "POST",
+                    "url": "http://shipping.svc/shipments",
+                    "onFailure": [],
+                    "isSuccessIfReceives": [{"status-code": 200}],
+                    "timeout": 3,
+                },
+            ],
+        }
+
+    def test_skipped_steps_are_not_sent_or_compensated(self):
+        with requests_mock.Mocker() as m:
+            m.post("http://billing.svc/charges", status_code=200, json={})
+            m.post("http://shipping.svc/shipments", status_code=500)
+            m.delete("http://billing.svc/charges", status_code=200)
+
+            coordinator = SagaCoordinator(
+                self.configuration(), start_request_headers={"X-Amount": "20"}
+            )
+            success, transactions, _ = coordinator.execute_saga()
+
+            self.assertFalse(success)
+            self.assertEqual(
+                [(r.method, r.url) for r in m.request_history],
+                [
+                    ("POST", "http://billing.svc/charges"),
+                    ("POST", "http://shipping.svc/shipments"),
+                    ("DELETE", "http://billing.svc/charges"),
+                ],
+            )
+            # Indices still refer to positions in the configuration.
+            self.assertEqual(m.request_history[0].headers["X-Check"], "none")
+            self.assertEqual([node.step for node in transactions], [1])
+
+    def test_steps_run_when_their_predicate_holds(self):
+        with requests_mock.Mocker() as m:
+            m.post("http://fraud.svc/checks", status_code=200, headers={"Id": "c-1"})
+            m.post("http://billing.svc/charges", status_code=200, json={})
+            m.post("http://shipping.svc/shipments", status_code=200)
+
+            coordinator = SagaCoordinator(
+                self.configuration(), start_request_headers={"X-Amount": "150"}
+            )
+            success, transactions, _ = coordinator.execute_saga()
+
+            self.assertTrue(success)
+            self.assertEqual(len(m.request_history), 3)
+            self.assertEqual(m.request_history[1].headers["X-Check"], "c-1")
+
+    def test_exit_when_ends_the_saga_early(self):
+        with requests_mock.Mocker() as m:
+            m.post(
+                "http://billing.svc/charges", status_code=200, json={"status": "done"}
+            )
+
+            coordinator = SagaCoordinator(self.configuration())
+            success, transactions, _ = coordinator.execute_saga()
+
+            self.assertTrue(success)
+            self.assertEqual(
+                [r.url for r in m.request_history], ["http://billing.svc/charges"]
+            )
@@ -0,0 +1,95 @@
+import events
+import unittest
+import threading
+import requests_mock
+from unittest.mock import patch
+from coordinator import SagaCoordinator
+
+
+class TestEventBus(unittest.TestCase):
+    def setUp(self):
+        self.bus = events.EventBus(history_size=4)
+
+    def test_subscribers_only_see_their_saga(self):
+        with self.bus.subscribe("a") as mine, self.bus.subscribe() as everything:
+            self.bus.publish("sent", "a")
+            self.bus.publish("sent", "b")
+
+            self.assertEqual([e["transaction"] for e in mine.get(0)], ["a"])
+            self.assertEqual([e["transaction"] for e in everything.get(0)], ["a", "b"])
+
+        self.assertEqual(self.bus.snapshot()["subscribers"], 0)
+
+    def test_slow_subscribers_lose_the_oldest_events(self):
+        with self.bus.subscribe(capacity=2) as subscription:
+            for step in range(5):
+                self.bus.publish("sent", "a", step=step)
+
+            self.assertEqual([e["step"] for e in subscription.get(0)], [3, 4])
+            self.assertEqual(subscription.dropped, 3)
+
+    def test_history_replay(self):
+        published = [self.bus.publish("sent", "a", step=step) for step in range(6)]
+
+        with self.bus.subscribe(since=published[2]["sequence"]) as subscription:
+            self.assertEqual([e["step"] for e in subscription.get(0)], [3, 4, 5])
+
+    def test_get_waits_for_events(self):
+        with self.bus.subscribe() as subscription:
+            threading.Timer(0.05, self.bus.publish, ("sent", "a")).start()
+            self.assertEqual(len(subscription.get(5)), 1)
+            self.assertEqual(subscription.get(0.01), [])
+
+
+class TestSagaEvents(unittest.TestCase):
+    def test_saga_transitions_are_published(self):
+
+        configuration = {
+            "host": "me.svc",
+            "matchRequest": {"method": "POST", "url": "http://qbox.me.svc/orders"},
+            "onMatchedRequest": [
+                {
+                    "method": "POST",
+                    "url": f"http://step{step}.svc/orders",
+                    "onFailure": [
+                        {
+                            "method": "DELETE",
+                            "url": f"http://step{step}.svc/orders",
+                            "timeout": 3,
+                            "isSuccessIfReceives": [{"status-code": 200}],
+                        }
+                    ],
+                    "isSuccessIfReceives": [{"status-code": 200}],
+                    "timeout": 3,
+                }
+                for step in range(2)
+            ],
+        }
+
+        bus = events.EventBus()
+        with patch("events.bus", bus), requests_mock.Mocker() as m:
+            m.post("http://step0.svc/orders", status_code=200)
+            m.post("http://step1.svc/orders", status_code=500)
+            m.delete("http://step0.svc/orders", status_code=200)
+
+            coordinator = SagaCoordinator(configuration)
+            with bus.subscribe(coordinator.identifier) as subscription:
+                coordinator.execute_saga()
+                published = subscription.get(0)
+
+        self.assertEqual(
+            [(e["type"], e.get("url")) for e in published],
+            [
+                ("started", "http://qbox.me.svc/orders"),
+                ("sent", "http://step0.svc/orders"),
+                ("succeeded", "http://step0.svc/orders"),
+                ("sent", "http://step1.svc/orders"),
+                ("failed", "http://step1.svc/orders"),
+                ("sent", "http://step0.svc/orders"),
+                ("compensated", "http://step0.svc/orders"),
+                ("finished", None),
+            ],
+        )
+        self.assertEqual(published[4]["status"], 500)
+        self.assertEqual(published[5]["messageType"], "COMPENSATION")
+        self.assertFalse(published[-1]["success"])
@@ -0,0 +1,92 @@
+import random
+import latency
+import unittest
+import requests_mock
+from unittest.mock import patch
+from coordinator import SagaCoordinator
+
+
+class TestQuantileSketch(unittest.TestCase):
+    def test_quantiles_are_within_the_accuracy(self):
+        sketch = latency.QuantileSketch()
+        values = [random.uniform(0.001, 2.0) for _ in range(5000)]
+        for value in values:
+            sketch.add(value)
+
+        values.sort()
+        for q in (0.5, 0.9, 0.99):
+            exact = values[int(q * (len(values) - 1))]
+            self.assertAlmostEqual(sketch.quantile(q), exact, delta=exact * 0.03)
+
+    def test_old_latencies_fade_out(self):
+        sketch = latency.QuantileSketch(max_count=100)
+        for _ in range(99):
+            sketch.add(5.0)
+        for _ in range(400):
+            sketch.add(0.01)
+
+        self.assertLess(sketch.count, 100)
+        self.assertAlmostEqual(sketch.quantile(0.99), 0.01, delta=0.001)
+
+    def test_empty_sketches_have_no_quantiles(self):
+        self.assertIsNone(latency.QuantileSketch().quantile(0.5))
+
+
+class TestAdaptiveTimeouts(unittest.TestCase):
+    def setUp(self):
+        patcher = patch("latency._sketches", {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_static_timeouts_are_kept(self):
+        self.assertEqual(latency.timeout_for({"timeout": 3}, "http://a.svc/x"), 3)
+
+    def test_adaptive_timeouts_follow_the_host(self):
+        transaction = {
+            "timeout": "adaptive",
+            "adaptiveTimeout": {"quantile": 0.9, "multiplier": 3, "maxSeconds": 10},
+        }
+
+        # Not enough samples yet.
+        self.assertEqual(latency.timeout_for(transaction, "http://a.svc/x"), 10)
+
+        for _ in range(50):
+            latency.observe("http://a.svc/y", 0.2)
+        self.assertAlmostEqual(
+            latency.timeout_for(transaction, "http://a.svc/x"), 0.6, delta=0.02
+        )
+
+        # Bounded below, and other hosts have their own sketches.
+        for _ in range(50):
+            latency.observe("http://b.svc/y", 0.001)
+        self.assertEqual(latency.timeout_for(transaction, "http://b.svc/x"), 0.05)
+        self.assertEqual(sorted(latency.snapshot()), ["a.svc", "b.svc"])
+
+    def test_coordinators_send_with_adaptive_timeouts(self):
+
+        configuration = {
+            "host": "me.svc",
+            "matchRequest": {"method": "POST", "url": "http://qbox.me.svc/orders"},
+            "onMatchedRequest": [
+                {
+                    "method": "POST",
+                    "url": "http://orders.svc/orders",
+                    "timeout": "adaptive",
+                    "adaptiveTimeout": {"maxSeconds": 5},
+                    "onFailure": [],
+                    "isSuccessIfReceives": [{"status-code": 200}],
+                }
+            ],
+        }
+
+        with requests_mock.Mocker() as m:
+            m.post("http://orders.svc/orders", status_code=200)
+            SagaCoordinator(configuration).execute_saga()
+            self.assertEqual(m.request_history[0].timeout, 5)
+
+            for _ in range(50):
+                latency.observe("http://orders.svc/", 0.5)
+            SagaCoordinator(configuration).execute_saga()
+            self.assertAlmostEqual(m.request_history[1].timeout, 1.0, delta=0.05)
+
+        self.assertEqual(latency.snapshot()["orders.svc"]["count"], 52)
@@ -0,0 +1,271 @@
+import os
+import time
+import importlib
+import settings
+import leases
+import shutil
+import tempfile
+import unittest
+import threading
+import statestore
+import requests_mock
+from unittest.mock import patch
+from coordinator import SagaCoordinator
+from test_statestore import SharedMemoryStore
+
+CONFIGURATION = {
+    "host": "me.svc",
+    "matchRequest": {"method": "POST", "url": "http://qbox.me.svc/orders"},
+    "onMatchedRequest": [
+        {
+            "method": "POST",
+            "url": f"http://step{step}.svc/orders",
+            "onFailure": [
+                {
+                    "method": "DELETE",
+                    "url": f"http://step{step}.svc/orders",
+                    "timeout": 3,
+                    "maxRetriesOnTimeout": 1,
+                    "isSuccessIfReceives": [{"status-code": 200}],
+                }
+            ],
+            "isSuccessIfReceives": [{"status-code": 200}],
+            "timeout": 3,
+        }
+        for step in range(3)
+    ],
+}
+
+
+def orphan(store, steps=2, owner="gone"):
+    """
+    Leave behind the record of a saga that got through `steps` transactions on a
+    replica that went away.
+    """
+
+    coordinator = SagaCoordinator(
+        CONFIGURATION, start_request_body=b"\xff\x00", store=store
+    )
+    with requests_mock.Mocker() as m:
+        for step in range(steps):
+            m.post(f"http://step{step}.svc/orders", status_code=200)
+        for transaction in CONFIGURATION["onMatchedRequest"][:steps]:
+            coordinator.send(transaction, parent=coordinator.root).add_parent(
+                coordinator.root
+            )
+
+    record = coordinator.snapshot(statestore.COMPENSATING)
+    record["owner"] = owner
+    store.save(coordinator.identifier, record)
+    return record
+
+
+class TestLeaseKeeper(unittest.TestCase):
+    def test_heartbeats_keep_leases(self):
+        store = statestore.MemoryStore()
+        keeper = leases.LeaseKeeper(store, owner="one", ttl=0.2)
+        lease = keeper.acquire("saga:a")
+
+        time.sleep(0.1)
+        keeper.heartbeat()
+        time.sleep(0.15)
+        self.assertTrue(lease.held())
+        self.assertEqual(store.lease_owner("saga:a"), "one")
+
+        keeper.release(lease)
+        self.assertFalse(lease.held())
+        self.assertIsNone(store.lease_owner("saga:a"))
+
+    def test_release_all(self):
+        store = statestore.MemoryStore()
+        keeper = leases.LeaseKeeper(store, owner="one", ttl=5)
+        held = [keeper.acquire(name) for name in ("replica:one", "saga:a")]
+
+        keeper.release_all()
+        self.assertFalse(any(lease.held() for lease in held))
+        self.assertIsNone(store.lease_owner("replica:one"))
+        self.assertIsNone(store.lease_owner("saga:a"))
+
+    def test_hold_waits_for_the_lease(self):
+        store = statestore.MemoryStore()
+        previous = leases.LeaseKeeper(store, owner="one", ttl=0.1)
+        previous.acquire("replica:one")
+
+        keeper = leases.LeaseKeeper(store, owner="one", ttl=0.1)
+        lease = keeper.hold("replica:one", interval=0.02)
+        self.assertTrue(lease.held())
+        self.assertEqual(store.lease_owner("replica:one"), "one")
+
+    def test_replica_ids_are_unique_per_process(self):
+        with patch.dict(os.environ):
+            os.environ.pop("QBOX_REPLICA_ID", None)
+            ids = {importlib.reload(settings).REPLICA_ID for _ in range(2)}
+        importlib.reload(settings)
+        self.assertEqual(len(ids), 2)
+
+    def test_leases_taken_over_are_lost(self):
+        store = statestore.MemoryStore()
+        keeper = leases.LeaseKeeper(store, owner="one", ttl=0.05)
+        lease = keeper.acquire("saga:a")
+
+        time.sleep(0.1)
+        self.assertFalse(lease.held())
+        other = leases.LeaseKeeper(store, owner="two").acquire("saga:a")
+        self.assertGreater(other.token, lease.token)
+
+        keeper.heartbeat()
+        self.assertTrue(lease.lost)
+        with self.assertRaises(leases.LeaseLost):
+            lease.check()
+
+
+class TestRecovery(unittest.TestCase):
+    def setUp(self):
+        self.store = SharedMemoryStore()
+        self.keeper = leases.LeaseKeeper(self.store, owner="here")
+        self.recovery = leases.Recovery(
+            self.keeper,
+            lambda record, lease: SagaCoordinator.resume(
+                record, lease, store=self.store
+            ),
+        )
+
+    def test_orphaned_sagas_are_compensated(self):
+        record = orphan(self.store)
+
+        with requests_mock.Mocker() as m:
+            m.delete("http://step0.svc/orders", status_code=200)
+            m.delete("http://step1.svc/orders", status_code=200)
+            self.assertEqual(self.recovery.recover(), 1)
+
+            self.assertEqual(
+                [(r.method, r.url) for r in m.request_history],
+                [
+                    ("DELETE", "http://step0.svc/orders"),
+                    ("DELETE", "http://step1.svc/orders"),
+                ],
+            )
+            headers = m.request_history[0].headers
+            self.assertEqual(headers["X-Qbox-TransactionID"], record["id"])
+            self.assertEqual(headers["X-Qbox-Fencing-Token"], "1")
+
+        self.assertEqual(self.store.records(), [])
+        self.assertIsNone(self.store.lease_owner(leases.saga_lease(record["id"])))
+
+    def test_issued_compensations_are_skipped(self):
+        record = orphan(self.store)
+        record["transactions"][1]["compensated"] = [0]
+        self.store.save(record["id"], record)
+
+        with requests_mock.Mocker() as m:
+            m.delete("http://step0.svc/orders", status_code=200)
+            self.assertEqual(self.recovery.recover(), 1)
+            self.assertEqual(
+                [r.url for r in m.request_history], ["http://step0.svc/orders"]
+            )
+
+    def test_sagas_of_live_replicas_are_left_alone(self):
+        orphan(self.store, owner="alive")
+        leases.LeaseKeeper(self.store, owner="alive").acquire(
+            leases.replica_lease("alive")
+        )
+        orphan(self.store, owner="here")
+
+        self.assertEqual(self.recovery.orphans(), [])
+
+    def test_own_sagas_left_by_an_earlier_process_are_compensated(self):
+        stale = orphan(self.store, owner="here")
+        stale["updated"] = self.keeper.started - 60
+        self.store.save(stale["id"], stale)
+        orphan(self.store, owner="here")
+
+        self.assertEqual(
+            [record["id"] for record in self.recovery.orphans()], [stale["id"]]
+        )
+
+    def test_sagas_leased_elsewhere_are_skipped(self):
+        record = orphan(self.store)
+        self.store.acquire_lease(leases.saga_lease(record["id"]), "other", 5)
+
+        self.assertEqual(self.recovery.recover(), 0)
+
+    def test_compensation_stops_when_the_lease_is_lost(self):
+        record = orphan(self.store)
+        lease = self.keeper.acquire(leases.saga_lease(record["id"]))
+        lease.lost = True
+
+        with requests_mock.Mocker() as m:
+            with self.assertRaises(leases.LeaseLost):
+                SagaCoordinator.resume(record, lease, store=self.store)
+            self.assertEqual(m.request_history, [])
+
+    def test_sagas_are_handed_back_when_the_lease_is_lost(self):
+        record = orphan(self.store)
+        name = leases.saga_lease(record["id"])
+
+        def lose_the_lease(request, context):
+            self.keeper.leases[name].lost = True
+            return ""
+
+        with requests_mock.Mocker() as m:
+            m.delete("http://step0.svc/orders", text=lose_the_lease)
+            m.delete("http://step1.svc/orders", text=lose_the_lease)
+            self.assertEqual(self.recovery.recover(), 0)
+            self.assertEqual(len(m.request_history), 1)
+
+        handed_back = self.store.get(record["id"])
+        self.assertEqual(handed_back["owner"], "gone")
+        self.assertEqual(handed_back["updated"], record["updated"])
+        self.assertEqual(self.recovery.orphans(), [handed_back])
+
+        with requests_mock.Mocker() as m:
+            m.delete("http://step0.svc/orders", status_code=200)
+            m.delete("http://step1.svc/orders", status_code=200)
+            self.assertEqual(self.recovery.recover(), 1)
+            # The compensation issued before the lease was lost isn't issued again.
+            self.assertEqual(len(m.request_history), 1)
+        self.assertEqual(self.store.records(), [])
+
+
+class TestRecoveryAcrossReplicas(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replicas_split_the_backlog(self):
+        path = f"sqlite://{os.path.join(self.directory, 'state.db')}"
+        backlog = statestore.from_url(path)
+        for _ in range(20):
+            orphan(backlog)
+        backlog.flush()
+
+        lock = threading.Lock()
+        resumed = []
+
+        def resumer(store):
+            def resume(record, lease):
+                with lock:
+                    resumed.append((lease.owner, record["id"]))
+                time.sleep(0.01)
+                store.delete(record["id"])
+
+            return resume
+
+        workers = []
+        for name in ("one", "two", "three"):
+            store = statestore.from_url(path)
+            keeper = leases.LeaseKeeper(store, owner=name)
+            workers.append(leases.Recovery(keeper, resumer(store)))
+
+        threads = [threading.Thread(target=worker.recover) for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        saga_ids = [saga_id for _, saga_id in resumed]
+        self.assertEqual(len(saga_ids), 20)
+        self.assertEqual(len(set(saga_ids)), 20)
+        self.assertGreater(len(set(owner for owner, _ in resumed)), 1)
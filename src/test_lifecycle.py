@@ -0,0 +1,104 @@
+import socket
+import unittest
+import threading
+import lifecycle
+import http.client
+from readiness import Readiness
+from unittest.mock import patch, MagicMock
+from http.server import BaseHTTPRequestHandler
+
+
+class OkHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+class TestInFlight(unittest.TestCase):
+    def test_wait(self):
+        in_flight = lifecycle.InFlight()
+        self.assertTrue(in_flight.wait(0))
+
+        release = threading.Event()
+
+        def work():
+            with in_flight.track():
+                release.wait()
+
+        worker = threading.Thread(target=work)
+        worker.start()
+        while not in_flight.count:
+            pass
+        self.assertFalse(in_flight.wait(0.05))
+
+        release.set()
+        self.assertTrue(in_flight.wait(5))
+        worker.join()
+
+
+class TestServer(unittest.TestCase):
+    def test_serves_on_an_inherited_socket(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        port = listener.getsockname()[1]
+
+        with patch("settings.LISTEN_FD", listener.detach()):
+            httpd = lifecycle.create_server(("127.0.0.1", 1), OkHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+
+        self.assertEqual(httpd.server_port, port)
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        connection.request("GET", "/")
+        self.assertEqual(connection.getresponse().read(), b"ok")
+
+    def test_drain(self):
+        httpd = lifecycle.create_server(("127.0.0.1", 0), OkHandler)
+        serving = threading.Thread(target=httpd.serve_forever)
+        serving.start()
+        self.addCleanup(httpd.server_close)
+
+        in_flight = lifecycle.InFlight()
+        readiness = Readiness()
+        store = MagicMock(shared=True)
+        stopped = []
+        release = threading.Event()
+
+        def saga():
+            with in_flight.track():
+                release.wait()
+
+        worker = threading.Thread(target=saga)
+        worker.start()
+        while not in_flight.count:
+            pass
+
+        with patch("lifecycle.in_flight", in_flight), patch(
+            "lifecycle.readiness", readiness
+        ), patch("statestore.store", store), patch("leases.keeper") as keeper:
+            drain = lifecycle.Drain(
+                httpd, seconds=5, stopping=[lambda: stopped.append(True)]
+            )
+            drain.start(replace=False)
+
+            # The server stops accepting at once, but the saga is waited for.
+            serving.join(5)
+            self.assertFalse(serving.is_alive())
+            self.assertTrue(in_flight.draining)
+            self.assertFalse(readiness.is_ready())
+            self.assertTrue(drain.thread.is_alive())
+
+            release.set()
+            drain.wait()
+
+        self.assertEqual(stopped, [True])
+
+        store.flush.assert_called_once_with(timeout=5)
+        keeper.release_all.assert_called_once_with()
@@ -0,0 +1,179 @@
+import time
+import bulkhead
+import unittest
+import lifecycle
+import statestore
+import requests_mock
+from outbox import Outbox
+from unittest.mock import patch, MagicMock
+from coordinator import SagaCoordinator
+from test_statestore import SharedMemoryStore
+
+
+def configuration(priority=0):
+    return {
+        "host": "orders.svc",
+        "compensationPriority": priority,
+        "matchRequest": {"method": "POST", "url": "/orders"},
+        "onMatchedRequest": [
+            {
+                "method": "POST",
+                "url": "http://billing.svc/charges",
+                "onFailure": [
+                    {
+                        "method": "DELETE",
+                        "url": "http://billing.svc/charges",
+                        "timeout": 3,
+                        "isSuccessIfReceives": [{"status-code": 200}],
+                    }
+                ],
+                "isSuccessIfReceives": [{"status-code": 200}],
+                "timeout": 3,
+            },
+            {
+                "method": "POST",
+                "url": "http://shipping.svc/shipments",
+                "onFailure": [],
+                "isSuccessIfReceives": [{"status-code": 200}],
+                "timeout": 3,
+            },
+        ],
+    }
+
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        # Shared, as the outbox is only durable with a store other replicas see.
+        self.store = SharedMemoryStore()
+        self.in_flight = lifecycle.InFlight()
+        patcher = patch("lifecycle.in_flight", self.in_flight)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def use(self, outbox):
+        patcher = patch("coordinator.outbox", outbox)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return outbox
+
+    def test_failed_sagas_are_answered_before_compensating(self):
+        outbox = self.use(Outbox(workers=1, max_attempts=3, backoff_seconds=0))
+
+        with requests_mock.Mocker() as m:
+            m.post("http://billing.svc/charges", status_code=200)
+            m.post("http://shipping.svc/shipments", status_code=500)
+            m.delete("http://billing.svc/charges", status_code=200)
+
+            with patch.object(outbox, "start"):
+                coordinator = SagaCoordinator(configuration(), store=self.store)
+                success, _, failed = coordinator.execute_saga()
+
+            self.assertFalse(success)
+            self.assertEqual(failed, [])
+            self.assertEqual(len(m.request_history), 2)
+            self.store.flush()
+            record = self.store.get(coordinator.identifier)
+            self.assertEqual(record["status"], statestore.COMPENSATING)
+
+            outbox.start()
+            self.assertTrue(self.in_flight.wait(5))
+
+        self.assertEqual(m.request_history[-1].method, "DELETE")
+        self.assertEqual(outbox.snapshot()["completed"], 1)
+        self.store.flush()
+        self.assertIsNone(self.store.get(coordinator.identifier))
+
+    def test_compensations_are_retried_then_dead_lettered(self):
+        outbox = self.use(Outbox(workers=1, max_attempts=3, backoff_seconds=0))
+
+        with requests_mock.Mocker() as m:
+            m.post("http://billing.svc/charges", status_code=200)
+            m.post("http://shipping.svc/shipments", status_code=500)
+            m.delete("http://billing.svc/charges", status_code=503)
+
+            coordinator = SagaCoordinator(configuration(), store=self.store)
+            coordinator.execute_saga()
+            self.assertTrue(self.in_flight.wait(5))
+
+        methods = [r.method for r in m.request_history]
+        self.assertEqual(methods.count("DELETE"), 3)
+        snapshot = outbox.snapshot()
+        self.assertEqual((snapshot["retried"], snapshot["deadLettered"]), (2, 1))
+        self.store.flush()
+        record = self.store.get(coordinator.identifier)
+        self.assertEqual(record["status"], statestore.FAILED)
+
+    def test_retried_compensations_can_succeed(self):
+        outbox = self.use(Outbox(workers=1, max_attempts=3, backoff_seconds=0))
+
+        with requests_mock.Mocker() as m:
+            m.post("http://billing.svc/charges", status_code=200)
+            m.post("http://shipping.svc/shipments", status_code=500)
+            m.delete(
+                "http://billing.svc/charges",
+                [{"status_code": 503}, {"status_code": 200}],
+            )
+
+            SagaCoordinator(configuration(), store=self.store).execute_saga()
+            self.assertTrue(self.in_flight.wait(5))
+
+        snapshot = outbox.snapshot()
+        self.assertEqual((snapshot["retried"], snapshot["completed"]), (1, 1))
+        self.assertEqual(self.store.records(), [])
+
+    def test_workers_are_not_held_by_a_full_bulkhead(self):
+        outbox = self.use(Outbox(workers=1, max_attempts=100, backoff_seconds=0))
+        saga = configuration()
+        saga["bulkhead"] = {"name": "outboxed", "maxConnections": 1}
+        saga["onMatchedRequest"][0]["onFailure"][0]["timeout"] = 0.01
+        self.addCleanup(bulkhead._bulkheads.pop, "outboxed", None)
+
+        with requests_mock.Mocker() as m:
+            m.post("http://billing.svc/charges", status_code=200)
+            m.post("http://shipping.svc/shipments", status_code=500)
+            m.delete("http://billing.svc/charges", status_code=200)
+
+            with patch.object(outbox, "start"):
+                SagaCoordinator(saga, store=self.store).execute_saga()
+
+            # Another saga holds the only connection.
+            pool = bulkhead.bulkhead_for(saga)
+            pool.connect()
+            outbox.start()
+            deadline = time.monotonic() + 5
+            while not outbox.snapshot()["retried"]:
+                self.assertLess(time.monotonic(), deadline, "The worker is held")
+                time.sleep(0.01)
+
+            pool.disconnect()
+            self.assertTrue(self.in_flight.wait(5))
+
+        self.assertEqual(outbox.snapshot()["completed"], 1)
+        self.assertEqual([r.method for r in m.request_history].count("DELETE"), 1)
+
+    def test_higher_priorities_go_first(self):
+        # Without workers, jobs are only queued.
+        outbox = Outbox(workers=0, max_attempts=3, backoff_seconds=0)
+        for priority in (0, 5, 1, 5):
+            outbox.submit(MagicMock(configuration={"compensationPriority": priority}))
+
+        taken = [outbox.take().priority for _ in range(4)]
+        self.assertEqual(taken, [5, 5, 1, 0])
+
+    def test_retries_wait_for_their_backoff(self):
+        now = [0.0]
+        outbox = Outbox(
+            workers=0, max_attempts=3, backoff_seconds=10, clock=lambda: now[0]
+        )
+        outbox.submit(MagicMock(configuration={}))
+        job = outbox.take()
+        job.attempts = 1
+        outbox.retry(job)
+
+        self.assertEqual(outbox.snapshot()["scheduled"], 1)
+        now[0] = 10
+        self.assertIs(outbox.take(), job)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+import pool
+import unittest
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class CountingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+class CountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), CountingHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+
+
+class StaticDNSCache(pool.DNSCache):
+    def __init__(self, ttl, answers):
+        super().__init__(ttl)
+        self.answers = answers
+        self.lookups = 0
+
+    def lookup(self, host):
+        self.lookups += 1
+        answer = self.answers[host]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+class TestDownstreamHosts(unittest.TestCase):
+    def test_hosts_of_transactions_and_compensations(self):
+
+        configurations = [
+            {
+                "onMatchedRequest": [
+                    {
+                        "url": "http://Orders.svc/orders/${root.path.id}",
+                        "onFailure": [{"url": "payments.svc:8080/refund"}],
+                    },
+                    {"url": "http://orders.svc/other", "onFailure": []},
+                    {"url": "http://${root.headers.Region:eu}.billing.svc/charge"},
+                    {"url": "http://${root.headers.Host}/unknown"},
+                ]
+            }
+        ]
+
+        self.assertEqual(
+            pool.downstream_hosts(configurations),
+            ["http://eu.billing.svc", "http://orders.svc", "http://payments.svc:8080"],
+        )
+
+
+class TestDNSCache(unittest.TestCase):
+    def test_caches_until_ttl_and_rotates(self):
+        cache = StaticDNSCache(60, {"orders.svc": ["10.0.0.1", "10.0.0.2"]})
+
+        self.assertEqual(cache.resolve("orders.svc"), "10.0.0.1")
+        self.assertIn(cache.resolve("orders.svc"), ["10.0.0.1", "10.0.0.2"])
+        self.assertEqual(cache.lookups, 1)
+        self.assertEqual(cache.resolve("127.0.0.1"), "127.0.0.1")
+
+    def test_serves_stale_entries_when_resolution_fails(self):
+        cache = StaticDNSCache(0, {"orders.svc": ["10.0.0.1"]})
+        cache.resolve("orders.svc")
+
+        cache.answers["orders.svc"] = OSError("no nameserver")
+        self.assertEqual(cache.resolve("orders.svc"), "10.0.0.1")
+        self.assertEqual(cache.lookups, 2)
+
+        cache.answers["unknown.svc"] = OSError("no nameserver")
+        self.assertEqual(cache.resolve("unknown.svc"), "unknown.svc")
+
+
+class TestWarm(unittest.TestCase):
+    def setUp(self):
+        self.server = CountingServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_warm_connections_are_reused(self):
+        self.assertEqual(pool.warm([self.url], connections=3), {self.url: 3})
+
+        for _ in range(5):
+            response = pool.session().get(f"{self.url}/orders")
+            self.assertEqual(response.content, b"ok")
+
+        self.assertEqual(self.server.connections, 3)
+
+        # Warming again only tops the pool up.
+        self.assertEqual(pool.warm([self.url], connections=3), {self.url: 3})
+        self.assertEqual(self.server.connections, 3)
+
+    def test_unreachable_hosts_are_skipped(self):
+        unreachable = "http://127.0.0.1:1"
+        self.assertEqual(
+            pool.warm([unreachable, self.url], connections=2),
+            {unreachable: 0, self.url: 2},
+        )
@@ -0,0 +1,52 @@
+import unittest
+from coordinator import RequestNode
+from interpolate import SagaContext
+from predicates import compile_predicate
+
+
+class TestPredicates(unittest.TestCase):
+    def setUp(self):
+        self.root = RequestNode()
+        self.root.update_request(
+            headers={"X-Amount": "250", "X-Country": "US"},
+            body=b'{"order": {"risk": "high", "items": 3}}',
+        )
+        self.context = SagaContext(self.root)
+
+    def holds(self, expression):
+        return compile_predicate(expression).evaluate(self.root, self.context)
+
+    def test_references_compare_as_json_values(self):
+        self.assertTrue(self.holds("${root.headers.X-Amount} >= 100"))
+        self.assertTrue(self.holds('${root.headers.X-Country} == "US"'))
+        self.assertTrue(self.holds("${root.body.json.$.order.items} * 2 == 6"))
+        self.assertTrue(
+            self.holds('${root.body.json.$.order.risk} in ["high", "unknown"]')
+        )
+        self.assertFalse(
+            self.holds(
+                'not (${root.headers.X-Amount} > 100 and ${root.headers.X-Country} == "US")'
+            )
+        )
+
+    def test_missing_references_are_null(self):
+        self.assertTrue(self.holds("${root.headers.X-Coupon} == null"))
+        self.assertTrue(
+            self.holds("${transaction[0].response.headers.Location} == null")
+        )
+        self.assertTrue(self.holds("${root.headers.X-Coupon:10} == 10"))
+
+    def test_incomparable_values_dont_hold(self):
+        self.assertFalse(self.holds("${root.headers.X-Country} > 3"))
+
+    def test_invalid_predicates_are_rejected(self):
+        for expression in (
+            "${root.headers.X-Amount} >",
+            "__import__('os')",
+            "${root.headers.X-Amount}.real",
+            "amount > 3",
+            "${env.HOME} == 1",
+            "[x for x in ${root.body}]",
+        ):
+            with self.assertRaises(ValueError, msg=expression):
+                compile_predicate(expression)
@@ -0,0 +1,74 @@
+import os
+import time
+import shutil
+import profiler
+import tempfile
+import unittest
+import threading
+from unittest.mock import patch
+
+
+@profiler.profiled
+def handle(seconds):
+    return spin_in_a_distinctive_function(seconds)
+
+
+def spin_in_a_distinctive_function(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+    return "handled"
+
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        profiler.stop()
+        shutil.rmtree(self.directory)
+
+    def test_sessions_are_bounded(self):
+        for seconds, fraction in ((float("nan"), 1), (-1, 1), (5, 0), (5, 1.5)):
+            with self.assertRaises(ValueError):
+                profiler.Session(seconds, fraction, directory=self.directory)
+
+    def test_profiled_requests_are_written_as_collapsed_stacks(self):
+        session = profiler.start(5, interval=0.001, directory=self.directory)
+        self.assertIs(profiler.start(5), session)
+
+        threads = [threading.Thread(target=handle, args=(0.1,)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        profiler.stop()
+
+        self.assertEqual(session.snapshot()["requests"], 2)
+        self.assertFalse(session.snapshot()["active"])
+        with open(session.path) as profile:
+            lines = profile.read().splitlines()
+
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(" ", 1)
+        self.assertGreater(int(count), 0)
+        self.assertTrue(
+            stack.endswith("spin_in_a_distinctive_function (test_profiler.py:16)")
+        )
+        self.assertIn("handle (test_profiler.py:11)", stack)
+
+    def test_only_a_fraction_of_requests_is_profiled(self):
+        session = profiler.start(5, fraction=0.5, directory=self.directory)
+        with patch("random.random", return_value=0.5):
+            self.assertEqual(handle(0), "handled")
+        self.assertEqual(session.snapshot()["requests"], 0)
+        with patch("random.random", return_value=0.25):
+            handle(0)
+        self.assertEqual(session.snapshot()["requests"], 1)
+
+    def test_sessions_end_by_themselves(self):
+        session = profiler.start(0.05, directory=self.directory)
+        session.sampler.join(5)
+        self.assertFalse(session.snapshot()["active"])
+        self.assertTrue(os.path.exists(session.path))
+        self.assertEqual(handle(0), "handled")
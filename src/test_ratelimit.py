@@ -0,0 +1,119 @@
+import unittest
+import threading
+import requests_mock
+import ratelimit
+from ratelimit import HostLimiter, limiter_for
+from coordinator import SagaCoordinator
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestHostLimiter(unittest.TestCase):
+    def test_forward_budget(self):
+
+        clock = FakeClock()
+        limiter = HostLimiter({"requestsPerSecond": 2, "burst": 2}, clock=clock)
+
+        self.assertTrue(limiter.acquire(timeout=0))
+        self.assertTrue(limiter.acquire(timeout=0))
+        self.assertFalse(limiter.acquire(timeout=0))
+
+        clock.now += 0.5
+        self.assertTrue(limiter.acquire(timeout=0))
+        self.assertFalse(limiter.acquire(timeout=0))
+        self.assertEqual(limiter.snapshot()["throttled"], 2)
+
+    def test_compensations_have_their_own_budget(self):
+
+        clock = FakeClock()
+        limiter = HostLimiter(
+            {"requestsPerSecond": 1, "burst": 1, "compensationsPerSecond": 1},
+            clock=clock,
+        )
+
+        self.assertTrue(limiter.acquire(timeout=0))
+        self.assertFalse(limiter.acquire(timeout=0))
+        self.assertTrue(limiter.acquire(compensation=True, timeout=0))
+
+    def test_compensations_borrow_from_forward_budget(self):
+
+        clock = FakeClock()
+        limiter = HostLimiter(
+            {"requestsPerSecond": 1, "burst": 1, "compensationsPerSecond": 1},
+            clock=clock,
+        )
+
+        self.assertTrue(limiter.acquire(compensation=True, timeout=0))
+        self.assertTrue(limiter.acquire(compensation=True, timeout=0))
+        self.assertFalse(limiter.acquire(timeout=0))
+
+    def test_forward_traffic_yields_to_waiting_compensations(self):
+
+        limiter = HostLimiter({"requestsPerSecond": 1000, "burst": 1})
+        limiter.waiting_compensations = 1
+
+        self.assertFalse(limiter.acquire(timeout=0.01))
+
+        limiter.waiting_compensations = 0
+        self.assertTrue(limiter.acquire(timeout=0.01))
+
+    def test_reconfiguring_keeps_spent_tokens(self):
+
+        clock = FakeClock()
+        limiter = HostLimiter({"requestsPerSecond": 1, "burst": 1}, clock=clock)
+        self.assertTrue(limiter.acquire(timeout=0))
+
+        limiter.configure({"requestsPerSecond": 1, "burst": 5})
+        self.assertFalse(limiter.acquire(timeout=0))
+
+    def test_blocks_until_a_token_is_available(self):
+
+        limiter = HostLimiter({"requestsPerSecond": 50, "burst": 1})
+        self.assertTrue(limiter.acquire())
+
+        acquired = []
+        thread = threading.Thread(target=lambda: acquired.append(limiter.acquire()))
+        thread.start()
+        thread.join(timeout=5)
+
+        self.assertEqual(acquired, [True])
+
+
+class TestCoordinatorRateLimiting(unittest.TestCase):
+    def tearDown(self):
+        ratelimit._limiters.clear()
+
+    def test_limits_are_shared_between_sagas(self):
+
+        configuration = {
+            "host": "me.svc",
+            "matchRequest": {"method": "POST", "url": "http://qbox.me.svc/orders"},
+            "onMatchedRequest": [
+                {
+                    "method": "POST",
+                    "url": "http://orders.svc/create",
+                    "rateLimit": {"requestsPerSecond": 0.001, "burst": 1},
+                    "onFailure": [],
+                    "isSuccessIfReceives": [{"status-code": 200}],
+                    "timeout": 0,
+                }
+            ],
+        }
+
+        with requests_mock.Mocker() as m:
+            m.post("http://orders.svc/create", status_code=200)
+
+            success, _, _ = SagaCoordinator(configuration).execute_saga()
+            self.assertTrue(success)
+
+            success, _, _ = SagaCoordinator(configuration).execute_saga()
+            self.assertFalse(success)
+
+            self.assertEqual(m.call_count, 1)
+            self.assertIsNotNone(limiter_for("http://orders.svc/other"))
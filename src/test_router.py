@@ -0,0 +1,145 @@
+import io
+import spool
+import unittest
+import requests_mock
+from email.message import Message
+from router import Router, Inbound, ContentMatch
+from coordinator import SagaCoordinator
+
+
+class TestRouter(unittest.TestCase):
+    def setUp(self):
+        self.router = Router()
+        self.router.add(0, "GET", "http://orders.svc/orders/{id}")
+        self.router.add(1, "GET", "http://orders.svc/orders/{id}/items/{item}")
+        self.router.add(2, "GET", "http://orders.svc/orders/latest")
+        self.router.add(3, "POST", "http://orders.svc/orders/{id}")
+        self.router.add(4, "GET", "http://orders.svc/files/{path*}")
+        self.router.add(5, "GET", "http://orders.svc/search?q=shoes")
+        self.router.add(6, "GET", "http://orders.svc/")
+
+    def test_literal_and_templated_routes(self):
+        self.assertEqual(
+            self.router.match("GET", "http://orders.svc/orders/12"), [(0, {"id": "12"})]
+        )
+        self.assertEqual(
+            self.router.match("GET", "http://orders.svc/orders/latest"),
+            [(0, {"id": "latest"}), (2, {})],
+        )
+        self.assertEqual(
+            self.router.match("GET", "http://orders.svc/orders/12/items/3"),
+            [(1, {"id": "12", "item": "3"})],
+        )
+        self.assertEqual(self.router.match("GET", "http://orders.svc/"), [(6, {})])
+
+    def test_method_host_and_query_must_match(self):
+        self.assertEqual(
+            self.router.match("POST", "http://orders.svc/orders/12"),
+            [(3, {"id": "12"})],
+        )
+        self.assertEqual(self.router.match("GET", "http://other.svc/orders/12"), [])
+        self.assertEqual(
+            self.router.match("GET", "http://orders.svc/search?q=shoes"), [(5, {})]
+        )
+        self.assertEqual(
+            self.router.match("GET", "http://orders.svc/search?q=hats"), []
+        )
+        self.assertEqual(self.router.match("GET", "http://orders.svc/orders"), [])
+
+    def test_wildcards(self):
+        self.assertEqual(
+            self.router.match("GET", "http://orders.svc/files/a/b/c.txt"),
+            [(4, {"path": "a/b/c.txt"})],
+        )
+
+        with self.assertRaises(ValueError):
+            self.router.add(7, "GET", "http://orders.svc/files/*/meta")
+
+    def test_urls_without_scheme(self):
+        router = Router()
+        router.add(0, "GET", "qbox.me.svc/{id}")
+        self.assertEqual(
+            router.match("GET", "http://QBOX.me.svc/7"), [(0, {"id": "7"})]
+        )
+
+
+class TestContentMatch(unittest.TestCase):
+    def inbound(self, headers=(), body=b""):
+        message = Message()
+        for name, value in headers:
+            message[name] = value
+        return Inbound(message, body)
+
+    def test_headers(self):
+        match = ContentMatch({"X-Tenant": "acme", "start-faking": "True"}, "")
+        inbound = self.inbound([("x-tenant", "acme"), ("Start-Faking", "True")])
+
+        self.assertEqual(inbound.headers["x-tenant"], "acme")
+        self.assertTrue(match.matches(inbound))
+        self.assertFalse(match.matches(self.inbound([("X-Tenant", "acme")])))
+        self.assertFalse(
+            match.matches(
+                self.inbound([("X-Tenant", "ACME"), ("Start-Faking", "True")])
+            )
+        )
+
+    def test_repeated_headers_match_on_the_first(self):
+        inbound = self.inbound([("X-Tenant", "acme"), ("X-Tenant", "other")])
+        self.assertTrue(ContentMatch({"X-Tenant": "acme"}, "").matches(inbound))
+
+    def test_bodies(self):
+        match = ContentMatch({}, '{"order": 1}')
+        self.assertTrue(match.matches(self.inbound(body=b'{"order": 1}')))
+        self.assertFalse(match.matches(self.inbound(body=b'{"order": 2}')))
+        self.assertFalse(match.matches(self.inbound(body=b'{"order": 10}')))
+
+        data = b"x" * 5000
+        spooled = spool.read(io.BytesIO(data), len(data), threshold=100)
+        self.addCleanup(spooled.close)
+        self.assertTrue(
+            ContentMatch({}, data.decode()).matches(self.inbound(body=spooled))
+        )
+
+    def test_routers_check_content_by_configuration(self):
+        router = Router.from_configurations(
+            [
+                {"matchRequest": {"method": "GET", "url": "http://a.svc/"}},
+                {
+                    "matchRequest": {
+                        "method": "GET",
+                        "url": "http://a.svc/",
+                        "headers": {"X-Tenant": "acme"},
+                    }
+                },
+            ]
+        )
+        inbound = self.inbound([("X-Tenant", "other")])
+        self.assertTrue(router.matches_content(0, inbound))
+        self.assertFalse(router.matches_content(1, inbound))
+
+
+class TestPathParameterInterpolation(unittest.TestCase):
+    def test_root_path_parameters(self):
+
+        configuration = {
+            "host": "me.svc",
+            "matchRequest": {"method": "POST", "url": "http://qbox.me.svc/orders/{id}"},
+            "onMatchedRequest": [
+                {
+                    "method": "POST",
+                    "url": "http://billing.svc/charge/${root.path.id}",
+                    "headers": {"Tenant": "${root.path.tenant:none}"},
+                    "onFailure": [],
+                    "isSuccessIfReceives": [{"status-code": 200}],
+                    "timeout": 30,
+                }
+            ],
+        }
+
+        with requests_mock.Mocker() as m:
+            m.post("http://billing.svc/charge/12", status_code=200)
+            coordinator = SagaCoordinator(configuration, path_parameters={"id": "12"})
+            success, _, _ = coordinator.execute_saga()
+
+            self.assertTrue(success)
+            self.assertEqual(m.request_history[0].headers["Tenant"], "none")
@@ -1,12 +1,42 @@
 import io
+import os
+import json
+import events
+import profiler
+import bulkhead
 import yaml
+import shutil
+import tempfile
 import requests
 import unittest
+import http.client
+import collections
 import requests_mock
 from server import RequestHandler
+from coordinator import RequestNode
+from readiness import Readiness
 from unittest.mock import patch, mock_open
 from requests_toolbelt.utils import dump
-from scapy.layers.http import HTTP, HTTPResponse, HTTPRequest
+
+Response = collections.namedtuple("Response", ["status", "headers", "body"])
+
+
+class RawSocket(object):
+    def __init__(self, raw):
+        self.raw = raw
+
+    def makefile(self, *args, **kwargs):
+        return io.BytesIO(self.raw)
+
+
+def parse_response(raw):
+    """
+    Parse a raw HTTP response with the standard library's client.
+    """
+
+    response = http.client.HTTPResponse(RawSocket(raw))
+    response.begin()
+    return Response(response.status, response.headers, response.read())
 
 
 class TestableHandler(RequestHandler):
@@ -48,14 +78,14 @@ class HTTPRequestHandlerTestCase(unittest.TestCase):
                 text="success",
             )
 
+            expected_response = requests.get("http://foo.svc")
             raw = dump.dump_response(
-                requests.get("http://foo.svc"),
+                expected_response,
                 request_prefix="",
                 response_prefix="@@@",
             )
             split = raw.split(b"@@@")
             raw_request = split[0]
-            expected_response = HTTPResponse(b"".join(split[1:]))
 
             raw_request
             handler = TestableHandler(raw_request, (0, 0), None)
@@ -64,11 +94,14 @@ class HTTPRequestHandlerTestCase(unittest.TestCase):
             handler.test(write_file)
             write_file.seek(0)
 
-            response = HTTPResponse(write_file.read())
+            response = parse_response(write_file.read())
 
-            self.assertEqual(response.Status_Code, expected_response.Status_Code)
-            self.assertEqual(response.Content_Type, expected_response.Content_Type)
-            self.assertEqual(response.load, expected_response.load)
+            self.assertEqual(response.status, expected_response.status_code)
+            self.assertEqual(
+                response.headers["Content-Type"],
+                expected_response.headers["Content-Type"],
+            )
+            self.assertEqual(response.body, expected_response.content)
 
     def test_saga_behaviour(self):
 
@@ -170,10 +203,10 @@ class HTTPRequestHandlerTestCase(unittest.TestCase):
                     handler.test(write_file)
                     write_file.seek(0)
 
-                    response = HTTPResponse(write_file.read())
-                    self.assertEqual(response.Status_Code, b"200")
+                    response = parse_response(write_file.read())
+                    self.assertEqual(response.status, 200)
                     self.assertEqual(
-                        response.load, b"Ratings: success\nDetails: success again\n"
+                        response.body, b"Ratings: success\nDetails: success again\n"
                     )
 
     def test_saga_behaviour_with_multiple_configs(self):
@@ -353,10 +386,10 @@ class HTTPRequestHandlerTestCase(unittest.TestCase):
                     handler.test(write_file)
                     write_file.seek(0)
 
-                    response = HTTPResponse(write_file.read())
-                    self.assertEqual(response.Status_Code, b"200")
+                    response = parse_response(write_file.read())
+                    self.assertEqual(response.status, 200)
                     self.assertEqual(
-                        response.load, b"Ratings: success\nDetails: success again\n"
+                        response.body, b"Ratings: success\nDetails: success again\n"
                     )
 
             raw_request = b"GET /ziggiebot HTTP/1.1\r\nHost: http://localhost:3001\r\nUser-Agent: python-requests/2.9.1\r\nAccept-Encoding: gzip, deflate\r\nAccept: */*\r\nConnection: keep-alive\r\nStart-Faking: True\r\nProduct-Id: 12\r\n\r\n"
@@ -373,8 +406,316 @@ class HTTPRequestHandlerTestCase(unittest.TestCase):
                     handler.test(write_file)
                     write_file.seek(0)
 
-                    response = HTTPResponse(write_file.read())
-                    self.assertEqual(response.Status_Code, b"200")
+                    response = parse_response(write_file.read())
+                    self.assertEqual(response.status, 200)
                     self.assertEqual(
-                        response.load, b"Ratings: success\nDetails: success again\n"
+                        response.body, b"Ratings: success\nDetails: success again\n"
                     )
+
+    def test_shadow_saga_passes_request_through(self):
+
+        configuration = {
+            "host": "productpage.svc",
+            "shadow": True,
+            "matchRequest": {"method": "GET", "url": "http://foo.svc/"},
+            "onMatchedRequest": [
+                {
+                    "method": "GET",
+                    "url": "http://ratings.svc/add",
+                    "isSuccessIfReceives": [{"status-code": 200}],
+                    "onFailure": [],
+                    "timeout": 30,
+                }
+            ],
+        }
+
+        with requests_mock.Mocker() as m:
+            m.get("http://foo.svc/", status_code=200, text="live")
+
+            raw_request = b"GET / HTTP/1.1\r\nHost: foo.svc\r\n\r\n"
+
+            with patch("builtins.open", mock_open(read_data=yaml.dump(configuration))):
+                with patch("os.path.exists") as os_mock:
+                    os_mock.return_value = True
+                    with patch("server.shadow_recorder") as recorder:
+                        handler = TestableHandler(raw_request, (0, 0), None)
+                        write_file = io.BytesIO()
+                        handler.test(write_file)
+
+            write_file.seek(0)
+            response = parse_response(write_file.read())
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.body, b"live")
+            self.assertEqual(
+                ["http://foo.svc/"],
+                [request.url for request in m.request_history],
+            )
+            recorder.observe.assert_called_once()
+            recorder.submit.assert_called_once()
+
+    def test_sagas_over_their_bulkhead_are_turned_away(self):
+
+        configuration = {
+            "host": "productpage.svc",
+            "bulkhead": {"maxConcurrentSagas": 1},
+            "matchRequest": {"method": "GET", "url": "http://foo.svc/"},
+            "onMatchedRequest": [
+                {
+                    "method": "GET",
+                    "url": "http://ratings.svc/add",
+                    "isSuccessIfReceives": [{"status-code": 200}],
+                    "onFailure": [],
+                    "timeout": 30,
+                }
+            ],
+            "onAllSucceeded": {"status-code": 200},
+        }
+        full = bulkhead.Bulkhead("productpage.svc", configuration["bulkhead"])
+        self.assertTrue(full.enter())
+
+        with requests_mock.Mocker() as m:
+            raw_request = b"GET / HTTP/1.1\r\nHost: foo.svc\r\n\r\n"
+
+            with patch("builtins.open", mock_open(read_data=yaml.dump(configuration))):
+                with patch("os.path.exists") as os_mock:
+                    os_mock.return_value = True
+                    with patch.dict("bulkhead._bulkheads", {"productpage.svc": full}):
+                        handler = TestableHandler(raw_request, (0, 0), None)
+                        write_file = io.BytesIO()
+                        handler.test(write_file)
+
+            write_file.seek(0)
+            response = parse_response(write_file.read())
+            self.assertEqual(response.status, 503)
+            self.assertEqual(m.request_history, [])
+            self.assertEqual(full.snapshot()["rejected"], 1)
+
+    def test_bodies_in_response_headers_are_text(self):
+        root = RequestNode()
+        root.update_request(body=b"hello")
+        context = {"parent": RequestNode(), "root": root, "transactions": []}
+
+        status, headers, body = RequestHandler.respond(
+            None,
+            {
+                "status-code": 200,
+                "headers": {"X-Echo": "${root.body}"},
+                "body": "${root.body}",
+            },
+            context,
+        )
+        self.assertEqual(headers["X-Echo"], "hello")
+        self.assertEqual(body, b"hello")
+
+    def test_metrics_endpoint(self):
+
+        raw_request = b"GET /_qbox/metrics HTTP/1.1\r\nHost: localhost:3001\r\n\r\n"
+        handler = TestableHandler(raw_request, (0, 0), None)
+        write_file = io.BytesIO()
+        handler.test(write_file)
+        write_file.seek(0)
+
+        response = parse_response(write_file.read())
+        self.assertEqual(response.status, 200)
+        self.assertIn("shadow", json.loads(response.body))
+
+    def test_admin_endpoints_are_only_served_for_admin_hosts(self):
+
+        with requests_mock.Mocker() as m:
+            m.get("http://foo.svc/_qbox/metrics", status_code=200, text="upstream")
+
+            raw_request = b"GET /_qbox/metrics HTTP/1.1\r\nHost: foo.svc\r\n\r\n"
+            handler = TestableHandler(raw_request, (0, 0), None)
+            write_file = io.BytesIO()
+            handler.test(write_file)
+
+        write_file.seek(0)
+        response = parse_response(write_file.read())
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body, b"upstream")
+
+        raw_request = b"GET /_qbox/metrics HTTP/1.1\r\nHost: [::1]:3001\r\n\r\n"
+        handler = TestableHandler(raw_request, (0, 0), None)
+        write_file = io.BytesIO()
+        handler.test(write_file)
+        write_file.seek(0)
+        self.assertIn("shadow", json.loads(parse_response(write_file.read()).body))
+
+    def test_readiness_endpoint(self):
+
+        raw_request = b"GET /_qbox/ready HTTP/1.1\r\nHost: localhost:3001\r\n\r\n"
+
+        with patch("server.readiness", Readiness()) as state:
+            state.require("configuration")
+
+            handler = TestableHandler(raw_request, (0, 0), None)
+            write_file = io.BytesIO()
+            handler.test(write_file)
+            write_file.seek(0)
+            response = parse_response(write_file.read())
+            self.assertEqual(response.status, 503)
+            self.assertEqual(json.loads(response.body)["pending"], ["configuration"])
+
+            state.mark("configuration")
+
+            handler = TestableHandler(raw_request, (0, 0), None)
+            write_file = io.BytesIO()
+            handler.test(write_file)
+            write_file.seek(0)
+            response = parse_response(write_file.read())
+            self.assertEqual(response.status, 200)
+
+    def test_events_endpoint(self):
+
+        bus = events.EventBus()
+        with patch("events.bus", bus):
+            bus.publish("started", "a")
+            bus.publish("started", "b")
+            bus.publish("finished", "a", success=True)
+
+            raw_request = (
+                b"GET /_qbox/events?transaction=a&since=0&timeout=0 HTTP/1.1\r\n"
+                b"Host: localhost:3001\r\n\r\n"
+            )
+            handler = TestableHandler(raw_request, (0, 0), None)
+            write_file = io.BytesIO()
+            handler.test(write_file)
+            write_file.seek(0)
+            response = parse_response(write_file.read())
+            self.assertEqual(response.status, 200)
+            self.assertEqual(
+                [event["type"] for event in json.loads(response.body)["events"]],
+                ["started", "finished"],
+            )
+
+            # The stream of one saga replays what was missed, and ends with the saga.
+            raw_request = (
+                b"GET /_qbox/events?transaction=a HTTP/1.1\r\n"
+                b"Host: localhost:3001\r\n"
+                b"Accept: text/event-stream\r\n"
+                b"Last-Event-ID: 1\r\n\r\n"
+            )
+            handler = TestableHandler(raw_request, (0, 0), None)
+            write_file = io.BytesIO()
+            handler.test(write_file)
+            write_file.seek(0)
+            response = parse_response(write_file.read())
+            self.assertEqual(response.headers["Content-Type"], "text/event-stream")
+            self.assertTrue(response.body.startswith(b"id: 3\nevent: finished\n"))
+
+    def test_events_endpoint_rejects_malformed_input(self):
+        for query, headers in (
+            (b"since=yesterday", b""),
+            (b"timeout=soon", b""),
+            (b"timeout=inf", b""),
+            (b"timeout=-1", b""),
+            (b"", b"Accept: text/event-stream\r\nLast-Event-ID: x\r\n"),
+        ):
+            raw_request = (
+                b"GET /_qbox/events?" + query + b" HTTP/1.1\r\n"
+                b"Host: localhost:3001\r\n" + headers + b"\r\n"
+            )
+            handler = TestableHandler(raw_request, (0, 0), None)
+            write_file = io.BytesIO()
+            handler.test(write_file)
+            write_file.seek(0)
+            self.assertEqual(parse_response(write_file.read()).status, 400, query)
+
+    def test_profile_endpoint_rejects_malformed_input(self):
+        for query in (
+            b"seconds=soon",
+            b"seconds=nan",
+            b"seconds=inf",
+            b"seconds=-1",
+            b"seconds=0",
+            b"fraction=0",
+            b"fraction=5",
+            b"fraction=nan",
+        ):
+            raw_request = (
+                b"POST /_qbox/profile?" + query + b" HTTP/1.1\r\n"
+                b"Host: localhost:3001\r\n\r\n"
+            )
+            handler = TestableHandler(raw_request, (0, 0), None)
+            write_file = io.BytesIO()
+            handler.test(write_file)
+            write_file.seek(0)
+            self.assertEqual(parse_response(write_file.read()).status, 400, query)
+        session = profiler.current()
+        self.assertTrue(session is None or session.stopped.is_set())
+
+    def test_profile_endpoint(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        def request(raw_request):
+            handler = TestableHandler(raw_request, (0, 0), None)
+            write_file = io.BytesIO()
+            handler.test(write_file)
+            write_file.seek(0)
+            return parse_response(write_file.read())
+
+        with patch("settings.PROFILE_DIR", directory):
+            response = request(
+                b"POST /_qbox/profile?seconds=10&fraction=0.5 HTTP/1.1\r\n"
+                b"Host: localhost:3001\r\n\r\n"
+            )
+            self.assertEqual(response.status, 202)
+            started = json.loads(response.body)
+            self.assertTrue(started["active"])
+            self.assertEqual(started["fraction"], 0.5)
+            self.assertTrue(started["path"].startswith(directory))
+
+            response = request(
+                b"DELETE /_qbox/profile HTTP/1.1\r\nHost: localhost:3001\r\n\r\n"
+            )
+            self.assertFalse(json.loads(response.body)["active"])
+            self.assertTrue(os.path.exists(started["path"]))
+
+            response = request(
+                b"PUT /_qbox/profile HTTP/1.1\r\nHost: localhost:3001\r\n\r\n"
+            )
+            self.assertEqual(response.status, 404)
+
+    def test_oversized_bodies_are_refused(self):
+        raw_request = (
+            b"POST /upload HTTP/1.1\r\nHost: foo.svc\r\nContent-Length: 2048\r\n\r\n"
+        )
+
+        with patch("settings.MAX_BODY_BYTES", 1024):
+            handler = TestableHandler(raw_request, (0, 0), None)
+            write_file = io.BytesIO()
+            handler.test(write_file)
+            write_file.seek(0)
+            response = parse_response(write_file.read())
+
+        self.assertEqual(response.status, 413)
+        self.assertTrue(handler.close_connection)
+
+    def test_proxy_keeps_path(self):
+        raw_request = b"GET /items?page=2 HTTP/1.1\r\nHost: foo.svc\r\n\r\n"
+
+        with requests_mock.Mocker() as m:
+            m.get("http://foo.svc/items?page=2", text="page two")
+            handler = TestableHandler(raw_request, (0, 0), None)
+            write_file = io.BytesIO()
+            handler.test(write_file)
+            write_file.seek(0)
+            response = parse_response(write_file.read())
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body, b"page two")
+
+    def test_draining_closes_connections(self):
+        raw_request = b"GET /items HTTP/1.1\r\nHost: foo.svc\r\n\r\n"
+
+        with requests_mock.Mocker() as m, patch("lifecycle.in_flight.draining", True):
+            m.get("http://foo.svc/items", text="ok")
+            handler = TestableHandler(raw_request, (0, 0), None)
+            write_file = io.BytesIO()
+            handler.test(write_file)
+            write_file.seek(0)
+            response = parse_response(write_file.read())
+
+        self.assertEqual(response.headers["Connection"], "close")
+        self.assertTrue(handler.close_connection)
@@ -0,0 +1,106 @@
+import unittest
+import requests_mock
+from shadow import ShadowCoordinator, ShadowRecorder, mirrored
+
+
+def shadow_configuration(shadow):
+    return {
+        "host": "me.svc",
+        "shadow": shadow,
+        "matchRequest": {"method": "POST", "url": "http://qbox.me.svc/orders"},
+        "onMatchedRequest": [
+            {
+                "method": "POST",
+                "url": "http://orders.svc/create",
+                "onFailure": [
+                    {
+                        "method": "POST",
+                        "url": "http://orders.svc/cancel",
+                        "timeout": 3,
+                        "maxRetriesOnTimeout": 1,
+                        "isSuccessIfReceives": [{"status-code": 200}],
+                    }
+                ],
+                "isSuccessIfReceives": [{"status-code": 201}],
+                "timeout": 30,
+            },
+            {
+                "method": "POST",
+                "url": "http://billing.svc/charge?currency=usd",
+                "onFailure": [],
+                "isSuccessIfReceives": [{"status-code": 200}],
+                "shadowResponse": {"status-code": 402},
+                "timeout": 30,
+            },
+        ],
+    }
+
+
+class TestShadowCoordinator(unittest.TestCase):
+    def test_stubbed_run_sends_nothing(self):
+
+        with requests_mock.Mocker() as m:
+            coordinator = ShadowCoordinator(shadow_configuration(True))
+            success, transactions, failed_compensations = coordinator.execute_saga()
+
+            self.assertEqual(m.call_count, 0)
+            self.assertFalse(success)
+            self.assertEqual(len(transactions), 1)
+            self.assertEqual(coordinator.compensations, 1)
+            self.assertEqual(len(failed_compensations), 0)
+
+    def test_mirror_receives_the_plan(self):
+
+        configuration = shadow_configuration({"mirror": "http://mirror.svc:8080"})
+
+        with requests_mock.Mocker() as m:
+            m.post("http://mirror.svc:8080/create", status_code=201)
+            m.post("http://mirror.svc:8080/charge?currency=usd", status_code=200)
+
+            coordinator = ShadowCoordinator(configuration)
+            success, _, _ = coordinator.execute_saga()
+
+            self.assertTrue(success)
+            self.assertEqual(
+                [
+                    "http://mirror.svc:8080/create",
+                    "http://mirror.svc:8080/charge?currency=usd",
+                ],
+                [request.url for request in m.request_history],
+            )
+
+    def test_mirrored(self):
+        self.assertEqual(
+            mirrored("http://a.svc/x/y?z=1", "https://b.svc:9000"),
+            "https://b.svc:9000/x/y?z=1",
+        )
+
+
+class TestShadowRecorder(unittest.TestCase):
+    def test_records_outcomes_and_match_rate(self):
+
+        recorder = ShadowRecorder(workers=1)
+        configuration = shadow_configuration(True)
+
+        recorder.observe(configuration, matched=True)
+        recorder.observe(configuration, matched=False)
+        recorder.submit(configuration, {}, b"").result()
+
+        [stats] = recorder.snapshot().values()
+        self.assertEqual(stats["requests"], 2)
+        self.assertEqual(stats["matchRate"], 0.5)
+        self.assertEqual(stats["runs"], 1)
+        self.assertEqual(stats["failed"], 1)
+        self.assertEqual(stats["projectedCompensations"], 1)
+        self.assertIsNotNone(stats["latencyMs"]["p99"])
+
+    def test_drops_runs_when_too_many_are_pending(self):
+
+        recorder = ShadowRecorder(workers=1, max_pending=1)
+        configuration = shadow_configuration(True)
+
+        recorder.pending.acquire()
+        self.assertIsNone(recorder.submit(configuration, {}, b""))
+
+        [stats] = recorder.snapshot().values()
+        self.assertEqual(stats["dropped"], 1)
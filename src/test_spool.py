@@ -0,0 +1,49 @@
+import io
+import spool
+import unittest
+
+
+class TestSpool(unittest.TestCase):
+    def test_small_bodies_stay_in_memory(self):
+        body = spool.read(io.BytesIO(b"hello world"), 11, threshold=1024)
+        self.assertEqual(body, b"hello world")
+        self.assertIsInstance(body, bytes)
+
+    def test_large_bodies_are_spooled(self):
+        data = bytes(range(256)) * 1000
+        body = spool.read(io.BytesIO(data), len(data), threshold=1024)
+        self.addCleanup(body.close)
+
+        self.assertIsInstance(body, spool.SpooledBody)
+        self.assertEqual(len(body), len(data))
+        self.assertEqual(body, data)
+        self.assertEqual(data, body)
+        self.assertNotEqual(body, data[:-1] + b"x")
+        self.assertNotEqual(body, "not bytes")
+        self.assertEqual(b"".join(body.chunks(1000)), data)
+        self.assertEqual(bytes(body), data)
+
+        written = io.BytesIO()
+        spool.write(written, body)
+        self.assertEqual(written.getvalue(), data)
+
+    def test_spooled_bodies_compare_with_each_other(self):
+        data = b"x" * 5000
+        first = spool.collect([data[:2000], data[2000:]], threshold=100)
+        second = spool.collect([data], threshold=100)
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+
+        self.assertEqual(first, second)
+
+    def test_limit(self):
+        with self.assertRaises(spool.BodyTooLarge):
+            spool.read(io.BytesIO(b""), 2048, limit=1024)
+
+        # Bodies without a declared length are cut off as they grow.
+        with self.assertRaises(spool.BodyTooLarge):
+            spool.collect([b"x" * 600, b"x" * 600], threshold=100, limit=1024)
+
+    def test_truncated_stream(self):
+        body = spool.read(io.BytesIO(b"short"), 100)
+        self.assertEqual(body, b"short")
@@ -0,0 +1,39 @@
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+# Generous enough to pass on a loaded CI machine, tight enough to catch an eager import
+# of the HTTP client or the configuration toolchain (each of which costs more than this
+# on its own on a cold start).
+IMPORT_BUDGET_SECONDS = 0.5
+
+# Modules the serving path must not pay for at import time.
+LAZY_MODULES = {"requests", "urllib3", "yaml", "schema", "scapy", "concurrent"}
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import server
+elapsed = time.perf_counter() - start
+loaded = sorted({name.split(".")[0] for name in sys.modules} & set(json.loads(sys.argv[1])))
+print(json.dumps({"elapsed": elapsed, "loaded": loaded}))
+"""
+
+
+class TestStartup(unittest.TestCase):
+    def probe(self):
+        output = subprocess.check_output(
+            [sys.executable, "-c", PROBE, json.dumps(sorted(LAZY_MODULES))],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        return json.loads(output)
+
+    def test_server_import_is_slim(self):
+        self.assertEqual(self.probe()["loaded"], [])
+
+    def test_server_import_budget(self):
+        # Take the best of a few runs to keep noise from the rest of the machine out.
+        elapsed = min(self.probe()["elapsed"] for _ in range(3))
+        self.assertLess(elapsed, IMPORT_BUDGET_SECONDS)
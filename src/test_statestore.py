@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import spool
+import shutil
+import tempfile
+import unittest
+import threading
+import statestore
+import socketserver
+import requests_mock
+from unittest.mock import patch
+from coordinator import SagaCoordinator
+
+
+class RESPHandler(socketserver.StreamRequestHandler):
+    """
+    A stand-in for Redis that understands the handful of commands the store sends.
+    """
+
+    def handle(self):
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            self.wfile.write(self.server.execute(command))
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+
+        command = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            command.append(self.rfile.read(length + 2)[:-2])
+        return command
+
+
+class RESPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), RESPHandler)
+        self.lock = threading.Lock()
+        self.strings = {}
+        self.expiries = {}
+        self.sets = {}
+        self.commands = []
+        self.scripts = {
+            statestore.ACQUIRE_LEASE_SCRIPT: self.acquire_lease,
+            statestore.RENEW_LEASE_SCRIPT: self.renew_lease,
+            statestore.RELEASE_LEASE_SCRIPT: self.release_lease,
+        }
+
+    def get(self, key):
+        if self.expiries.get(key, float("inf")) <= time.monotonic():
+            self.strings.pop(key, None)
+        return self.strings.get(key)
+
+    def expire(self, key, milliseconds):
+        self.expiries[key] = time.monotonic() + int(milliseconds) / 1000
+
+    def acquire_lease(self, keys, arguments):
+        if self.get(keys[0]) is not None:
+            return b"$-1\r\n"
+        token = int(self.strings.get(keys[1], b"0")) + 1
+        self.strings[keys[1]] = str(token).encode()
+        self.strings[keys[0]] = b"%d %s" % (token, arguments[0])
+        self.expire(keys[0], arguments[1])
+        return b":%d\r\n" % token
+
+    def renew_lease(self, keys, arguments):
+        if self.get(keys[0]) != arguments[0]:
+            return b":0\r\n"
+        self.expire(keys[0], arguments[1])
+        return b":1\r\n"
+
+    def release_lease(self, keys, arguments):
+        if self.get(keys[0]) != arguments[0]:
+            return b":0\r\n"
+        del self.strings[keys[0]]
+        return b":1\r\n"
+
+    def execute(self, command):
+        name, arguments = command[0].decode().upper(), command[1:]
+
+        with self.lock:
+            self.commands.append(name)
+
+            if name in ("SELECT", "AUTH", "PING"):
+                return b"+OK\r\n"
+            if name == "EVAL":
+                keys = arguments[2 : 2 + int(arguments[1])]
+                script = self.scripts[arguments[0].decode()]
+                return script(keys, arguments[2 + len(keys) :])
+            if name == "SET":
+                self.strings[arguments[0]] = arguments[1]
+                self.expiries.pop(arguments[0], None)
+                return b"+OK\r\n"
+            if name == "GET":
+                value = self.get(arguments[0])
+                if value is None:
+                    return b"$-1\r\n"
+                return b"$%d\r\n%s\r\n" % (len(value), value)
+            if name == "DEL":
+                return b":%d\r\n" % int(
+                    self.strings.pop(arguments[0], None) is not None
+                )
+            if name == "SADD":
+                self.sets.setdefault(arguments[0], set()).add(arguments[1])
+                return b":1\r\n"
+            if name == "SREM":
+                self.sets.get(arguments[0], set()).discard(arguments[1])
+                return b":1\r\n"
+            if name == "SMEMBERS":
+                members = self.sets.get(arguments[0], set())
+                return b"*%d\r\n" % len(members) + b"".join(
+                    b"$%d\r\n%s\r\n" % (len(member), member) for member in members
+                )
+            return b"-ERR unknown command\r\n"
+
+
+class StoreConformance(object):
+    """
+    Behaviour every backend must have.
+    """
+
+    def test_save_get_and_delete(self):
+        self.store.save("a", {"id": "a", "status": statestore.RUNNING})
+        self.store.save("b", {"id": "b", "status": statestore.RUNNING})
+        self.store.save("a", {"id": "a", "status": statestore.COMPENSATING})
+        self.assertTrue(self.store.flush(timeout=5))
+
+        self.assertEqual(self.store.get("a")["status"], statestore.COMPENSATING)
+        self.assertEqual(
+            sorted(record["id"] for record in self.store.records()), ["a", "b"]
+        )
+
+        self.store.delete("a")
+        self.assertTrue(self.store.flush(timeout=5))
+        self.assertIsNone(self.store.get("a"))
+        self.assertEqual([record["id"] for record in self.store.records()], ["b"])
+
+    def test_writes_are_batched(self):
+        for i in range(200):
+            self.store.save(str(i % 20), {"id": str(i % 20), "step": i})
+        self.assertTrue(self.store.flush(timeout=5))
+
+        snapshot = self.store.snapshot()
+        self.assertEqual(snapshot["writes"], 200)
+        self.assertEqual(snapshot["pending"], 0)
+        self.assertEqual(len(self.store.records()), 20)
+        self.assertEqual(self.store.get("19")["step"], 199)
+        if self.store.shared:
+            self.assertLess(snapshot["batches"], 200)
+
+    def test_leases(self):
+        token = self.store.acquire_lease("saga:a", "one", 5)
+        self.assertIsNotNone(token)
+        self.assertIsNone(self.store.acquire_lease("saga:a", "two", 5))
+        self.assertEqual(self.store.lease_owner("saga:a"), "one")
+
+        self.assertTrue(self.store.renew_lease("saga:a", "one", token, 5))
+        self.assertFalse(self.store.renew_lease("saga:a", "two", token, 5))
+
+        # Releasing a lease someone else holds does nothing.
+        self.store.release_lease("saga:a", "two", token)
+        self.assertEqual(self.store.lease_owner("saga:a"), "one")
+
+        self.store.release_lease("saga:a", "one", token)
+        self.assertIsNone(self.store.lease_owner("saga:a"))
+        self.assertGreater(self.store.acquire_lease("saga:a", "two", 5), token)
+
+    def test_leases_expire(self):
+        token = self.store.acquire_lease("saga:a", "one", 0.05)
+        time.sleep(0.1)
+
+        self.assertIsNone(self.store.lease_owner("saga:a"))
+        self.assertFalse(self.store.renew_lease("saga:a", "one", token, 5))
+        self.assertGreater(self.store.acquire_lease("saga:a", "two", 5), token)
+
+
+class TestMemoryStore(StoreConformance, unittest.TestCase):
+    def setUp(self):
+        self.store = statestore.from_url("memory://")
+
+
+class TestSQLiteStore(StoreConformance, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = statestore.from_url(
+            f"sqlite://{os.path.join(self.directory, 'state.db')}"
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestRedisStore(StoreConformance, unittest.TestCase):
+    def setUp(self):
+        self.server = RESPServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.store = statestore.from_url(
+            f"redis://:secret@127.0.0.1:{self.server.server_address[1]}/2"
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_setup(self):
+        self.store.get("a")
+        self.assertEqual(self.server.commands[:3], ["AUTH", "SELECT", "GET"])
+
+
+class SharedMemoryStore(statestore.MemoryStore):
+    """
+    A memory store that coordinators treat as shared with other replicas.
+    """
+
+    shared = True
+
+
+class TestWriteBehind(unittest.TestCase):
+    def test_records_are_serialized_behind(self):
+        written = {}
+        threads = set()
+
+        class Store(statestore.StateStore):
+            def write_batch(self, batch):
+                written.update(batch)
+
+        original = statestore.serialize
+
+        def serialize(record):
+            threads.add(threading.current_thread().name)
+            return original(record)
+
+        store = Store()
+        with patch("statestore.serialize", serialize):
+            store.save("a", {"body": b"ok", "spooled": spool.collect([b"x" * 8], 4)})
+            self.assertTrue(store.flush(timeout=5))
+
+        self.assertEqual(threads, {"qbox-state-store"})
+        self.assertEqual(json.loads(written["a"]), {"body": "ok", "spooled": None})
+
+
+class TestSagaState(unittest.TestCase):
+
+    configuration = {
+        "host": "me.svc",
+        "matchRequest": {"method": "POST", "url": "http://qbox.me.svc/orders"},
+        "onMatchedRequest": [
+            {
+                "method": "POST",
+                "url": f"http://step{step}.svc/orders",
+                "onFailure": [
+                    {
+                        "method": "DELETE",
+                        "url": f"http://step{step}.svc/orders",
+                        "timeout": 3,
+                        "maxRetriesOnTimeout": 1,
+                        "isSuccessIfReceives": [{"status-code": 200}],
+                    }
+                ],
+                "isSuccessIfReceives": [{"status-code": 200}],
+                "timeout": 3,
+            }
+            for step in range(3)
+        ],
+    }
+
+    def setUp(self):
+        self.store = SharedMemoryStore()
+
+    def test_finished_sagas_are_forgotten(self):
+        with requests_mock.Mocker() as m:
+            for step in range(3):
+                m.post(f"http://step{step}.svc/orders", status_code=200)
+            coordinator = SagaCoordinator(self.configuration, store=self.store)
+            success, _, _ = coordinator.execute_saga()
+
+        self.assertTrue(success)
+        self.assertEqual(self.store.records(), [])
+        self.assertEqual(self.store.snapshot()["writes"], 5)
+
+    def test_progress_is_not_written_to_unshared_stores(self):
+        store = statestore.MemoryStore()
+        with requests_mock.Mocker() as m:
+            for step in range(3):
+                m.post(f"http://step{step}.svc/orders", status_code=200)
+            SagaCoordinator(self.configuration, store=store).execute_saga()
+
+        # Only the delete of the finished saga.
+        self.assertEqual(store.snapshot()["writes"], 1)
+
+    def test_failed_compensations_are_kept(self):
+        with requests_mock.Mocker() as m:
+            m.post("http://step0.svc/orders", status_code=200)
+            m.post("http://step1.svc/orders", status_code=500)
+            m.delete("http://step0.svc/orders", status_code=500)
+            coordinator = SagaCoordinator(self.configuration, store=self.store)
+            success, _, failed = coordinator.execute_saga()
+
+        self.assertFalse(success)
+        self.assertEqual(len(failed), 1)
+        record = self.store.get(coordinator.identifier)
+        self.assertEqual(record["status"], statestore.FAILED)
+        self.assertEqual(len(record["transactions"]), 1)
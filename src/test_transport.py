@@ -0,0 +1,221 @@
+import gzip
+import json
+import time
+import unittest
+import threading
+import spool
+import transport
+from unittest.mock import patch
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def respond(self, status, body=b"", headers=()):
+        self.send_response(status)
+        for header, value in headers:
+            self.send_header(header, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def echo(self):
+        length = int(self.headers.get("Content-Length", 0))
+        echoed = {
+            "method": self.command,
+            "path": self.path,
+            "headers": dict(self.headers.items()),
+            "body": self.rfile.read(length).decode("latin-1"),
+        }
+        self.respond(200, json.dumps(echoed).encode(), [("X-Echo", "yes")])
+
+    def do_GET(self):
+        if self.path == "/chunked":
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for chunk in (b"hello, ", b"chunked world"):
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        elif self.path == "/gzip":
+            self.respond(
+                200, gzip.compress(b"compressed" * 10), [("Content-Encoding", "gzip")]
+            )
+        elif self.path == "/slow":
+            time.sleep(0.5)
+            self.respond(200, b"late")
+        elif self.path == "/redirect":
+            self.respond(302, headers=[("Location", "/echo")])
+        elif self.path == "/large":
+            self.respond(200, b"0123456789" * 20000)
+        elif self.path == "/login":
+            self.respond(200, headers=[("Set-Cookie", "session=alice-secret; Path=/")])
+        elif self.path == "/missing":
+            self.respond(404, b"nope")
+        else:
+            self.echo()
+
+    do_POST = do_PUT = do_DELETE = do_HEAD = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+
+
+class TransportConformance(object):
+    """
+    Behaviour every backend must have.
+    """
+
+    def setUp(self):
+        self.server = StubServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.transport = transport.create(self.backend)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_round_trip(self):
+        response = self.transport.request(
+            "POST",
+            f"{self.url}/echo?page=2",
+            headers={"X-Qbox-TransactionID": "t-1"},
+            body=b"\xff\x00payload",
+            timeout=5,
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["x-echo"], "yes")
+        echoed = json.loads(response.content)
+        self.assertEqual(echoed["method"], "POST")
+        self.assertEqual(echoed["path"], "/echo?page=2")
+        self.assertEqual(echoed["headers"]["X-Qbox-TransactionID"], "t-1")
+        self.assertEqual(echoed["body"], "\xff\x00payload")
+
+    def test_bodies_are_decoded(self):
+        chunked = self.transport.request("GET", f"{self.url}/chunked", timeout=5)
+        self.assertEqual(chunked.content, b"hello, chunked world")
+
+        compressed = self.transport.request("GET", f"{self.url}/gzip", timeout=5)
+        self.assertEqual(compressed.content, b"compressed" * 10)
+
+    def test_large_bodies_are_spooled(self):
+        with patch("settings.SPOOL_THRESHOLD_BYTES", 1024):
+            large = self.transport.request("GET", f"{self.url}/large", timeout=5)
+        self.assertIsInstance(large.content, spool.SpooledBody)
+        self.assertEqual(large.content, b"0123456789" * 20000)
+
+        # And are sent on without being read into memory.
+        echoed = self.transport.request(
+            "POST", f"{self.url}/echo", body=large.content, timeout=5
+        )
+        self.assertEqual(json.loads(echoed.content)["body"], "0123456789" * 20000)
+
+    def test_statuses_are_handed_back(self):
+        missing = self.transport.request("GET", f"{self.url}/missing", timeout=5)
+        self.assertEqual((missing.status_code, missing.content), (404, b"nope"))
+
+        redirect = self.transport.request("GET", f"{self.url}/redirect", timeout=5)
+        self.assertEqual(redirect.status_code, 302)
+        self.assertEqual(redirect.headers["Location"], "/echo")
+
+        head = self.transport.request("HEAD", f"{self.url}/echo", timeout=5)
+        self.assertEqual((head.status_code, head.content), (200, b""))
+
+    def test_cookies_are_not_kept(self):
+        login = self.transport.request("GET", f"{self.url}/login", timeout=5)
+        self.assertIn("session=alice-secret", login.headers["Set-Cookie"])
+
+        response = self.transport.request("GET", f"{self.url}/other", timeout=5)
+        self.assertNotIn("Cookie", json.loads(response.content)["headers"])
+
+    def test_proxy(self):
+        with patch("settings.HTTP_PROXY", self.url):
+            proxied = transport.create(self.backend)
+        self.addCleanup(proxied.close)
+
+        response = proxied.request(
+            "POST", "http://downstream.invalid/echo?page=2", body=b"{}", timeout=5
+        )
+        echoed = json.loads(response.content)
+        self.assertEqual(echoed["path"], "http://downstream.invalid/echo?page=2")
+        self.assertEqual(echoed["headers"]["Host"], "downstream.invalid")
+        self.assertEqual(echoed["body"], "{}")
+
+    def test_timeouts(self):
+        with self.assertRaises(transport.Timeout):
+            self.transport.request("GET", f"{self.url}/slow", timeout=0.1)
+
+        # The connection that timed out isn't handed out again.
+        response = self.transport.request("GET", f"{self.url}/missing", timeout=5)
+        self.assertEqual(response.content, b"nope")
+
+    def test_connections_are_reused(self):
+        self.assertEqual(self.transport.warm(self.url, 2), 2)
+        for _ in range(5):
+            self.transport.request("PUT", f"{self.url}/echo", body=b"{}", timeout=5)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_concurrent_requests(self):
+        results = []
+
+        def send(index):
+            response = self.transport.request(
+                "POST", f"{self.url}/echo", body=str(index).encode(), timeout=5
+            )
+            results.append(json.loads(response.content)["body"])
+
+        threads = [threading.Thread(target=send, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results, key=int), [str(i) for i in range(20)])
+
+
+class TestRequestsTransport(TransportConformance, unittest.TestCase):
+    backend = "requests"
+
+
+class TestUrllib3Transport(TransportConformance, unittest.TestCase):
+    backend = "urllib3"
+
+
+class TestAsyncioTransport(TransportConformance, unittest.TestCase):
+    backend = "asyncio"
+
+
+class TestHeaders(unittest.TestCase):
+    def test_case_insensitive_and_folded(self):
+        headers = transport.Headers([("Set-Cookie", "a=1"), ("set-cookie", "b=2")])
+        headers["Content-Type"] = "text/plain"
+
+        self.assertEqual(headers["SET-COOKIE"], "a=1, b=2")
+        self.assertEqual(
+            dict(headers), {"Set-Cookie": "a=1, b=2", "Content-Type": "text/plain"}
+        )
+        self.assertIn("content-type", headers)
+
+    def test_unknown_backends_are_rejected(self):
+        with self.assertRaises(ValueError):
+            transport.create("curl")
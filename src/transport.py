@@ -0,0 +1,311 @@
+"""
+Pluggable outbound HTTP.
+
+Every request Qbox sends downstream - saga transactions, compensations and pass-through
+traffic - goes through the process-wide transport returned by `get`. The backend is
+chosen with QBOX_TRANSPORT:
+
+    requests   the pooled requests session from pool.py (the default)
+    urllib3    a urllib3 pool manager, without requests' per-request work of merging
+               session settings, cookies and hooks
+    asyncio    HTTP/1.1 over asyncio streams, multiplexed on one event loop thread
+               (see asynctransport.py)
+
+Whichever is used, hostnames are resolved through pool's DNS cache, up to
+QBOX_POOL_CONNECTIONS_PER_HOST idle connections are kept alive per host, redirects are
+handed back rather than followed, plain http:// requests go through QBOX_HTTP_PROXY if
+it is set, and `Timeout` is raised when connecting or waiting
+for the response takes longer than the timeout. Cookies set by responses are never
+stored, so none are sent with later requests. Responses come back as a `Response`
+with the status code, headers and (decoded) body.
+
+`python3 benchmark.py transport` compares the backends against a local stub server.
+"""
+import zlib
+import settings
+import threading
+import collections.abc
+from urllib.parse import urlsplit
+
+import pool
+import spool
+
+
+class Timeout(Exception):
+    pass
+
+
+class Headers(collections.abc.MutableMapping):
+    """
+    Case-insensitive headers, keeping the case they were first set with. Repeated
+    headers are folded into one comma-separated value, as requests does.
+    """
+
+    def __init__(self, items=()):
+        self.store = {}
+        for name, value in items:
+            self.add(name, value)
+
+    def add(self, name, value):
+        key = name.lower()
+        if key in self.store:
+            self.store[key] = (self.store[key][0], f"{self.store[key][1]}, {value}")
+        else:
+            self.store[key] = (name, value)
+
+    def __getitem__(self, name):
+        return self.store[name.lower()][1]
+
+    def __setitem__(self, name, value):
+        self.store[name.lower()] = (name, value)
+
+    def __delitem__(self, name):
+        del self.store[name.lower()]
+
+    def __iter__(self):
+        return (name for name, _ in self.store.values())
+
+    def __len__(self):
+        return len(self.store)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class Response(object):
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+
+class Transport(object):
+    name = None
+
+    def __init__(self):
+        self.proxy = settings.HTTP_PROXY
+
+    def proxies(self, url):
+        """
+        The proxy to send a request to `url` through, or None.
+        """
+
+        return self.proxy if url.lower().startswith("http://") else None
+
+    def request(self, method, url, headers=None, body=None, timeout=None):
+        """
+        Send a request and return its `Response`. `timeout` is in seconds, and None
+        waits for as long as it takes.
+        """
+
+        raise NotImplementedError()
+
+    def warm(self, url, connections):
+        """
+        Make sure `connections` connections to the "scheme://host[:port]" `url` are
+        open and pooled, and return how many are.
+        """
+
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+def fill(connection_pool, connections):
+    """
+    Open connections in a urllib3 connection pool until `connections` are open.
+    """
+
+    # Take the connections out all at once so that we get distinct ones rather than
+    # the same one back each time, and put them back when we're done.
+    taken = []
+    try:
+        for _ in range(connections):
+            connection = connection_pool._get_conn()
+            taken.append(connection)
+            if getattr(connection, "sock", None) is None:
+                connection.connect()
+    finally:
+        for connection in taken:
+            connection_pool._put_conn(connection)
+
+    return len(taken)
+
+
+class RequestsTransport(Transport):
+    name = "requests"
+
+    def request(self, method, url, headers=None, body=None, timeout=None):
+        # Imported here rather than at module load to keep sidecar startup fast.
+        import requests
+
+        proxy = self.proxies(url)
+        try:
+            response = pool.session().request(
+                method=method,
+                url=url,
+                headers=headers,
+                data=body,
+                timeout=timeout,
+                allow_redirects=False,
+                stream=True,
+                proxies={"http": proxy} if proxy else None,
+            )
+        except requests.exceptions.Timeout as e:
+            raise Timeout(str(e)) from e
+
+        try:
+            content = spool.collect(response.iter_content(spool.CHUNK_SIZE))
+        finally:
+            response.close()
+        return Response(response.status_code, response.headers, content)
+
+    def warm(self, url, connections):
+        import requests
+
+        # Ask the adapter for the pool the way a request would, so that we warm the
+        # pool requests will actually use (they are keyed by TLS settings too).
+        shared = pool.session()
+        adapter = shared.get_adapter(url)
+        settings_for_url = shared.merge_environment_settings(url, {}, None, None, None)
+        if hasattr(adapter, "get_connection_with_tls_context"):
+            connection_pool = adapter.get_connection_with_tls_context(
+                requests.Request("GET", url).prepare(),
+                settings_for_url["verify"],
+                settings_for_url["proxies"],
+                settings_for_url["cert"],
+            )
+        else:
+            connection_pool = adapter.get_connection(url, settings_for_url["proxies"])
+
+        return fill(connection_pool, connections)
+
+
+class Urllib3Transport(Transport):
+    name = "urllib3"
+
+    def __init__(self):
+        import urllib3
+
+        super().__init__()
+        self.urllib3 = urllib3
+        self.manager = urllib3.PoolManager(
+            num_pools=settings.POOL_HOSTS, maxsize=settings.POOL_CONNECTIONS_PER_HOST
+        )
+        self.manager.pool_classes_by_scheme = pool.connection_pool_classes()
+        self.proxy_manager = None
+        if self.proxy:
+            self.proxy_manager = urllib3.ProxyManager(
+                self.proxy, maxsize=settings.POOL_CONNECTIONS_PER_HOST
+            )
+
+    def request(self, method, url, headers=None, body=None, timeout=None):
+        headers = dict(headers.items()) if headers else {}
+        if isinstance(body, spool.SpooledBody):
+            # Sent a chunk at a time, which urllib3 would otherwise frame as chunked.
+            headers["Content-Length"] = str(len(body))
+
+        manager = self.proxy_manager if self.proxies(url) else self.manager
+        try:
+            response = manager.urlopen(
+                method,
+                url,
+                headers=headers,
+                body=body,
+                timeout=self.urllib3.Timeout(connect=timeout, read=timeout),
+                retries=False,
+                redirect=False,
+                preload_content=False,
+            )
+            try:
+                content = spool.collect(response.stream(spool.CHUNK_SIZE))
+            except BaseException:
+                # Whatever is left of the body is still on the connection.
+                response.close()
+                raise
+            response.release_conn()
+        except self.urllib3.exceptions.TimeoutError as e:
+            raise Timeout(str(e)) from e
+
+        return Response(response.status, Headers(response.headers.items()), content)
+
+    def warm(self, url, connections):
+        return fill(self.manager.connection_from_url(url), connections)
+
+    def close(self):
+        self.manager.clear()
+        if self.proxy_manager is not None:
+            self.proxy_manager.clear()
+
+
+class Decoder(object):
+    """
+    Undoes the Content-Encoding of a body a chunk at a time.
+    """
+
+    def __init__(self, headers):
+        self.encoding = headers.get("Content-Encoding", "").lower()
+        if self.encoding == "gzip":
+            self.inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == "deflate":
+            self.inflate = zlib.decompressobj()
+        else:
+            self.inflate = None
+        self.started = False
+
+    def decode(self, chunk):
+        if self.inflate is None or not chunk:
+            return chunk
+        try:
+            decoded = self.inflate.decompress(chunk)
+        except zlib.error:
+            if self.started or self.encoding != "deflate":
+                raise
+            # Some servers send raw deflate streams without the zlib wrapper.
+            self.inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+            decoded = self.inflate.decompress(chunk)
+        self.started = True
+        return decoded
+
+    def flush(self):
+        return self.inflate.flush() if self.inflate is not None else b""
+
+
+def asyncio_transport():
+    # asyncio pulls in a good part of the standard library, so only load it if used.
+    from asynctransport import AsyncioTransport
+
+    return AsyncioTransport()
+
+
+BACKENDS = {
+    "requests": RequestsTransport,
+    "urllib3": Urllib3Transport,
+    "asyncio": asyncio_transport,
+}
+
+
+def create(name):
+    if name not in BACKENDS:
+        raise ValueError(
+            f"Unknown transport {name}, expected one of {', '.join(sorted(BACKENDS))}"
+        )
+    return BACKENDS[name]()
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get():
+    """
+    The process-wide transport all downstream requests are sent through.
+    """
+
+    global _transport
+
+    with _transport_lock:
+        if _transport is None:
+            _transport = create(settings.TRANSPORT)
+        return _transport